@@ -0,0 +1,242 @@
+'''
+Reactive state machines ticked once per sensor frame
+Nothing a state does blocks: states send commands when they are entered, and leave when a sensor predicate or their timeout says so
+Every transition is checked on every frame, so the iRobot reacts within a frame instead of whenever a sleep ends
+Predicates are given the iRobot's snapshot of the frame, so every predicate of a tick sees the same frame
+'''
+import math
+from history import clock
+from scheduler import FrameScheduler
+
+class State(object):
+	'''
+	One state of a Machine
+	'''
+	def __init__(self, name, enter=None, tick=None, timeout=None, then=None):
+		'''
+		enter(robot) runs when the state is entered and tick(robot, dt) on every frame the state doesn't leave
+		After timeout seconds the machine goes to the state called then
+		'''
+		self.name = name
+		self.enter = enter
+		self.tick = tick
+		self.timeout = timeout
+		self.then = then
+		self.transitions = [] # (predicate, target, action) checked in order on every frame
+
+	def on(self, predicate, target, action=None):
+		'''
+		Goes to the state called target, after running action(robot), on the first frame predicate(state) is True for the frame's sensor snapshot
+		Returns the state so transitions can be chained
+		'''
+		self.transitions.append((predicate, target, action))
+		return self
+
+class Machine(object):
+	'''
+	A set of States ticked by a FrameScheduler until one of the final states is reached
+	'''
+	def __init__(self, robot, initial, final=(), name='machine'):
+		'''
+		Creates a machine for robot that starts in the state called initial and stops in any of the final states
+		'''
+		self.robot = robot
+		self.initial = initial
+		self.final = final
+		self.name = name
+		self.states = {}
+		self.always = [] # (predicate, target, action) checked before every state's own transitions
+		self.state = None # The current State
+		self.entered = 0.0 # Time the current state was entered
+		self.frames = 0 # Frames spent in the current state
+		self.task = None # The scheduler task ticking the machine while it runs
+
+	def add(self, state):
+		'''
+		Adds a State and returns it
+		'''
+		self.states[state.name] = state
+		return state
+
+	def on(self, predicate, target, action=None):
+		'''
+		Goes to the state called target from any state on the first frame predicate(state) is True
+		'''
+		self.always.append((predicate, target, action))
+		return self
+
+	def sequence(self, name, steps, then):
+		'''
+		Adds states that run steps, a list of (enter, seconds) pairs, one after the other and then go to the state called then
+		The states are called name 0, name 1, and so on, and the list of them is returned so transitions can be added
+		'''
+		states = []
+		for i, (enter, seconds) in enumerate(steps):
+			following = '%s %d' % (name, i + 1) if i + 1 < len(steps) else then
+			states.append(self.add(State('%s %d' % (name, i), enter, timeout=seconds, then=following)))
+		return states
+
+	@property
+	def done(self):
+		'''
+		True once a final state has been reached
+		'''
+		return self.state is not None and self.state.name in self.final
+
+	@property
+	def elapsed(self):
+		'''
+		Seconds spent in the current state
+		'''
+		return clock() - self.entered
+
+	def go(self, name):
+		'''
+		Enters the state called name
+		'''
+		self.state = self.states[name]
+		self.entered = clock()
+		self.frames = 0
+		self.robot.log.event('state', machine=self.name, state=name)
+		if self.state.enter is not None:
+			self.state.enter(self.robot)
+
+	def tick(self, dt=0.0):
+		'''
+		Takes the first transition whose predicate is True, or the timeout, or else runs the state's tick
+		'''
+		if self.state is None:
+			self.go(self.initial)
+		if self.done:
+			return
+		self.frames += 1
+		state = self.robot.state # One frame for every predicate
+		for predicate, target, action in self.always + self.state.transitions:
+			if predicate(state):
+				if action is not None:
+					action(self.robot)
+				self.go(target)
+				return
+		if self.state.timeout is not None and self.elapsed >= self.state.timeout:
+			self.go(self.state.then)
+			return
+		if self.state.tick is not None:
+			self.state.tick(self.robot, dt)
+
+	def run(self, scheduler=None, timeout=None):
+		'''
+		Ticks the machine on every frame until it reaches a final state, or until no frame arrives within timeout seconds
+		Returns the name of the state it stopped in
+		'''
+		scheduler = FrameScheduler(self.robot) if scheduler is None else scheduler
+		self.state = None
+		self.task = scheduler.every(self.tick)
+		try:
+			scheduler.run(until=lambda: self.done, timeout=timeout)
+		finally:
+			scheduler.cancel(self.task)
+		return None if self.state is None else self.state.name
+
+def turn_time(robot, angle, speed):
+	'''
+	Seconds it takes robot to turn angle degrees in place at speed m/s
+	'''
+	return abs(angle) / (speed * 180.0 / (robot.RADIUS * math.pi))
+
+def turning(angle, speed):
+	'''
+	Returns an enter action that turns in place, counter clockwise if angle is positive
+	'''
+	return lambda robot: robot.drive(speed, robot.CCW if angle > 0 else robot.CW)
+
+def driving(speed):
+	'''
+	Returns an enter action that drives straight at speed m/s, backwards if speed is negative
+	'''
+	return lambda robot: robot.drive(speed, robot.STRAIGHT)
+
+def stopping(robot):
+	'''
+	Enter action that stops the wheels
+	'''
+	robot.stop_drive()
+
+def seek_dock(robot):
+	'''
+	Builds the machine that follows the dock's infrared beams until the iRobot is charging
+	'''
+	slow = robot.MAX_SPEED / 10
+	fast = robot.MAX_SPEED / 5
+	turn = lambda angle: (turning(angle, fast), turn_time(robot, angle, fast))
+	pause = lambda seconds: (stopping, seconds)
+	memory = {'on_dock': False, 'attempts': 0, 'made_room': False}
+	no_characters = lambda r: r.IR_OMNI_CHAR.curr == 0 and r.IR_LEFT_CHAR.curr == 0 and r.IR_RIGHT_CHAR.curr == 0
+	both_buoys = lambda r: r.IR_LEFT_CHAR.curr == robot.G_N_R_BUOY or r.IR_RIGHT_CHAR.curr == robot.G_N_R_BUOY
+	force_field = lambda r: r.IR_OMNI_CHAR.curr == robot.FORCE_FIELD and r.IR_LEFT_CHAR.curr == 0 and r.IR_RIGHT_CHAR.curr == 0
+	def attempt(r):
+		memory['attempts'] += 1
+	def give_up(r):
+		memory['attempts'] = 0
+		memory['on_dock'] = False
+	def hit(r):
+		memory['on_dock'] = True
+	def approach(r):
+		memory['made_room'] = True
+		r.drive(slow, r.STRAIGHT)
+	def make_room(r):
+		memory['made_room'] = True
+		turning(15, fast)(r)
+
+	machine = Machine(robot, 'search', final=('docked',), name='seek dock')
+	machine.on(lambda r: r.charging == 2, 'docked')
+	machine.add(State('search', stopping)) \
+		.on(lambda r: memory['on_dock'] and no_characters(r) and memory['attempts'] < 3, 'wiggle 0', attempt) \
+		.on(lambda r: memory['on_dock'] and no_characters(r), 'back off', give_up) \
+		.on(both_buoys, 'approach') \
+		.on(lambda r: force_field(r) and not memory['made_room'], 'make room 0')
+	machine.sequence('wiggle', [turn(5), pause(0.75), turn(-5), pause(0.75)], 'search') # Sitting on the dock without charging
+	# Search stops the wheels when it is entered, so every back up below lasts its fixed time
+	machine.add(State('back off', driving(-slow), timeout=0.75, then='search'))
+	machine.add(State('approach', approach)) \
+		.on(lambda r: r.LB and r.RB and r.charging != 0, 'docked') \
+		.on(lambda r: r.LB and r.RB, 'center hit 0', hit) \
+		.on(lambda r: r.RB and not r.LB, 'right hit 0', hit) \
+		.on(lambda r: r.LB and not r.RB, 'left hit 0', hit)
+	machine.sequence('center hit', [turn(-5), (driving(-slow), 0.5)], 'search')
+	machine.sequence('right hit', [turn(-5), (driving(-slow), 0.25), turn(-5)], 'search')
+	machine.sequence('left hit', [turn(5), (driving(-slow), 0.25), turn(5)], 'search')
+	steps = machine.sequence('make room', [(make_room, turn_time(robot, 15, fast)), (driving(fast), 0.44 / fast), turn(-85), pause(0.5), turn(-3), pause(0.5)], 'search')
+	steps[1].on(lambda r: r.LB or r.RB, 'make room 2', stopping) # Stop driving forward on a bump
+	machine.add(State('docked', stopping))
+	return machine
+
+def wall_follower(robot, Kp, Kd, set_point, speed=None, stop=None):
+	'''
+	Builds the machine that keeps the right light bump at set_point with a PD controller
+	It turns left away from walls in front and stops in 'stopped' once stop(state) is True, or in 'dock' when the dock's omni beam is seen
+	'''
+	speed = robot.MAX_SPEED / 4.5 if speed is None else speed
+	e_prev = [None] # Error at the last tick
+	def follow(r, dt):
+		e_curr = set_point - r.IR_BR # Set error
+		e_rate = 0.0 if e_prev[0] is None or not dt else (e_curr - e_prev[0]) / dt # Change in error per second over the measured dt
+		e_prev[0] = e_curr
+		r.drive(speed, r.error2radius(Kp * e_curr + Kd * e_rate)) # Drive while safe
+	def resume(r):
+		r.stop_drive()
+		e_prev[0] = None # The turn isn't part of the controller's history
+	wall_ahead = lambda r: r.LT_BFR or (r.RB and not r.LB) # Pointed towards the wall
+	blocked = lambda r: (r.LB and r.RB) or r.LT_BCL # Center bump or a wall in front
+
+	machine = Machine(robot, 'follow', final=('stopped', 'dock'), name='wall follower')
+	if stop is not None:
+		machine.on(stop, 'stopped')
+	machine.on(lambda r: r.IR_OMNI_CHAR.curr != 0, 'dock')
+	machine.add(State('follow', tick=follow)) \
+		.on(wall_ahead, 'turn from wall') \
+		.on(blocked, 'turn from front')
+	machine.add(State('turn from wall', lambda r: r.drive(speed, r.CCW))).on(lambda r: not wall_ahead(r), 'follow', resume)
+	machine.add(State('turn from front', lambda r: r.drive(speed, r.CCW))).on(lambda r: not blocked(r), 'follow', resume)
+	machine.add(State('stopped', stopping))
+	machine.add(State('dock'))
+	return machine
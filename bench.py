@@ -0,0 +1,281 @@
+'''
+Microbenchmarks for the sensor and command hot paths, run without an iRobot attached
+Each benchmark runs on synthetic frames, or on the frames of a telemetry log, and reports ops/s and per-call latency percentiles
+Results can be saved as a baseline, and a benchmark slower than its baseline by more than the threshold fails the run
+Run with: python bench.py [names] [--recording telemetry.bin] [--baseline bench.json] [--save] [--threshold 0.25]
+'''
+import argparse
+import functools
+import itertools
+import json
+import os
+import sys
+import timeit
+from struct import pack, unpack
+import encoder
+from interface import Connection, FrameSync, Packet, iRobot
+from metrics import Metrics
+from recorder import RECEIVED, TelemetryLog
+
+FRAMES = 2000 # Synthetic frames each benchmark cycles through
+BATCHES = 50 # Timed batches per benchmark, each gives one per-call latency
+BATCH_TIME = 0.01 # Seconds each batch should take
+BASELINE = 'bench.json'
+THRESHOLD = 0.25 # Fraction a benchmark's median latency can grow over its baseline before the run fails
+
+class NullConnection(object):
+	'''
+	Stands in for a Connection and throws away everything sent to it
+	'''
+	def __init__(self):
+		self.metrics = Metrics()
+
+	def send(self, data, delay=True):
+		pass
+
+def make_frame(packets, values):
+	'''
+	Builds a complete frame (header, n-bytes, payload, and checksum) for packets with the given values
+	Every field of a group packet gets the packet's value
+	'''
+	fields = lambda packet: len(unpack('>' + packet.unpack, bytes(bytearray(packet.bytes + 1)))) - 1
+	payload = b''.join(pack('>' + packet.unpack, packet.id, *[value] * fields(packet)) for packet, value in zip(packets, values))
+	frame = bytearray([19, len(payload)]) + bytearray(payload)
+	frame.append(-sum(frame) & 0xFF)
+	return bytes(frame)
+
+def make_stream(packets, n):
+	'''
+	Builds n frames of changing sensor values
+	'''
+	return [make_frame(packets, [(i + j) % 2 for j in range(len(packets))]) for i in range(n)]
+
+def legacy_unwrap(raw_data, v1, v2):
+	'''
+	The circular search and rotation that read_data used before FrameSync
+	'''
+	ret_list = []
+	for index in range(len(raw_data)):
+		if raw_data[index] == v1 and raw_data[(index + 1) % len(raw_data)] == v2:
+			ret_list = bytearray([raw_data[(i + index) % len(raw_data)] for i in range(len(raw_data))])
+			break
+	return ret_list
+
+def legacy_parse(robot, data):
+	'''
+	The if/elif chain that parse_data used before SensorDecoder
+	'''
+	state = robot.working
+	for i in range(0, len(data), 2):
+		if data[i] == robot.WHEEL_DROP_AND_BUMPERS.id:
+			robot.decodeWDAB(data[i + 1])
+		elif data[i] == robot.CLIFF_LEFT.id:
+			state.cliff_left = bool(data[i + 1])
+		elif data[i] == robot.CLIFF_FRONT_LEFT.id:
+			state.cliff_front_left = bool(data[i + 1])
+		elif data[i] == robot.CLIFF_FRONT_RIGHT.id:
+			state.cliff_front_right = bool(data[i + 1])
+		elif data[i] == robot.CLIFF_RIGHT.id:
+			state.cliff_right = bool(data[i + 1])
+		elif data[i] == robot.VIRTUAL_WALL.id:
+			state.virtual_wall = bool(data[i + 1])
+		elif data[i] == robot.BUTTONS.id:
+			robot.decodeB(data[i + 1])
+		elif data[i] == robot.DISTANCE.id:
+			state.distance += data[i + 1]
+		elif data[i] == robot.ANGLE.id:
+			state.angle += data[i + 1]
+			state.angle %= 360
+		elif data[i] == robot.LIGHT_BUMP_RIGHT.id:
+			state.IR_BR = data[i + 1]
+		elif data[i] == robot.LIGHT_BUMPERS.id:
+			robot.decodeLTBS(data[i + 1])
+		elif data[i] == robot.IR_LEFT.id:
+			state.IR_LEFT_CHAR = robot.characters['IR_LEFT_CHAR'].update(int(data[i + 1]))
+		elif data[i] == robot.IR_RIGHT.id:
+			state.IR_RIGHT_CHAR = robot.characters['IR_RIGHT_CHAR'].update(int(data[i + 1]))
+		elif data[i] == robot.IR_OMNI.id:
+			state.IR_OMNI_CHAR = robot.characters['IR_OMNI_CHAR'].update(int(data[i + 1]))
+		elif data[i] == robot.CHARGING.id:
+			state.charging = data[i + 1]
+		else:
+			break
+
+class NullTransport(object):
+	'''
+	Stands in for a serial port and throws away everything written to it
+	'''
+	in_waiting = 0
+
+	def write(self, data):
+		pass
+
+	def close(self):
+		pass
+
+def recorded_frames(path):
+	'''
+	Returns the packets streamed in a telemetry log and the received chunks, found from the first frame with a valid checksum
+	'''
+	log = TelemetryLog(path)
+	chunks = [bytes(data) for kind, timestamp, data in log.records((RECEIVED,))]
+	log.close()
+	packets = dict((packet.id, packet) for packet in vars(iRobot).values() if isinstance(packet, Packet))
+	stream = bytearray(b''.join(chunks))
+	for start in range(len(stream) - 2):
+		length = stream[start + 1]
+		frame = stream[start:start + length + 3]
+		if stream[start] != FrameSync.HEADER or len(frame) != length + 3 or sum(frame) & 0xFF:
+			continue
+		found = []
+		position = 2
+		while position < length + 2 and stream[start + position] in packets:
+			found.append(packets[stream[start + position]])
+			position += found[-1].bytes + 1
+		if position == length + 2:
+			return found, chunks
+	raise ValueError(path + ' has no frame of known packets')
+
+def cycle(values):
+	'''
+	Returns a function that returns the next of values every time it is called, going round forever
+	'''
+	return functools.partial(next, itertools.cycle(values))
+
+def benchmarks(robot, stream):
+	'''
+	Returns (name, operation) pairs, each operation doing one call of a hot path on the next frame or value
+	'''
+	sync = FrameSync(robot.decoder.length)
+	frames = [bytearray(frame) for chunk in stream for frame in sync.feed(chunk)]
+	if not frames:
+		raise ValueError('No frame of the streamed packets was found')
+	sync.reset()
+	chunk = cycle(stream)
+	frame = cycle(frames)
+	byte = cycle(range(256))
+	pair = cycle(range(-32768, 32768, 257))
+	bumps = cycle([tuple((i * 37 + j * 500) % 4096 for j in range(6)) for i in range(100)])
+	error = cycle([e for e in range(-500, 500, 7) if e])
+	speed = cycle(range(-500, 501, 10))
+	radius = cycle([iRobot.STRAIGHT, 1, -1, 200, -200, 500, 1000])
+	length = robot.decoder.length
+	fmt = '>' + ''.join(packet.unpack for packet in robot.packets)
+	raw = cycle([bytearray(chunk) for chunk in stream])
+	connection = Connection(transport=NullTransport(), metrics=Metrics(), writer=False)
+	drives = cycle([encoder.drive(v, 0) for v in range(-500, 501, 100)] + [encoder.STOP])
+	def feed():
+		for payload in sync.feed(chunk()):
+			pass
+	def send():
+		connection.send(drives(), delay=False)
+		connection.write_command(connection.queue.get(block=False))
+	return [
+		('frame_sync', feed),
+		('legacy_unwrap', lambda: legacy_unwrap(raw(), FrameSync.HEADER, length)),
+		('parse_data', lambda: robot.parse_data(frame())),
+		('legacy_parse', lambda: legacy_parse(robot, unpack(fmt, frame()))),
+		('snapshot', robot.working.snapshot),
+		('decodeWDAB', lambda: robot.decodeWDAB(byte())),
+		('decodeB', lambda: robot.decodeB(byte())),
+		('decodeLTBS', lambda: robot.decodeLTBS(byte())),
+		('decodeLightBumps', lambda: robot.decodeLightBumps(bumps())),
+		('decodeDistance', lambda: robot.decodeDistance(pair())),
+		('decodeAngle', lambda: robot.decodeAngle(pair())),
+		('error2radius', lambda: iRobot.error2radius(error())),
+		('encode_drive', lambda: encoder.drive(speed(), radius())),
+		('send', send),
+	]
+
+def time_calls(operation, calls):
+	'''
+	Returns the seconds calls calls of operation take
+	'''
+	timer = timeit.default_timer
+	loop = range(calls)
+	started = timer()
+	for i in loop:
+		operation()
+	return timer() - started
+
+def measure(operation, batches=BATCHES, batch_time=BATCH_TIME):
+	'''
+	Times operation in batches that take about batch_time seconds each
+	Returns a dictionary of ops/s and the 50th, 90th, and 99th percentiles of the per-call latency of the batches in seconds
+	'''
+	calls = 1
+	while True: # Find how many calls fill a batch, which also warms up caches
+		elapsed = time_calls(operation, calls)
+		if elapsed >= batch_time / 4:
+			break
+		calls *= 2
+	calls = max(1, int(calls * batch_time / elapsed))
+	latencies = sorted(time_calls(operation, calls) / calls for i in range(batches))
+	percentile = lambda percent: latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100.0))]
+	return {'ops': 1.0 / percentile(50), 'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99)}
+
+def compare(results, baseline, threshold):
+	'''
+	Returns a note for every benchmark compared with its baseline, and the names of the ones slower by more than threshold
+	'''
+	notes = {}
+	regressions = []
+	for name, result in results.items():
+		if name not in baseline:
+			notes[name] = 'new'
+			continue
+		change = result['p50'] / baseline[name]['p50'] - 1
+		notes[name] = '%+.0f%%' % (change * 100)
+		if change > threshold:
+			notes[name] += ' REGRESSION'
+			regressions.append(name)
+	return notes, regressions
+
+def main(arguments=None):
+	'''
+	Runs the benchmarks, prints a table, and returns 1 if any regressed past the threshold, 0 otherwise
+	'''
+	parser = argparse.ArgumentParser(description='Benchmarks the sensor and command hot paths')
+	parser.add_argument('names', nargs='*', help='benchmarks to run, all by default')
+	parser.add_argument('--recording', help='telemetry log whose received frames are used instead of synthetic ones')
+	parser.add_argument('--baseline', default=BASELINE, help='JSON file of baseline results, compared against when it exists')
+	parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+	parser.add_argument('--threshold', type=float, default=THRESHOLD, help='fraction the median latency can grow over the baseline')
+	options = parser.parse_args(arguments)
+
+	robot = iRobot(NullConnection())
+	if options.recording:
+		packets, stream = recorded_frames(options.recording)
+		robot.set_packets(packets)
+	else:
+		stream = make_stream(robot.packets, FRAMES)
+	operations = benchmarks(robot, stream)
+	names = [name for name, operation in operations]
+	unknown = [name for name in options.names if name not in names]
+	if unknown:
+		parser.error('unknown benchmark ' + ', '.join(unknown) + ', choose from ' + ', '.join(names))
+	baseline = {}
+	if os.path.exists(options.baseline):
+		with open(options.baseline) as f:
+			baseline = json.load(f)
+	results = {}
+	print('%-18s %12s %10s %10s %10s  %s' % ('benchmark', 'ops/s', 'p50 us', 'p90 us', 'p99 us', 'vs baseline'))
+	for name, operation in operations:
+		if options.names and name not in options.names:
+			continue
+		results[name] = result = measure(operation)
+		notes, regressions = compare({name: result}, baseline, options.threshold)
+		print('%-18s %12.0f %10.3f %10.3f %10.3f  %s' % (name, result['ops'], result['p50'] * 1e6, result['p90'] * 1e6, result['p99'] * 1e6, notes[name] if baseline else '-'))
+	notes, regressions = compare(results, baseline, options.threshold) if baseline else ({}, [])
+	if options.save:
+		baseline.update(results)
+		with open(options.baseline, 'w') as f:
+			json.dump(baseline, f, indent=1, sort_keys=True)
+		print('Saved the baseline to ' + options.baseline)
+	if regressions:
+		print('Slower than the baseline by more than %.0f%%: %s' % (options.threshold * 100, ', '.join(sorted(regressions))))
+		return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
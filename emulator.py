@@ -0,0 +1,497 @@
+'''
+In-process emulator of the iRobot Create 2 Open Interface
+It can stand in for the serial port of a Connection or PiConnector, or be served on a pty
+'''
+import collections
+import math
+import os
+import random
+import select
+import struct
+import threading
+import time
+import encoder
+
+class OIEmulator(object):
+	'''
+	Emulates the Open Interface: accepts commands through write and streams sensor frames through read
+	'''
+	# Modes reported by packet 35
+	OFF = 0
+	PASSIVE = 1
+	SAFE = 2
+	FULL = 3
+
+	WHEEL_BASE = encoder.WHEEL_BASE # mm
+	STRAIGHT = (32767, -32768, 0) # Radii that drive straight, iRobotPolygon relies on 0 doing so
+
+	# Number of argument bytes after each opcode, None when the first argument holds a count
+	ARGUMENTS = {
+		7: 0, 128: 0, 131: 0, 132: 0, 137: 4, 140: None, 141: 1, 142: 1, 143: 0, 145: 4, 148: None, 149: None, 150: 1,
+		152: None, 153: 0, 155: 1, 156: 2, 157: 2, 158: 1, 173: 0,
+	}
+	WAITS = (155, 156, 157, 158) # Script commands that wait for time, distance, angle, or an event
+
+	# Unpack format of every packet that can be streamed or queried
+	PACKETS = {
+		7: 'B', 8: 'B', 9: 'B', 10: 'B', 11: 'B', 12: 'B', 13: 'B', 14: 'B', 15: 'B', 16: 'B', 17: 'B', 18: 'B',
+		19: 'h', 20: 'h', 21: 'B', 22: 'H', 23: 'h', 24: 'b', 25: 'H', 26: 'H', 27: 'H', 28: 'H', 29: 'H', 30: 'H',
+		31: 'H', 32: 'B', 33: 'H', 34: 'B', 35: 'B', 36: 'B', 37: 'B', 38: 'B', 39: 'h', 40: 'h', 41: 'h', 42: 'h',
+		43: 'h', 44: 'h', 45: 'B', 46: 'H', 47: 'H', 48: 'H', 49: 'H', 50: 'H', 51: 'H', 52: 'B', 53: 'B', 54: 'h',
+		55: 'h', 56: 'h', 57: 'h', 58: 'B',
+	}
+	GROUPS = {106: (46, 47, 48, 49, 50, 51)} # Packet groups and the packets they hold
+
+	def __init__(self, period=0.015, realtime=True, drop_rate=0.0, corrupt_rate=0.0, jitter=0.0, seed=None):
+		'''
+		Creates an emulator that streams a frame every period seconds
+		If realtime is False frames are made as fast as they are read, with time advancing by period per frame
+		drop_rate and corrupt_rate are the chances of dropping or flipping each streamed byte
+		jitter is the most seconds a frame can be late by
+		'''
+		self.period = period
+		self.realtime = realtime
+		self.drop_rate = drop_rate
+		self.corrupt_rate = corrupt_rate
+		self.jitter = jitter
+		self.random = random.Random(seed)
+		self.timeout = None # Seconds read waits for, like serial.Serial.timeout
+		self.lock = threading.Lock()
+		self.ready = threading.Condition(self.lock) # Notified when output is added
+		self.input = bytearray() # Command bytes that haven't formed a full command yet
+		self.output = bytearray() # Bytes waiting to be read
+		self.received = collections.Counter() # Number of commands received for each opcode
+		self.commands = {
+			7: self.reset, 128: self.start, 131: self.safe, 132: self.full, 137: self.drive, 140: self.song,
+			141: self.play, 142: self.query, 143: self.seek_dock, 145: self.drive_direct, 148: self.stream,
+			149: self.query_list, 150: self.pause_resume, 152: self.script, 153: self.play_script, 173: self.stop,
+		}
+		self.reset(None)
+		self.running = True
+		self.pty = None # Master and slave file descriptors of the pty the emulator is served on
+		self.pumps = [] # Threads that move bytes between the pty and the emulator
+		self.thread = None
+		if realtime:
+			self.thread = threading.Thread(target=self.run)
+			self.thread.daemon = True
+			self.thread.start()
+
+	################################################## Serial Port ##################################################
+
+	def write(self, data):
+		'''
+		Takes command bytes and executes every complete command
+		'''
+		with self.lock:
+			self.input += bytearray(data)
+			for command in self.split(self.input):
+				self.received[command[0]] += 1
+				if command[0] in self.commands:
+					self.commands[command[0]](command)
+		return len(data)
+
+	def read(self, n=1):
+		'''
+		Returns up to n bytes, waiting at most timeout seconds for them to arrive
+		'''
+		deadline = None if self.timeout is None else time.time() + self.timeout
+		with self.lock:
+			while len(self.output) < n:
+				if not self.realtime and self.streaming:
+					self.tick()
+					continue
+				remaining = None if deadline is None else deadline - time.time()
+				if remaining is not None and remaining <= 0:
+					break
+				self.ready.wait(remaining)
+			data = bytes(self.output[:n])
+			del self.output[:n]
+			return data
+
+	@property
+	def in_waiting(self):
+		'''
+		Number of bytes that can be read without waiting
+		'''
+		with self.lock:
+			if not self.output and not self.realtime and self.streaming:
+				self.tick()
+			return len(self.output)
+
+	def reset_input_buffer(self):
+		'''
+		Throws away every byte that hasn't been read
+		'''
+		with self.lock:
+			del self.output[:]
+
+	def flush(self):
+		'''
+		Commands are executed as soon as they are written, so there is nothing to flush
+		'''
+
+	def close(self):
+		'''
+		Stops streaming frames
+		'''
+		self.running = False
+		for thread in self.pumps:
+			thread.join()
+		self.pumps = []
+		if self.pty is not None:
+			os.close(self.pty[0])
+			os.close(self.pty[1])
+			self.pty = None
+		if self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join()
+
+	def serve_pty(self):
+		'''
+		Serves the emulator on a pseudo terminal and returns its path, which can be opened like /dev/ttyUSB0
+		'''
+		import pty
+		import tty
+		master, slave = pty.openpty()
+		tty.setraw(slave)
+		def commands():
+			while self.running:
+				if select.select([master], [], [], 0.1)[0]:
+					self.write(os.read(master, 1024))
+		def frames():
+			timeout, self.timeout = self.timeout, 0.1
+			while self.running:
+				data = self.read(max(1, len(self.output)))
+				if data:
+					os.write(master, data)
+			self.timeout = timeout
+		for target in (commands, frames):
+			thread = threading.Thread(target=target)
+			thread.daemon = True
+			thread.start()
+			self.pumps.append(thread)
+		self.pty = (master, slave)
+		return os.ttyname(slave)
+
+	################################################## Fault Injection ##################################################
+
+	def inject(self, packet_id, value, frames=1):
+		'''
+		Makes packet_id report value for the next frames frames, or until cleared when frames is None
+		'''
+		with self.lock:
+			self.overrides[packet_id] = [value, frames]
+
+	def clear(self, packet_id=None):
+		'''
+		Removes the injected value of packet_id, or of every packet
+		'''
+		with self.lock:
+			if packet_id is None:
+				self.overrides.clear()
+			else:
+				self.overrides.pop(packet_id, None)
+
+	def bump(self, left=True, right=True, frames=1):
+		'''
+		Presses the bumpers for frames frames
+		'''
+		self.inject(7, (self.sensors[7] & ~3) | (left << 1) | right, frames)
+
+	def cliff(self, left=False, front_left=False, front_right=False, right=False, frames=1):
+		'''
+		Makes the cliff sensors see a cliff for frames frames
+		'''
+		for packet_id, detected in ((9, left), (10, front_left), (11, front_right), (12, right)):
+			if detected:
+				self.inject(packet_id, 1, frames)
+
+	def ir(self, character, frames=1, sensors=(17, 52, 53)):
+		'''
+		Makes the omni, left, and right infrared receivers see character for frames frames
+		'''
+		for packet_id in sensors:
+			self.inject(packet_id, character, frames)
+
+	################################################## Sensor Stream ##################################################
+
+	def run(self):
+		'''
+		Streams a frame every period seconds, plus up to jitter seconds
+		'''
+		next_frame = time.time()
+		while self.running:
+			next_frame += self.period
+			delay = next_frame - time.time() + self.random.uniform(0, self.jitter)
+			if delay > 0:
+				time.sleep(delay)
+			with self.lock:
+				self.tick()
+
+	def tick(self):
+		'''
+		Advances the emulator by one period and streams a frame if the stream is on
+		Must be called with the lock held
+		'''
+		self.clock += self.period
+		self.move(self.period)
+		self.run_script()
+		if not self.streaming:
+			return
+		frame = bytearray([19, 0])
+		for packet_id in self.stream_ids:
+			frame.append(packet_id)
+			frame += self.encode(packet_id)
+		frame[1] = len(frame) - 2
+		frame.append(-sum(frame) & 0xFF)
+		for value in frame:
+			if self.drop_rate and self.random.random() < self.drop_rate:
+				continue
+			if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+				value ^= 1 << self.random.randrange(8)
+			self.output.append(value)
+		for packet_id in list(self.overrides):
+			override = self.overrides[packet_id]
+			if override[1] is not None:
+				override[1] -= 1
+				if override[1] <= 0:
+					del self.overrides[packet_id]
+		self.ready.notify_all()
+
+	def encode(self, packet_id):
+		'''
+		Returns the bytes of packet_id, or of every packet in a group
+		'''
+		if packet_id in self.GROUPS:
+			return b''.join(self.encode(member) for member in self.GROUPS[packet_id])
+		return struct.pack('>' + self.PACKETS[packet_id], self.value(packet_id))
+
+	def value(self, packet_id):
+		'''
+		Returns the current value of packet_id
+		'''
+		if packet_id in self.overrides:
+			return self.overrides[packet_id][0]
+		if packet_id == 19: # Distance since it was last sent
+			value = int(self.distance)
+			self.distance -= value
+			return value
+		if packet_id == 20: # Angle since it was last sent
+			value = int(self.angle)
+			self.angle -= value
+			return value
+		if packet_id == 35:
+			return self.mode
+		return self.sensors[packet_id]
+
+	def move(self, dt):
+		'''
+		Integrates the wheel velocities over dt seconds
+		'''
+		left, right = self.wheels
+		distance = (left + right) / 2.0 * dt
+		angle = math.degrees((right - left) / self.WHEEL_BASE * dt)
+		self.distance += distance
+		self.angle += angle
+		self.traveled += distance
+		self.turned += angle
+		if self.mode == self.SAFE and (self.value_of(7) & 12 or any(self.value_of(i) for i in (9, 10, 11, 12))):
+			self.mode = self.PASSIVE # Safe mode falls back to passive on a wheel drop or cliff
+			self.wheels = (0, 0)
+
+	def value_of(self, packet_id):
+		'''
+		Returns the value of packet_id without consuming odometry
+		'''
+		return self.overrides[packet_id][0] if packet_id in self.overrides else self.sensors[packet_id]
+
+	################################################## Commands ##################################################
+
+	def split(self, buffer):
+		'''
+		Removes every complete command from the front of buffer and returns them
+		'''
+		commands = []
+		while buffer:
+			length = self.command_length(buffer)
+			if length is None or len(buffer) < length:
+				break
+			commands.append(buffer[:length])
+			del buffer[:length]
+		return commands
+
+	def command_length(self, buffer):
+		'''
+		Returns the length of the command at the front of buffer, or None if it isn't known yet
+		'''
+		opcode = buffer[0]
+		arguments = self.ARGUMENTS.get(opcode, 0)
+		if arguments is not None:
+			return 1 + arguments
+		if opcode == 140: # [140][song][length][note, duration]*length
+			return None if len(buffer) < 3 else 3 + 2 * buffer[2]
+		return None if len(buffer) < 2 else 2 + buffer[1] # [opcode][count][...]
+
+	def run_script(self):
+		'''
+		Executes script commands until one waits for something that hasn't happened yet
+		'''
+		while self.script_commands:
+			command = self.script_commands[0]
+			if command[0] in self.WAITS:
+				if self.waiting is None: # Remember where the wait started
+					self.waiting = (self.clock, self.traveled, self.turned)
+				if not self.waited(command):
+					return
+				self.waiting = None
+			elif command[0] in self.commands:
+				self.commands[command[0]](command)
+			self.script_commands.pop(0)
+
+	def waited(self, command):
+		'''
+		Returns whether the wait command is over
+		'''
+		clock, traveled, turned = self.waiting
+		if command[0] == 155: # Tenths of a second
+			return self.clock - clock >= command[1] / 10.0
+		if command[0] == 158: # Events aren't emulated
+			return True
+		target = struct.unpack('>h', bytes(command[1:3]))[0]
+		done = self.traveled - traveled if command[0] == 156 else self.turned - turned
+		return done >= target if target >= 0 else done <= target
+
+	def reset(self, command):
+		'''
+		[7], restarts the emulator as if it had just been turned on
+		'''
+		self.mode = self.OFF
+		self.clock = 0.0
+		self.sensors = collections.defaultdict(int)
+		self.overrides = {}
+		self.wheels = (0, 0) # Left and right velocities in mm/s
+		self.distance = 0.0 # mm since packet 19 was last sent
+		self.angle = 0.0 # Degrees since packet 20 was last sent
+		self.traveled = 0.0 # mm since the emulator started
+		self.turned = 0.0 # Degrees since the emulator started
+		self.stored_script = b''
+		self.script_commands = [] # Script commands that haven't run yet
+		self.waiting = None # Clock, distance, and angle when the current wait started
+		self.streaming = False
+		self.stream_ids = []
+		self.songs = {}
+		self.played = [] # Songs played, in order
+
+	def start(self, command):
+		'''
+		[128], starts the Open Interface in passive mode
+		'''
+		self.mode = self.PASSIVE
+
+	def safe(self, command):
+		'''
+		[131], enters safe mode and stops the wheels
+		'''
+		if self.mode != self.OFF:
+			self.mode = self.SAFE
+			self.wheels = (0, 0)
+
+	def full(self, command):
+		'''
+		[132], enters full mode and stops the wheels
+		'''
+		if self.mode != self.OFF:
+			self.mode = self.FULL
+			self.wheels = (0, 0)
+
+	def stop(self, command):
+		'''
+		[173], stops the Open Interface
+		'''
+		self.mode = self.OFF
+		self.streaming = False
+		self.wheels = (0, 0)
+
+	def seek_dock(self, command):
+		'''
+		[143], hands control to the robot's docking behavior
+		'''
+		self.mode = self.PASSIVE
+
+	def drive(self, command):
+		'''
+		[137][velocity][radius], turns on the spot for a radius of 1 or -1 and drives straight for 32767 or -32768
+		'''
+		if self.mode not in (self.SAFE, self.FULL):
+			return
+		velocity, radius = struct.unpack('>hh', bytes(command[1:]))
+		if radius in self.STRAIGHT:
+			self.wheels = (velocity, velocity)
+		elif radius in (1, -1):
+			self.wheels = (-radius * velocity, radius * velocity)
+		else:
+			offset = velocity * self.WHEEL_BASE / (2.0 * radius)
+			self.wheels = (velocity - offset, velocity + offset)
+
+	def drive_direct(self, command):
+		'''
+		[145][right velocity][left velocity]
+		'''
+		if self.mode not in (self.SAFE, self.FULL):
+			return
+		right, left = struct.unpack('>hh', bytes(command[1:]))
+		self.wheels = (left, right)
+
+	def song(self, command):
+		'''
+		[140][song][length][note, duration]*length, stores a song
+		'''
+		self.songs[command[1]] = bytes(command[3:])
+
+	def play(self, command):
+		'''
+		[141][song], plays a stored song
+		'''
+		if command[1] in self.songs:
+			self.played.append(command[1])
+
+	def script(self, command):
+		'''
+		[152][length][commands], stores a script
+		'''
+		self.stored_script = bytes(command[2:])
+
+	def play_script(self, command):
+		'''
+		[153], runs the stored script
+		'''
+		self.script_commands = self.split(bytearray(self.stored_script))
+		self.waiting = None
+		self.run_script()
+
+	def stream(self, command):
+		'''
+		[148][count][packet ids], starts streaming the packets
+		'''
+		self.stream_ids = list(command[2:])
+		self.streaming = True
+
+	def pause_resume(self, command):
+		'''
+		[150][0 or 1], pauses or resumes the stream
+		'''
+		self.streaming = bool(command[1])
+
+	def query(self, command):
+		'''
+		[142][packet id], sends the packet once
+		'''
+		self.output += self.encode(command[1])
+		self.ready.notify_all()
+
+	def query_list(self, command):
+		'''
+		[149][count][packet ids], sends the packets once
+		'''
+		for packet_id in command[2:]:
+			self.output += self.encode(packet_id)
+		self.ready.notify_all()
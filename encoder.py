@@ -0,0 +1,140 @@
+'''
+Bytes-native encoding of Open Interface commands
+Commands without arguments are constants, the rest are packed with precompiled structs and cached so repeated commands aren't rebuilt
+'''
+from struct import Struct
+
+# Op Codes
+RESET_OPCODE = 7
+START_OPCODE = 128
+SAFE_OPCODE = 131
+FULL_OPCODE = 132
+DRIVE = 137
+SONG = 140
+PLAY = 141
+SEEK_DOCK_OPCODE = 143
+QUERY = 142
+DRIVE_DIRECT = 145
+READ_SENSORS = 148
+PAUSE_RESUME = 150
+STOP_OPCODE = 173
+
+# Commands without arguments
+RESET = bytes(bytearray([RESET_OPCODE]))
+START = bytes(bytearray([START_OPCODE]))
+SAFE = bytes(bytearray([SAFE_OPCODE]))
+FULL = bytes(bytearray([FULL_OPCODE]))
+STOP = bytes(bytearray([STOP_OPCODE]))
+SEEK_DOCK = bytes(bytearray([SEEK_DOCK_OPCODE]))
+PAUSE_STREAM = bytes(bytearray([PAUSE_RESUME, 0]))
+RESUME_STREAM = bytes(bytearray([PAUSE_RESUME, 1]))
+
+WHEEL_BASE = 235.0 # mm between the wheels, which sit at the edge of the iRobot
+MAX_SPEED = 500.0 # Fastest a wheel can turn, mm/s
+
+DRIVE_COMMAND = Struct('>B2h') # Opcode and two signed 16 bit arguments
+PLAY_COMMAND = Struct('>2B')
+SONG_SLOTS = 4 # Songs the iRobot can hold at once
+MAX_NOTES = 16 # Notes a song can hold
+CACHE_SIZE = 256 # Most drive commands kept before the cache is emptied
+
+drives = {} # (opcode, first argument, second argument) -> encoded drive or drive direct command
+
+def drive(velocity, radius):
+	'''
+	Returns the drive command for a velocity in mm/s and a radius in mm, STRAIGHT for a straight line
+	'''
+	return encode_drive(DRIVE, velocity, radius)
+
+def drive_direct(right, left):
+	'''
+	Returns the drive direct command for right and left wheel velocities in mm/s
+	'''
+	return encode_drive(DRIVE_DIRECT, right, left)
+
+def encode_drive(opcode, first, second):
+	'''
+	Packs a drive or drive direct command, or returns the same command packed before
+	'''
+	key = (opcode, int(first), int(second))
+	command = drives.get(key)
+	if command is None:
+		if len(drives) >= CACHE_SIZE:
+			drives.clear()
+		command = drives[key] = DRIVE_COMMAND.pack(*key)
+	return command
+
+def stream(packet_ids):
+	'''
+	Returns the command that streams the packets with the given ids
+	'''
+	return bytes(bytearray([READ_SENSORS, len(packet_ids)] + list(packet_ids)))
+
+def song(slot, notes):
+	'''
+	Returns the command that stores notes, a sequence of (note, duration in 1/64 s) pairs, in a song slot
+	'''
+	if len(notes) > MAX_NOTES:
+		raise ValueError('A song holds at most ' + str(MAX_NOTES) + ' notes')
+	data = bytearray([SONG, slot, len(notes)])
+	for note, duration in notes:
+		data += bytearray([note, duration])
+	return bytes(data)
+
+def query(packet_id):
+	'''
+	Returns the command that asks for one packet
+	'''
+	return bytes(bytearray([QUERY, packet_id]))
+
+def play(slot):
+	'''
+	Returns the command that plays a song slot
+	'''
+	return PLAY_COMMAND.pack(PLAY, slot)
+
+class SongRegistry(object):
+	'''
+	Uploads each song to a slot the first time it is played, afterwards playing it only sends opcode 141
+	When every slot is taken the song played longest ago is replaced
+	'''
+	def __init__(self, send):
+		'''
+		Takes the function that sends a command, such as Connection.send
+		'''
+		self.send = send
+		self.slots = {} # Notes -> slot
+		self.used = [] # Songs in the order they were last played, oldest first
+
+	def play(self, notes):
+		'''
+		Plays notes, a sequence of (note, duration) pairs, uploading them first if they aren't in a slot
+		'''
+		notes = tuple(tuple(note) for note in notes)
+		slot = self.slots.get(notes)
+		if slot is None:
+			slot = self.load(notes)
+		else:
+			self.used.remove(notes)
+		self.used.append(notes)
+		self.send(play(slot))
+
+	def load(self, notes):
+		'''
+		Uploads notes to a free slot, or the slot of the song played longest ago, and returns the slot
+		'''
+		if len(self.slots) < SONG_SLOTS:
+			slot = len(self.slots)
+		else:
+			oldest = self.used.pop(0)
+			slot = self.slots.pop(oldest)
+		self.send(song(slot, notes))
+		self.slots[notes] = slot
+		return slot
+
+	def clear(self):
+		'''
+		Forgets every uploaded song, for when the iRobot has been reset
+		'''
+		self.slots.clear()
+		del self.used[:]
@@ -0,0 +1,122 @@
+'''
+Structured event log that never blocks the thread logging an event
+Events go into an in-memory ring buffer and a background thread writes them out as JSON lines
+Repeats of the same event are written once with a count, and each event name is rate limited
+'''
+import collections
+import json
+import sys
+import threading
+import time
+
+class EventLog(object):
+	'''
+	Ring buffer of events drained to a file by a background thread
+	Logging an event only appends to a deque, which is atomic, so no lock is taken
+	'''
+	def __init__(self, output=None, capacity=4096, rate=20, interval=0.1):
+		'''
+		Writes events to output, a path or file object, stdout by default
+		The buffer holds capacity events, and at most rate events of each name are kept per second
+		The drain thread writes every interval seconds
+		'''
+		self.path = output if isinstance(output, str) else None
+		self.output = output
+		self.capacity = capacity
+		self.rate = rate
+		self.interval = interval
+		self.buffer = collections.deque(maxlen=capacity) # (time, name, fields) of every event waiting to be written
+		self.windows = {} # Name -> [start of its current second, events logged in it]
+		self.suppressed = {} # Name -> events dropped by the rate limit since the last write
+		self.dropped = 0 # Events pushed out of the full buffer
+		self.thread = None
+		self.starting = threading.Lock() # Held while the drain thread is started
+		self.stopped = threading.Event()
+
+	def event(self, name, **fields):
+		'''
+		Logs an event called name with any fields, such as log.event('bump', left=True)
+		'''
+		now = time.time()
+		window = self.windows.get(name)
+		if window is None or now - window[0] >= 1.0:
+			window = self.windows[name] = [now, 0]
+		window[1] += 1
+		if window[1] > self.rate:
+			self.suppressed[name] = self.suppressed.get(name, 0) + 1
+			return
+		if len(self.buffer) == self.capacity:
+			self.dropped += 1
+		self.buffer.append((now, name, fields))
+		if self.thread is None:
+			self.start()
+
+	def start(self):
+		'''
+		Opens the output and starts the drain thread
+		'''
+		with self.starting:
+			if self.thread is not None:
+				return
+			if self.path is not None:
+				self.output = open(self.path, 'a')
+			elif self.output is None:
+				self.output = sys.stdout
+			self.thread = threading.Thread(target=self.drain)
+			self.thread.daemon = True
+			self.thread.start()
+
+	def drain(self):
+		'''
+		Writes the buffered events every interval seconds until the log is closed
+		'''
+		while not self.stopped.wait(self.interval):
+			self.write()
+		self.write()
+
+	def write(self):
+		'''
+		Writes every buffered event, collapsing repeats of the same event into one line with a repeated count
+		'''
+		lines = []
+		last = None
+		repeated = 0
+		while self.buffer:
+			timestamp, name, fields = self.buffer.popleft()
+			if last is not None and last[1] == name and last[2] == fields:
+				repeated += 1
+				continue
+			if last is not None:
+				lines.append(self.format(last, repeated))
+			last = (timestamp, name, fields)
+			repeated = 1
+		if last is not None:
+			lines.append(self.format(last, repeated))
+		for name in list(self.suppressed):
+			lines.append(self.format((time.time(), 'suppressed', {'event': name, 'count': self.suppressed.pop(name)}), 1))
+		if lines:
+			self.output.write(''.join(lines))
+			self.output.flush()
+
+	def format(self, event, repeated):
+		'''
+		Returns one event as a JSON line
+		'''
+		timestamp, name, fields = event
+		record = {'time': round(timestamp, 6), 'event': name}
+		record.update(fields)
+		if repeated > 1:
+			record['repeated'] = repeated
+		return json.dumps(record, sort_keys=True, default=str) + '\n'
+
+	def close(self):
+		'''
+		Writes every buffered event and stops the drain thread, closing the output if it was opened from a path
+		'''
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+		if self.path is not None and self.output is not None:
+			self.output.close()
+
+log = EventLog() # Shared log written to stdout
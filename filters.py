@@ -0,0 +1,168 @@
+'''
+Incremental filters for sensor channels
+Every filter takes one value per frame through update and returns the filtered value in amortized O(1) time with preallocated state
+'''
+import bisect
+import collections
+import operator
+
+class Debounce(object):
+	'''
+	Only changes its output once the input has held a new value for frames frames in a row
+	'''
+	def __init__(self, frames=2, initial=False):
+		'''
+		Creates a filter that needs frames frames to change from initial
+		'''
+		self.frames = frames
+		self.initial = initial
+		self.reset()
+
+	def update(self, value):
+		'''
+		Takes the next value and returns the debounced value
+		'''
+		if value == self.value:
+			self.count = 0
+		else:
+			if value == self.candidate and self.count:
+				self.count += 1
+			else:
+				self.candidate = value
+				self.count = 1
+			if self.count >= self.frames:
+				self.value = value
+				self.count = 0
+		return self.value
+
+	def reset(self):
+		'''
+		Returns to the initial value
+		'''
+		self.value = self.initial
+		self.candidate = self.initial
+		self.count = 0 # Frames the candidate has been held for
+
+class Hysteresis(object):
+	'''
+	Turns an analog value into a boolean that becomes True at high or above and only becomes False again at low or below
+	'''
+	def __init__(self, low, high, initial=False):
+		'''
+		Creates a filter that starts at initial
+		'''
+		self.low = low
+		self.high = high
+		self.initial = initial
+		self.reset()
+
+	def update(self, value):
+		'''
+		Takes the next value and returns the boolean
+		'''
+		if value >= self.high:
+			self.value = True
+		elif value <= self.low:
+			self.value = False
+		return self.value
+
+	def reset(self):
+		'''
+		Returns to the initial value
+		'''
+		self.value = self.initial
+
+class SlidingMax(object):
+	'''
+	Largest value of the last window frames, kept in a monotonic deque so every value is added and removed once
+	'''
+	keep = operator.gt # Values behind a new value are dropped unless they beat it
+
+	def __init__(self, window=4):
+		'''
+		Creates a filter over the last window frames
+		'''
+		self.window = window
+		self.reset()
+
+	def update(self, value):
+		'''
+		Takes the next value and returns the best value in the window
+		'''
+		queue = self.queue
+		while queue and not self.keep(queue[-1][1], value):
+			queue.pop()
+		queue.append((self.count, value))
+		if queue[0][0] <= self.count - self.window: # Left the window
+			queue.popleft()
+		self.count += 1
+		return queue[0][1]
+
+	def reset(self):
+		'''
+		Forgets every value
+		'''
+		self.queue = collections.deque(maxlen=self.window) # (frame, value) pairs, best first
+		self.count = 0 # Frames seen
+
+class SlidingMin(SlidingMax):
+	'''
+	Smallest value of the last window frames
+	'''
+	keep = operator.lt
+
+class Median(object):
+	'''
+	Median of the last window frames, for knocking out single frame spikes
+	Windows are a few frames, so keeping them sorted with bisect costs about the same as a constant
+	'''
+	def __init__(self, window=3):
+		'''
+		Creates a filter over the last window frames
+		'''
+		self.window = window
+		self.reset()
+
+	def update(self, value):
+		'''
+		Takes the next value and returns the median of the window
+		'''
+		position = self.count % self.window
+		if self.count >= self.window: # Replace the oldest value
+			del self.sorted[bisect.bisect_left(self.sorted, self.values[position])]
+		self.values[position] = value
+		bisect.insort(self.sorted, value)
+		self.count += 1
+		return self.sorted[len(self.sorted) // 2]
+
+	def reset(self):
+		'''
+		Forgets every value
+		'''
+		self.values = [0] * self.window # Ring of the last window values
+		self.sorted = [] # The same values in order
+		self.count = 0
+
+class EMA(object):
+	'''
+	Exponential moving average, alpha is the weight of each new value
+	'''
+	def __init__(self, alpha=0.5):
+		'''
+		Creates an average that starts with the first value
+		'''
+		self.alpha = alpha
+		self.reset()
+
+	def update(self, value):
+		'''
+		Takes the next value and returns the average
+		'''
+		self.value = value if self.value is None else self.value + self.alpha * (value - self.value)
+		return self.value
+
+	def reset(self):
+		'''
+		Forgets every value
+		'''
+		self.value = None
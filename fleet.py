@@ -0,0 +1,173 @@
+'''
+Runs many iRobots from one thread, multiplexing every serial port's reads and writes in a single selectors event loop
+Each iRobot keeps its own sensor state and command queue, but no reader or writer thread
+Needs Python 3
+'''
+import errno
+import os
+import selectors
+import threading
+from history import clock
+from interface import Connection, iRobot
+
+class FleetConnection(Connection):
+	'''
+	A Connection whose queued commands are written by a Fleet's event loop instead of a writer thread
+	'''
+	def __init__(self, fleet, port='/dev/ttyUSB0', transport=None, recorder=None, metrics=None):
+		'''
+		Opens port, or uses transport, which must have a fileno that can be selected
+		'''
+		Connection.__init__(self, port, transport, recorder, metrics, writer=False)
+		self.fleet = fleet
+		self.ready = 0.0 # Time the next command can be written
+
+	def send(self, data, delay=True, priority=None):
+		'''
+		Queues a command and wakes the event loop to write it
+		'''
+		Connection.send(self, data, delay, priority)
+		self.fleet.wake()
+
+	def write_ready(self, now):
+		'''
+		Writes the queued commands whose time has come, returns the seconds until the next one can be written or None if none are waiting
+		'''
+		while now >= self.ready:
+			command = self.queue.get(block=False)
+			if command is None:
+				return None
+			self.ready = now + self.write_command(command)
+		return self.ready - now if self.queue.unfinished else None
+
+	def close(self):
+		'''
+		Writes every queued command if the event loop is running, stops selecting the port, and closes it
+		'''
+		if self.fleet.running and threading.current_thread() is not self.fleet.thread:
+			self.flush(self.fleet.CLOSE_TIMEOUT)
+		self.fleet.detach(self)
+		Connection.close(self)
+
+class Fleet(object):
+	'''
+	Opens an iRobot on each of many serial ports and serves all of them from one event loop thread
+	'''
+	CLOSE_TIMEOUT = 1.0 # Most seconds close waits for an iRobot's queued commands to be written
+
+	def __init__(self, ports=()):
+		'''
+		Opens an iRobot on every port in ports, each named after its port
+		'''
+		self.selector = selectors.DefaultSelector()
+		self.robots = {} # Name -> iRobot
+		self.lock = threading.Lock() # Held while the event loop serves the iRobots, so they can be added and removed safely
+		self.waker, self.waking = os.pipe() # Written to wake the event loop when a command is queued
+		for fd in (self.waker, self.waking):
+			os.set_blocking(fd, False)
+		self.selector.register(self.waker, selectors.EVENT_READ)
+		self.running = False
+		self.thread = None
+		for port in ports:
+			self.add(port)
+
+	def add(self, port, name=None, transport=None, recorder=None):
+		'''
+		Opens an iRobot on port, or on transport, and returns it
+		The iRobot is named port unless a name is given
+		'''
+		robot = iRobot(FleetConnection(self, port, transport, recorder), reader=False)
+		with self.lock:
+			self.selector.register(robot.connection.connection.fileno(), selectors.EVENT_READ, robot)
+			self.robots[port if name is None else name] = robot
+		self.wake()
+		return robot
+
+	def detach(self, connection):
+		'''
+		Stops serving the iRobot on connection
+		'''
+		with self.lock:
+			for name, robot in list(self.robots.items()):
+				if robot.connection is connection:
+					self.selector.unregister(connection.connection.fileno())
+					del self.robots[name]
+
+	def remove(self, name):
+		'''
+		Closes and stops serving the iRobot called name
+		'''
+		self.robots[name].connection.close()
+
+	def __getitem__(self, name):
+		return self.robots[name]
+
+	def __iter__(self):
+		return iter(list(self.robots.values()))
+
+	def __len__(self):
+		return len(self.robots)
+
+	def wake(self):
+		'''
+		Makes the event loop check the command queues
+		'''
+		try:
+			os.write(self.waking, b'\0')
+		except OSError as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK): # Already woken
+				raise
+
+	def run(self):
+		'''
+		Reads and writes for every iRobot until stop is called
+		'''
+		self.running = True
+		timeout = None
+		while self.running:
+			events = self.selector.select(timeout)
+			with self.lock:
+				for key, mask in events:
+					if key.data is None: # Woken to write
+						try:
+							os.read(self.waker, 1024)
+						except OSError:
+							pass
+					elif key.fd in self.selector.get_map(): # Still being served
+						key.data.feed(key.data.connection.receive_available(), clock())
+				now = clock()
+				timeout = None
+				for robot in self.robots.values():
+					wait = robot.connection.write_ready(now)
+					if wait is not None and (timeout is None or wait < timeout):
+						timeout = wait
+
+	def start(self):
+		'''
+		Runs the event loop in a background thread
+		'''
+		self.running = True
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		'''
+		Stops the event loop
+		'''
+		self.running = False
+		self.wake()
+		if self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join()
+		self.thread = None
+
+	def close(self):
+		'''
+		Closes every iRobot's connection, then stops the event loop
+		'''
+		for robot in self:
+			robot.connection.close()
+		self.stop()
+		self.selector.close()
+		os.close(self.waker)
+		os.close(self.waking)
@@ -0,0 +1,122 @@
+'''
+Fixed capacity, timestamped history of every decoded sensor value
+'''
+import time
+from array import array
+
+clock = getattr(time, 'monotonic', time.time) # Never goes backwards where it is available
+
+class SensorHistory(object):
+	'''
+	Ring buffer with one preallocated column per field and a timestamp per frame
+	Windows are given in seconds or frames, and queries walk the columns in place without copying them
+	'''
+	def __init__(self, fields, capacity=1024):
+		'''
+		Takes a dictionary mapping each field (a packet id) to the index of its value in a decoded frame
+		'''
+		self.capacity = capacity
+		self.times = array('d', [0.0]) * capacity
+		self.columns = dict((field, array('d', [0.0]) * capacity) for field in fields)
+		self.slots = [(self.columns[field], index) for field, index in fields.items()]
+		self.count = 0 # Frames recorded since the history was created
+
+	def record(self, values, timestamp=None):
+		'''
+		Stores the values of one decoded frame, overwriting the oldest frame once the history is full
+		'''
+		position = self.count % self.capacity
+		self.times[position] = clock() if timestamp is None else timestamp
+		for column, index in self.slots:
+			column[position] = values[index]
+		self.count += 1
+
+	def clear(self):
+		'''
+		Forgets every recorded frame
+		'''
+		self.count = 0
+
+	def positions(self, seconds=None, frames=None):
+		'''
+		Yields the positions of the frames in a window, newest first
+		The window is the last frames frames, the last seconds seconds, or the whole history
+		'''
+		count = self.count
+		available = min(count, self.capacity)
+		if frames is not None:
+			available = min(available, frames)
+		if available <= 0:
+			return
+		newest = (count - 1) % self.capacity
+		start = self.times[newest] - seconds if seconds is not None else None
+		for i in range(available):
+			position = (newest - i) % self.capacity
+			if start is not None and self.times[position] < start:
+				return
+			yield position
+
+	def window(self, field, seconds=None, frames=None):
+		'''
+		Yields (timestamp, value) for every frame in the window, newest first
+		'''
+		column = self.columns[getattr(field, 'id', field)]
+		for position in self.positions(seconds, frames):
+			yield self.times[position], column[position]
+
+	def latest(self, field):
+		'''
+		Returns the newest value of field, or None if nothing has been recorded
+		'''
+		for timestamp, value in self.window(field, frames=1):
+			return value
+		return None
+
+	def max(self, field, seconds=None, frames=None):
+		'''
+		Returns the largest value of field in the window, or None if it is empty
+		'''
+		return self.reduce(max, self.columns[getattr(field, 'id', field)], seconds, frames)
+
+	def min(self, field, seconds=None, frames=None):
+		'''
+		Returns the smallest value of field in the window, or None if it is empty
+		'''
+		return self.reduce(min, self.columns[getattr(field, 'id', field)], seconds, frames)
+
+	def mean(self, field, seconds=None, frames=None):
+		'''
+		Returns the average value of field in the window, or None if it is empty
+		'''
+		total = 0.0
+		n = 0
+		column = self.columns[getattr(field, 'id', field)]
+		for position in self.positions(seconds, frames):
+			total += column[position]
+			n += 1
+		return total / n if n else None
+
+	def derivative(self, field, seconds=None, frames=None):
+		'''
+		Returns the change in field per second between the oldest and newest frames of the window, or 0 without two frames
+		'''
+		column = self.columns[getattr(field, 'id', field)]
+		newest = oldest = None
+		for position in self.positions(seconds, frames):
+			if newest is None:
+				newest = position
+			oldest = position
+		if newest is None or self.times[newest] == self.times[oldest]:
+			return 0.0
+		return (column[newest] - column[oldest]) / (self.times[newest] - self.times[oldest])
+
+	def reduce(self, function, column, seconds, frames):
+		'''
+		Applies max or min to the values of column in the window
+		'''
+		result = None
+		for position in self.positions(seconds, frames):
+			value = column[position]
+			if result is None or function(result, value) == value:
+				result = value
+		return result
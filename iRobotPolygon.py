@@ -3,16 +3,17 @@
 
 import serial
 import time
-import struct
 import sys
+import encoder
+import trajectory
+import path
+import interface
 
 #
 # ==== CONSTANTS ====
 #
 PAUSE = 0.5 # Constant for min time to pause command execution, to prevent two commands from sending at once
-WAIT = 10 # Constant time value (seconds) for iRobot to wait after initialization before executing movement
-TOTAL_TURN = 6.6 # Constant value as baseline for how long, in seconds, it takes iRobot to turn 2pi rad at 100mm/s
-TOTAL_FWD = 20.0 # Constant value as baseline for how long, in seconds, it takes iRobot to drive for 2m at 100mm/s
+PERIMETER = 2.0 # Total length of the polygon's sides, in m
 WHEEL_VEL = 100 # Constant speed for wheel velocity, in mm/s
 WHEEL_RAD_S = 0 # Constant value for moving in straight line, i.e no turning radius at all
 WHEEL_RAD_T = 1 # Constant value for turning at a radius of 1mm
@@ -30,17 +31,30 @@ WHEEL_RAD_T = 1 # Constant value for turning at a radius of 1mm
 #Connector Class
 # This controls basic requirements for connecting to the iRobot, specifically establishing the connection, sending commands and reading from the iRobot
 class PiConnector:
-  def __init__(self):
-    self.connection = serial.Serial(port='/dev/ttyUSB0', baudrate=115200)
+  def __init__(self, port='/dev/ttyUSB0', transport=None):
+    self.connection = serial.Serial(port=port, baudrate=115200) if transport is None else transport
       # Establish connection immediately upon being called
+      # transport replaces the serial port with anything that has read, write, and close, such as an emulator.OIEmulator
   
   def send(self, data):
     self.connection.write(data)
       # This takes an input string data, and sends it to the iRobot
   
-  def receive(self, n):
-    self.connection.read(n)
-      # This sends the command to read n number of bytes from iRobot
+  def receive(self, n, timeout=None):
+    # This reads and returns up to n bytes from iRobot, waiting at most timeout seconds for them if a timeout is given
+    if timeout is None:
+      return self.connection.read(n)
+    previous = self.connection.timeout
+    self.connection.timeout = timeout
+    try:
+      return self.connection.read(n)
+    finally:
+      self.connection.timeout = previous
+        # The port's own timeout is put back afterwards, like interface.Connection.receive_within
+
+  def drain(self):
+    self.connection.reset_input_buffer()
+      # Throws away any bytes left over from an earlier run
 
   def close(self):
     self.connection.close()
@@ -48,22 +62,42 @@ class PiConnector:
 
 class roombControl:
   # This class controls the managing of commands, and uses PiConnector to send and receive them from the iRobot
-  def __init__(self):
-    self.connection = PiConnector()
+  def __init__(self, connection=None):
+    self.connection = PiConnector() if connection is None else connection
   
   def setStart(self):
-    self.connection.send(chr(128))
+    self.connection.send(encoder.START)
       #Starts the Open Interface of iRobot, allowing other commands to be sent
   def setSafe(self):
-    self.connection.send(chr(131))
+    self.connection.send(encoder.SAFE)
       # Sets the iRobot to safe mode, where all features are allowed to be accessed and changed
+  def handshake(self, timeout=interface.iRobot.HANDSHAKE_TIMEOUT):
+    # Starts the Open Interface in safe mode and returns as soon as iRobot reports safe mode, instead of sleeping for a fixed time
+    self.connection.send(encoder.START)
+    self.connection.send(encoder.PAUSE_STREAM)
+    self.connection.send(encoder.SAFE)
+    self.connection.drain()
+      # A stream left running by an earlier run is paused and its stale bytes thrown away, so they aren't read as the answer
+    deadline = time.time() + timeout
+    reported = None
+    while time.time() < deadline:
+      self.connection.send(encoder.query(interface.iRobot.OI_MODE.id))
+      reply = bytearray(self.connection.receive(1, interface.iRobot.HANDSHAKE_POLL))
+        # Asks for the OI Mode sensor packet and waits a short while for its one byte
+      if reply:
+        reported = reply[-1]
+        if reported == interface.iRobot.SAFE_MODE:
+          return
+    raise interface.HandshakeError('iRobot reported mode ' + str(reported) + ' instead of safe mode after ' + str(timeout) + ' s')
+      # Fails fast with a clear error instead of driving an iRobot that never started
+
   def setStop(self):
-    self.connection.send(chr(173))
-    sleep(PAUSE)
+    self.connection.send(encoder.STOP)
+    time.sleep(PAUSE)
     self.connection.close()
       # Terminates the Open Interface, and closes connection to iRobot
   def reset(self):
-    self.connection.send(chr(7))
+    self.connection.send(encoder.RESET)
       # completely resets iRobot. Again, must be set to start again before commands can be sent
 
   def buttonState(self):
@@ -80,15 +114,47 @@ class roombControl:
 
   def drive(self, vel, rad, sec):
     # This command takes a given velocity(mm/s) and wheel radius, and sends the proper command to the iRobot to then drive at that velocity for a given amount of seconds.
-    data = struct.pack('>B2h', 137, vel, rad)
-    stopData = struct.pack('>B2h', 137, 0, rad)
+    data = encoder.drive(vel, rad)
+    stopData = encoder.drive(0, rad)
       # The command structure for the drive command uses the format [opcode][vel H-Byte][vel L-Byte][rad H-Byte][rad L-Byte].
-      # In order to avoid manually computing the 2's compliment hex value to turn an integer into two split hex values, pack with >B2h formatting is used to do it automatically
+      # In order to avoid manually computing the 2's compliment hex value to turn an integer into two split hex values, the encoder packs it with a precompiled >B2h struct
     self.connection.send(data)
     time.sleep(sec)
       # Used to allow iRobot to drive for sec seconds before stopping
     self.connection.send(stopData)
     time.sleep(PAUSE) # Ensure any command sent directly after moving goes through
+
+  def runPath(self, segments):
+    # This command compiles a list of trajectory segments into Open Interface scripts and runs them on the iRobot.
+    for body, sec in trajectory.compile_scripts(segments):
+      self.connection.send(trajectory.upload(body))
+      self.connection.send(trajectory.play())
+      time.sleep(sec)
+        # The iRobot stops each segment on its own distance and angle sensors, so the host only waits for the script to finish
+        # A path that doesn't fit in one script is split, and the next part is uploaded once the previous one should be done
+
+  def followPath(self, plan):
+    # This command drives a path.Plan, sending each of its drive direct commands when the one before it is done.
+    due = time.time()
+    for data, sec in plan.commands():
+      self.connection.send(data)
+      due += sec
+      time.sleep(max(due - time.time(), 0))
+        # Each command is timed from when the path started, so time spent sending doesn't add up over a long path
+
+def odometryPolygon(sides, port='/dev/ttyUSB0'):
+  # Traces the polygon with interface.iRobot, which streams the distance and angle packets and stops every side and turn on what iRobot measured.
+  robot = interface.iRobot(interface.Connection(port))
+  robot.track_pose()
+  robot.connect(interface.iRobot.SAFE_MODE)
+    # Waits for iRobot to report safe mode, then streams the sensors including distance (19) and angle (20)
+  for i in range(sides):
+    robot.drive_straight(PERIMETER / sides, WHEEL_VEL / 1000.0, robot.ODOMETRY)
+    robot.turn(360.0 / sides, WHEEL_VEL / 1000.0, robot.ODOMETRY)
+      # Each move slows down near its end and stops once iRobot has measured the distance or angle,
+      # so latency and wheel slip don't change the shape and no turning time has to be measured by hand
+  robot.stop()
+  robot.connection.close()
 #
 #
 # ==== CLASSES/INTERFACES ====
@@ -108,38 +174,37 @@ class roombControl:
   will proceed to trace a polygon of N sides on the floor. The polygon will
   have a total perimeter of 2 meters, and will be traced at a constant rate
   of 100 millimeters per second. By this, and by using math to determine the 
-  turning rate at 100mm/s, the constants TOTAL_TIME and TOTAL_FWD have been
-  established and will be used to determine the time needed for iRobot to
-  properly trace the polygon with desired specifications.
+  turning rate at 100mm/s, the time needed for iRobot to properly trace the
+  polygon with desired specifications is planned before it starts.
+  Run with a second argument of odometry (python iRobotPolygon.py N odometry)
+  to stop each side and turn on the distance and angle iRobot measures instead.
 '''
 
 '''
   According to the lab specifications, a button input is required to start/stop
   the motion of the iRobot. However, due to complications previously discussed
-  (line 72) this was not possible. Instead, the iRobot will simply wait about ten
-  seconds after initialization before starting to move, and cannot be stopped until
-  it naturally finishes its polygon.
+  (line 72) this was not possible. Instead, the iRobot will start moving as soon as
+  it reports that it is in safe mode, and cannot be stopped until it naturally
+  finishes its polygon.
 '''
 
 try:
-  N = sys.argv[1]
+  N = int(sys.argv[1])
 except:
   print("NO INPUT")
 
-turnTime = TOTAL_TURN / N # Each turn should take 6.6s/N at a velocity of 100mm/s
-driveTime = TOTAL_FWD / N # Each side of polygon should take 20.0s/N at a velocity of 100mm/s
-
-connect = roombControl()
-connect.setStart()
-time.sleep(PAUSE)
-connect.setSafe()
-time.sleep(WAIT) # WANT IROBOT TO SLEEP FOR 10 SECONDS BEFORE ACTUALLY STARTING TO MOVE
-  # This block establishes connection to iRobot and sets it to the proper state
-for i in range(N):
-  connect.drive(WHEEL_VEL, WHEEL_RAD_S, driveTime)
-  connect.drive(WHEEL_VEL, WHEEL_RAD_T, turnTime)
-    # The actual driving and making of the polygon. Simply drives and turns as necessary to complete polygon of N sides
-connect.setStop() # After finishing driving, stop the Open Interface and terminate the connection to iRobot
+if len(sys.argv) > 2 and sys.argv[2] == 'odometry':
+  odometryPolygon(N)
+    # Closed on odometry: sides and turns end on measured distance and angle instead of on the clock
+else:
+  connect = roombControl()
+  connect.handshake()
+    # This block establishes connection to iRobot and sets it to the proper state, moving on as soon as iRobot confirms it
+  connect.followPath(path.plan(path.polygon(N, PERIMETER * 1000), speed=WHEEL_VEL, final=0.0))
+    # The actual driving and making of the polygon. The corners are rounded into arcs so iRobot never stops between sides,
+    # and no wheel goes over 100mm/s. The plan's duration is known before it starts
+    # The last corner is turned in place at the end, so iRobot finishes facing the way it started
+  connect.setStop() # After finishing driving, stop the Open Interface and terminate the connection to iRobot
   #End of program.
 #
 #
@@ -3,86 +3,521 @@ import serial
 import threading
 import time
 import math
-from struct import pack, unpack
+import operator
+import encoder
+from struct import Struct
+from history import SensorHistory, clock
+from filters import Debounce, Median, SlidingMax
+from odometry import Odometry
+import eventlog
+import behavior
+from metrics import Metrics
+from recorder import TelemetryRecorder
+from scheduler import FrameScheduler, FRAME_PERIOD
+from safety import SafetyInterlock
+
+flagStop = True # Toggled when the clean button is released, stops the wall follower in __main__
+
+class CommandQueue(object):
+	'''
+	Priority queue of commands where a waiting drive command is replaced by the next one
+	'''
+	URGENT = 0 # Stops and mode changes
+	NORMAL = 1 # Driving and everything else
+	BULK = 2 # Songs
+	PRIORITIES = {7: URGENT, 128: URGENT, 131: URGENT, 132: URGENT, 173: URGENT, 140: BULK, 141: BULK}
+	MOTION = (137, 145) # Drive and drive direct, only the latest one matters
+
+	def __init__(self):
+		'''
+		Creates an empty queue
+		'''
+		self.queues = [collections.deque() for priority in (self.URGENT, self.NORMAL, self.BULK)]
+		self.motion = None # The motion command that is waiting, if any
+		self.unfinished = 0 # Commands that have been put but not marked done
+		self.closed = False
+		self.changed = threading.Condition()
+
+	@classmethod
+	def priority(cls, data):
+		'''
+		Finds the priority of a command from its opcode, drive commands with all zero velocities are stops
+		'''
+		opcode = ord(data[:1])
+		if opcode in cls.MOTION and not any(bytearray(data[1:5 if opcode == 145 else 3])):
+			return cls.URGENT
+		return cls.PRIORITIES.get(opcode, cls.NORMAL)
+
+	def put(self, data, delay=False, priority=None):
+		'''
+		Adds a command without blocking, replacing the motion command that is waiting if data is one
+		'''
+		priority = self.priority(data) if priority is None else priority
+		entry = [data, delay, priority, clock()]
+		with self.changed:
+			if ord(data[:1]) in self.MOTION:
+				if self.motion is not None and self.motion[2] == priority: # Replace it in place
+					self.motion[0], self.motion[1] = data, delay
+					return
+				if self.motion is not None: # Replace it with a command of another priority, which waits in its own queue
+					self.motion[0] = None
+					self.unfinished -= 1
+				self.motion = entry
+			self.queues[priority].append(entry)
+			self.unfinished += 1
+			self.changed.notify_all()
+
+	def get(self, block=True):
+		'''
+		Blocks until a command is waiting and returns its data, delay, priority, and the time it was queued, or None once the queue is closed and empty
+		If block is False it returns None straight away when nothing is waiting
+		'''
+		with self.changed:
+			while True:
+				for queue in self.queues:
+					while queue:
+						entry = queue.popleft()
+						if entry[0] is None: # Replaced by a more urgent command
+							continue
+						if entry is self.motion:
+							self.motion = None
+						return tuple(entry)
+				if self.closed or not block:
+					return None
+				self.changed.wait()
+
+	def done(self):
+		'''
+		Marks the last command returned by get as written
+		'''
+		with self.changed:
+			self.unfinished -= 1
+			self.changed.notify_all()
+
+	def join(self, timeout=None):
+		'''
+		Blocks until every command has been written, returns False if timeout seconds pass first
+		'''
+		deadline = None if timeout is None else time.time() + timeout
+		with self.changed:
+			while self.unfinished:
+				remaining = None if deadline is None else deadline - time.time()
+				if remaining is not None and remaining <= 0:
+					return False
+				self.changed.wait(remaining)
+			return True
+
+	def close(self):
+		'''
+		Lets get return None once every waiting command has been returned
+		'''
+		with self.changed:
+			self.closed = True
+			self.changed.notify_all()
+
+class HandshakeError(IOError):
+	'''
+	Raised when the iRobot doesn't report the requested mode in time
+	'''
 
 class Connection(object):
 	'''
 	Wrapper class for serial connection
 	'''
 	DELAY = 0.015
-	def __init__(self):
+	BAUDRATE = 115200
+	BYTE_TIME = 10.0 / BAUDRATE # Seconds to send one byte with a start and stop bit
+	def __init__(self, port='/dev/ttyUSB0', transport=None, recorder=None, metrics=None, writer=True):
 		'''
 		Establish connection immdeiately upon being called
+		transport replaces the serial port with anything that has read, write, in_waiting, and close, such as an emulator.OIEmulator
+		recorder, such as a recorder.TelemetryRecorder, is given every received chunk and sent command
+		metrics is the metrics.Metrics that times the send queue and reactions, a new one by default
+		writer starts a thread that writes the queued commands, without one they are written by calling write_command, as a fleet.Fleet does
+		'''
+		self.recorder = recorder
+		self.metrics = Metrics() if metrics is None else metrics
+		self.connection = serial.Serial(port=port, baudrate=self.BAUDRATE) if transport is None else transport
+		self.queue = CommandQueue() # Commands waiting to be written
+		self.last_motion = None # Last drive command written, repeats of it are skipped
+		self.writing = threading.Lock() # Held while bytes are written, so a stop written by halt never splits a command
+		self.halted = False # Set by halt, motion commands other than stops are dropped until release
+		self.writer = None
+		if writer:
+			self.writer = threading.Thread(target=self.write_commands) # Create a thread to write commands
+			self.writer.daemon = True
+			self.writer.start()
+
+	def send(self, data, delay=True, priority=None):
 		'''
-		self.connection = serial.Serial(port='/dev/ttyUSB0', baudrate=115200)
-		self.lock = threading.Lock()
-		time.sleep(self.DELAY)
-  
-	def send(self, data, delay=True):
+		This takes an input string data and queues it to be sent to the iRobot without blocking
+		Stops and mode changes are sent first, and a drive command that is still waiting is replaced by a newer one
+		If delay is True the iRobot is given DELAY seconds before the next command
+		'''
+		self.queue.put(data, delay, priority)
+
+	def write_commands(self):
+		'''
+		Writes queued commands, most urgent first, waiting as long as the bytes take to send before the next one
+		'''
+		while True:
+			command = self.queue.get()
+			if command is None:
+				return
+			time.sleep(self.write_command(command))
+
+	def write_command(self, command):
 		'''
-		This takes an input string data, and sends it to the iRobot
+		Writes one command returned by the queue and returns the seconds to wait before writing the next one
 		'''
-		self.lock.acquire()
+		data, delay, priority, queued = command
 		try:
-			self.connection.write(data)
+			self.metrics.queue_wait.record(clock() - queued)
+			with self.writing:
+				if ord(data[:1]) in CommandQueue.MOTION:
+					if self.halted and CommandQueue.priority(data) != CommandQueue.URGENT: # Held back until the fault is acknowledged
+						self.metrics.count('blocked')
+						return 0.0
+					if data == self.last_motion: # The iRobot is already doing this
+						if priority == CommandQueue.URGENT:
+							self.metrics.actuated()
+						return 0.0
+					self.last_motion = data
+				else:
+					self.last_motion = None # Mode changes stop the wheels
+				self.connection.write(data)
+			self.metrics.count('commands')
+			if priority == CommandQueue.URGENT: # Answers the events waiting for a reaction
+				self.metrics.actuated()
+			if self.recorder is not None:
+				self.recorder.sent(data)
+			return len(data) * self.BYTE_TIME + (self.DELAY if delay else 0)
 		finally:
-			if delay:
-				time.sleep(self.DELAY)
-			self.lock.release()
+			self.queue.done()
+
+	def halt(self, data):
+		'''
+		Writes the stop command data straight away from the calling thread, ahead of every queued command, then drops every motion command except stops until release
+		'''
+		with self.writing:
+			self.halted = True
+			self.connection.write(data)
+			self.last_motion = data
+		self.metrics.count('commands')
+		self.metrics.actuated()
+		if self.recorder is not None:
+			self.recorder.sent(data)
+
+	def release(self):
+		'''
+		Lets motion commands through again after halt
+		'''
+		self.halted = False
+
+	def flush(self, timeout=None):
+		'''
+		Blocks until every queued command has been written, returns False if timeout seconds pass first
+		'''
+		return self.queue.join(timeout)
   
 	def receive(self, n):
 		'''
 		This sends the command to read n number of bytes from iRobot
 		'''
-		return self.connection.read(n)
+		data = self.connection.read(n)
+		if self.recorder is not None:
+			self.recorder.received(data)
+		return data
+
+	def receive_available(self):
+		'''
+		Reads every byte that has already arrived, blocking only until at least one is available
+		'''
+		return self.receive(max(1, self.connection.in_waiting))
+
+	def receive_within(self, n, timeout):
+		'''
+		Reads up to n bytes, waiting at most timeout seconds for them
+		'''
+		previous = self.connection.timeout
+		self.connection.timeout = timeout
+		try:
+			return self.receive(n)
+		finally:
+			self.connection.timeout = previous
+
+	def drain(self):
+		'''
+		Throws away every byte that has arrived but hasn't been read
+		'''
+		self.connection.reset_input_buffer()
 
 	def close(self):
 		'''
-		Closes connection to iRobot
+		Writes every queued command and closes connection to iRobot
 		'''
+		self.queue.close()
+		if self.writer is not None and self.writer is not threading.current_thread():
+			self.writer.join()
 		self.connection.close()
+		if self.recorder is not None:
+			self.recorder.close()
 
 class Packet(object):
 	'''
 	A class that helps organize packets
 	'''
-	def __init__(self, _id, _bytes, _unpack):
+	def __init__(self, _id, _bytes, _unpack, _members=()):
 		self.id = _id
 		self.bytes = _bytes
 		self.unpack = _unpack
+		self.members = _members # Ids of the packets in a group packet, in order
+
+class Button(collections.namedtuple('Button', 'pressed released')):
+	'''
+	A button in one frame: whether it is being pressed, and whether it has just been released
+	Buttons can't be changed, the decoder replaces one with the next from update_button
+	'''
+	__slots__ = ()
+
+	def update_button(self, new_state):
+		'''
+		Takes a new state and returns the next button, which knows if it is being pressed or has just been released
+		'''
+		return BUTTON_STATES[new_state, self.pressed and not new_state]
 
-class Button(object):
+BUTTON_STATES = dict(((pressed, released), Button(pressed, released)) for pressed in (False, True) for released in (False, True)) # Every button there can be, so none is made per frame
+
+class Character(collections.namedtuple('Character', 'curr')):
 	'''
-	A class to make better button responses
+	The infrared character held by an IR_CHAR in one frame
+	'''
+	__slots__ = ()
+
+CHARACTERS = tuple(Character(value) for value in range(256)) # Every character there can be
+
+class IR_CHAR(object):
+	'''
+	Holds an infrared character for 4 frames, since the dock's beams flicker
 	'''
 	def __init__(self):
+		self.hist = SlidingMax(4) # Holds a character for 4 frames
+		self.curr = 0
+	def update(self, new_state):
 		'''
-		Creates a button
+		Takes the character of the next frame and returns the held Character
 		'''
-		self.pressed = False
-		self.released = False
+		self.curr = self.hist.update(new_state)
+		return CHARACTERS[self.curr]
 
-	def update_button(self, new_state):
+class SensorState(object):
+	'''
+	Every sensor value of one frame, in slots so that copying one is small and quick
+	The decoder writes each frame into a working state and publishes it as a Snapshot, so readers always see one whole frame
+	'''
+	__slots__ = (
+		'LWD', 'RWD', 'LB', 'RB', 'cliff_left', 'cliff_front_left', 'cliff_front_right', 'cliff_right', 'virtual_wall',
+		'clock', 'schedule', 'day', 'hour', 'minute', 'dock', 'spot', 'clean',
+		'distance', 'angle', 'charging', 'mode',
+		'IR_BR', 'IR_BFR', 'IR_BCR', 'IR_BCL', 'IR_BFL', 'IR_BL', 'LT_BR', 'LT_BFR', 'LT_BCR', 'LT_BCL', 'LT_BFL', 'LT_BL',
+		'IR_LEFT_CHAR', 'IR_RIGHT_CHAR', 'IR_OMNI_CHAR', 'x', 'y', 'heading', 'speed', 'rate', 'frame',
+	)
+
+	def __init__(self):
 		'''
-		Takes a new state and finds if the button is being pressed or has been released
+		Creates the state before any frame has arrived
 		'''
-		self.released = True if self.pressed == True and new_state == False else False
-		self.pressed = new_state
+		self.LWD = False # Left wheel drop
+		self.RWD = False # Right wheel drop
+		self.LB = False # Left bumper
+		self.RB = False # Right bumper
+		self.cliff_left = False
+		self.cliff_front_left = False
+		self.cliff_front_right = False
+		self.cliff_right = False
+		self.virtual_wall = False
+		self.clock = self.schedule = self.day = self.hour = self.minute = self.dock = self.spot = self.clean = BUTTON_STATES[False, False]
+		self.distance = 0
+		self.angle = 0
+		self.charging = 0
+		self.mode = 0 # Only updated if OI_MODE is streamed
+		self.IR_BR = 0 # Infrared right sensor
+		self.IR_BFR = 0 # Infrared front right sensor
+		self.IR_BCR = 0 # Infrared center right sensor
+		self.IR_BCL = 0 # Infrared center left sensor
+		self.IR_BFL = 0 # Infrared front left sensor
+		self.IR_BL = 0 # Infrared left sensor
+		self.LT_BR = False # Light bump right
+		self.LT_BFR = False # Light bump front right
+		self.LT_BCR = False # Light bump center right
+		self.LT_BCL = False # Light bump center left
+		self.LT_BFL = False # Light bump front left
+		self.LT_BL = False # Light bump left
+		self.IR_LEFT_CHAR = CHARACTERS[0] # Infrared's left character
+		self.IR_RIGHT_CHAR = CHARACTERS[0] # Infrared's right character
+		self.IR_OMNI_CHAR = CHARACTERS[0] # Infrared's omni character
+		self.x = 0.0 # Odometry position in mm, only updated if DISTANCE and ANGLE are streamed
+		self.y = 0.0
+		self.heading = 0.0 # Odometry heading in degrees counter clockwise
+		self.speed = 0.0 # Odometry speed in mm/s and turn rate in degrees/s over the last few frames
+		self.rate = 0.0
+		self.frame = 0 # Number of the frame, 0 before the first one
+
+	def snapshot(self):
+		'''
+		Returns a read only copy
+		'''
+		return tuple.__new__(Snapshot, SENSOR_VALUES(self))
+
+SENSOR_VALUES = operator.attrgetter(*SensorState.__slots__) # Reads every value of a state in one call
+
+class Snapshot(collections.namedtuple('Snapshot', SensorState.__slots__)):
+	'''
+	A published frame, a tuple with the same attributes as a SensorState so it can't be changed once readers can see it
+	'''
+	__slots__ = ()
+
+	def safe_to_drive(self):
+		'''
+		Returns a boolean that represents whether or not the iRobot is safe to drive
+		'''
+		return not (self.LWD or self.RWD or self.LB or self.RB or self.cliff_front_left or self.cliff_front_right or self.cliff_left or self.cliff_right)
+
+	def safe_to_turn(self):
+		'''
+		Returns a boolean that represents whether or not the iRobot is safe to rotate
+		'''
+		return not (self.LWD or self.RWD)
+
+	def button_pressed(self):
+		'''
+		Returns a boolean that represents whether or not the iRobot has had a button pressed
+		'''
+		return self.clean.pressed or self.dock.pressed or self.spot.pressed or self.schedule.pressed or self.clock.pressed or self.day.pressed or self.hour.pressed or self.minute.pressed
+
+class FrameSync(object):
+	'''
+	Incrementally finds sensor stream frames in the bytes read from the iRobot
+	'''
+	HEADER = 19
+	def __init__(self, length, capacity=1024):
+		'''
+		Creates a synchronizer for frames with a payload of length bytes
+		'''
+		self.length = length # Payload length without header, n-bytes, and checksum
+		self.size = length + 3 # Full frame length
+		self.header = bytearray([self.HEADER, length])
+		self.buffer = bytearray(capacity)
+		self.view = memoryview(self.buffer)
+		self.start = 0 # First byte that hasn't been consumed
+		self.end = 0 # One past the last byte received
+		self.frames = 0 # Number of valid frames found
+		self.corrupt = 0 # Number of frames rejected by their checksum
+		self.skipped = 0 # Number of bytes thrown away while searching for a header
+
+	def feed(self, data):
+		'''
+		Takes newly received bytes and yields the payload of every complete frame with a valid checksum
+		Payloads are memoryviews into the buffer and are only valid until the next call to feed
+		'''
+		self.append(data)
+		buf = self.buffer
+		while True:
+			index = buf.find(self.header, self.start, self.end)
+			if index < 0: # No header, keep the last byte in case it starts one
+				last = max(self.start, self.end - 1)
+				self.skipped += last - self.start
+				self.start = last
+				return
+			self.skipped += index - self.start
+			self.start = index
+			if self.end - index < self.size: # Wait for the rest of the frame
+				return
+			if sum(buf[index:index + self.size]) & 0xFF: # Bad checksum, resync on the next header
+				self.corrupt += 1
+				self.start = index + 1
+				continue
+			self.frames += 1
+			self.start = index + self.size
+			yield self.view[index + 2:index + self.size - 1]
+
+	def append(self, data):
+		'''
+		Copies data to the end of the buffer, moving unconsumed bytes to the front when needed
+		'''
+		n = len(data)
+		capacity = len(self.buffer)
+		if self.end + n > capacity:
+			pending = self.end - self.start
+			if pending + n > capacity: # Too far behind, drop the oldest bytes
+				drop = min(pending, pending + n - capacity)
+				self.skipped += drop
+				self.start += drop
+				pending -= drop
+				if n > capacity:
+					self.skipped += n - capacity
+					data = data[n - capacity:]
+					n = capacity
+			self.buffer[:pending] = self.buffer[self.start:self.end]
+			self.start = 0
+			self.end = pending
+		self.buffer[self.end:self.end + n] = data
+		self.end += n
 
 	def reset(self):
 		'''
-		Resets the button
+		Throws away every buffered byte
 		'''
-		self.pressed = False
-		self.released = False
+		self.start = 0
+		self.end = 0
 
-class IR_CHAR(object):
-	def __init__(self):
-		self.hist = collections.deque([0]*4, 4)
-		self.curr = max(self.hist)
-	def update(self, new_state):
-		self.hist.appendleft(new_state)
-		self.curr = max(self.hist)
+class SensorDecoder(object):
+	'''
+	Compiles a list of packets into a single struct and an id-indexed table of field decoders
+	'''
+	def __init__(self, packets, decoders):
+		'''
+		Takes the packets in stream order and a dictionary mapping each packet id to the function that decodes its value
+		'''
+		self.packets = list(packets)
+		if not self.packets:
+			raise ValueError('At least one packet must be streamed, pause_stream stops the stream')
+		self.format = Struct('>' + ''.join(packet.unpack for packet in self.packets)) # One struct for the whole payload
+		self.length = self.format.size # Payload length without header, n-bytes, and checksum
+		self.fields = [] # (index of the value in the unpacked payload, decoder) for every single value packet
+		self.groups = [] # (first index, end index, decoder) for every group packet
+		self.indices = {} # Packet id, or id of a packet in a group, -> index of its value in the unpacked payload
+		expected = [] # Unpacked payload with only the packet ids filled in
+		positions = [] # Index of every packet id in the unpacked payload
+		for packet in self.packets:
+			if packet.id not in decoders:
+				raise ValueError('No decoder for packet ' + str(packet.id))
+			positions.append(len(expected))
+			expected += Struct('>' + packet.unpack).unpack(bytearray(packet.bytes + 1))
+			expected[positions[-1]] = packet.id
+			if packet.members:
+				self.groups.append((positions[-1] + 1, len(expected), decoders[packet.id]))
+				for offset, member in enumerate(packet.members):
+					self.indices[member] = positions[-1] + 1 + offset
+			else:
+				self.fields.append((positions[-1] + 1, decoders[packet.id]))
+				self.indices[packet.id] = positions[-1] + 1
+		self.get_ids = operator.itemgetter(*positions)
+		self.ids = self.get_ids(expected)
+
+	def decode(self, frame):
+		'''
+		Unpacks a frame's payload in one pass, hands every value to its decoder, and returns the unpacked values
+		Returns None without decoding anything if the packet ids don't match
+		'''
+		values = self.format.unpack(frame)
+		if self.get_ids(values) != self.ids:
+			return None
+		for index, decoder in self.fields:
+			decoder(values[index])
+		for start, end, decoder in self.groups: # Group decoders get a tuple of their values
+			decoder(values[start:end])
+		return values
 
 class iRobot(object):
 	'''
@@ -92,15 +527,16 @@ class iRobot(object):
 	################################################## Const Variables ##################################################
 
 	# Op Codes
-	RESET = chr(7)
-	START = chr(128)
-	SAFE = chr(131)
-	FULL = chr(132)
-	STOP = chr(173)
-	DRIVE = 137
-	DRIVE_DIRECT = 145
-	READ_SENSORS = 148
-	SEEK_DOCK = 143
+	RESET = encoder.RESET
+	START = encoder.START
+	SAFE = encoder.SAFE
+	FULL = encoder.FULL
+	STOP = encoder.STOP
+	DRIVE = encoder.DRIVE
+	DRIVE_DIRECT = encoder.DRIVE_DIRECT
+	READ_SENSORS = encoder.READ_SENSORS
+	PAUSE_RESUME = encoder.PAUSE_RESUME
+	SEEK_DOCK = encoder.SEEK_DOCK_OPCODE
   
 	# Packets
 	WHEEL_DROP_AND_BUMPERS = Packet(7, 1, 'BB')
@@ -113,28 +549,71 @@ class iRobot(object):
 	DISTANCE = Packet(19, 2, 'Bh')
 	ANGLE = Packet(20, 2, 'Bh')
 	LIGHT_BUMPERS = Packet(45, 1, 'BB')
+	LIGHT_BUMP_LEFT = Packet(46, 2, 'BH')
+	LIGHT_BUMP_FRONT_LEFT = Packet(47, 2, 'BH')
+	LIGHT_BUMP_CENTER_LEFT = Packet(48, 2, 'BH')
+	LIGHT_BUMP_CENTER_RIGHT = Packet(49, 2, 'BH')
+	LIGHT_BUMP_FRONT_RIGHT = Packet(50, 2, 'BH')
 	LIGHT_BUMP_RIGHT = Packet(51, 2, 'BH')
+	LIGHT_BUMPS = Packet(106, 12, 'B6H', (46, 47, 48, 49, 50, 51)) # Group of all six light bumps
 	IR_LEFT = Packet(52, 1, 'BB')
 	IR_RIGHT = Packet(53, 1, 'BB')
 	IR_OMNI = Packet(17, 1, 'BB')
 	CHARGING = Packet(21, 1, 'BB')
-	PACKETS = [IR_LEFT, IR_RIGHT, IR_OMNI, BUTTONS, LIGHT_BUMP_RIGHT, WHEEL_DROP_AND_BUMPERS, LIGHT_BUMPERS, CHARGING]
-
-	SENSOR_READ_FORMAT = '>BB'
-	for index in range(len(PACKETS)):
-		SENSOR_READ_FORMAT += PACKETS[index].unpack
-	SENSOR_READ_FORMAT += 'B'
+	OI_MODE = Packet(35, 1, 'BB')
+	PACKETS = [IR_LEFT, IR_RIGHT, IR_OMNI, BUTTONS, LIGHT_BUMP_RIGHT, WHEEL_DROP_AND_BUMPERS, LIGHT_BUMPERS, CHARGING] # Streamed by default
 
 	# Variables
 	SENSOR_DELAY = 0.020 # s
-	MAX_SPEED = 0.5 # m/s
-	DIAMETER = 0.235 # m
+	DECELERATION = 0.5 # m/s^2 the speed ramps down at near the target of a move on odometry
+	MIN_SPEED = 0.02 # m/s the ramp stops at, slower and the wheels can stall short of the target
+	STOP_LATENCY = 2 * FRAME_PERIOD # Seconds from a frame to a stop sent for it taking effect, the iRobot keeps moving meanwhile
+	MOTION_TIMEOUT = 1.0 # Seconds a move on odometry may run over twice its expected time before it gives up
+	HANDSHAKE_TIMEOUT = 2.0 # Most seconds connect waits for the requested mode
+	HANDSHAKE_POLL = 0.05 # Seconds between queries of the mode
+	HANDSHAKE_QUIET = 2 * FRAME_PERIOD # Seconds without a byte after the stream is paused before replies are read, so a late frame byte isn't taken for the mode
+	HISTORY_FRAMES = 1024 # About 15 seconds of sensor history
+	MAX_SPEED = encoder.MAX_SPEED / 1000.0 # m/s
+	DIAMETER = encoder.WHEEL_BASE / 1000.0 # m
 	RADIUS = DIAMETER / 2.0 # m
 	STRAIGHT = 32767
 	CCW = 1
 	CW = -1
 	BUTTON_INTERRUPT = NameError('Button Pressed')
 
+	# Bases a move is stopped on
+	ODOMETRY = 'odometry' # Measured distance and angle, needs DISTANCE and ANGLE streamed
+	TIME = 'time' # Seconds worked out from the speed
+
+	# Reasons for waking up from wait_until
+	DONE = 'done'
+	TIMEOUT = 'timeout'
+	BUMP = 'bump'
+	CLIFF = 'cliff'
+	WHEEL_DROP = 'wheel drop'
+	BUTTON = 'button'
+	INTERRUPTS = {
+		BUMP: lambda robot: robot.LB or robot.RB,
+		CLIFF: lambda robot: robot.cliff_left or robot.cliff_front_left or robot.cliff_front_right or robot.cliff_right,
+		WHEEL_DROP: lambda robot: robot.LWD or robot.RWD,
+		BUTTON: lambda robot: robot.clean.pressed,
+	}
+	REACTIONS = { # Events whose reaction latency is measured, from the frame that shows them to the next stop
+		BUMP: INTERRUPTS[BUMP],
+		CLIFF: INTERRUPTS[CLIFF],
+		BUTTON: lambda robot: robot.clean.released,
+	}
+
+	# Modes reported by packet 35
+	OFF_MODE = 0
+	PASSIVE_MODE = 1
+	SAFE_MODE = 2
+	FULL_MODE = 3
+	MODE_COMMANDS = {PASSIVE_MODE: b'', SAFE_MODE: encoder.SAFE, FULL_MODE: encoder.FULL}
+
+	# Songs, (note, duration in 1/64 s) pairs
+	CHARGING_SONG = ((59, 16), (55, 16), (60, 16), (55, 16), (62, 16), (55, 16), (63, 16), (55, 16), (62, 16), (55, 16), (60, 16), (55, 16), (40, 8), (41, 8), (42, 8), (43, 16))
+
 	# Infrared Characters
 	RED_BUOY = 168
 	GREEN_BUOY = 164
@@ -144,54 +623,88 @@ class iRobot(object):
 	R_N_FF = 169
 	R_N_G_N_FF = 173
 
-	def __init__(self):
+	def __init__(self, connection=None, reader=True):
 		'''
 		Establishes connection to the iRobot and creates a thread for data reading
-		'''
-		self.connection = Connection() # Establish connection
-		self.data_thread = threading.Thread(target=self.read_data) # Create a thread to read data
-		self.data_thread.daemon = True
+		Without a reader thread the received bytes must be given to feed, as a fleet.Fleet does
+		'''
+		self.connection = Connection() if connection is None else connection # Establish connection
+		self.data_thread = None
+		if reader:
+			self.data_thread = threading.Thread(target=self.read_data) # Create a thread to read data
+			self.data_thread.daemon = True
+		self.frame_ready = threading.Condition() # Notified every time a frame has been decoded
+		self.frame_count = 0 # Number of frames decoded
+		self.metrics = self.connection.metrics # Counters and latency histograms
+		self.reacting = set() # Events that have happened and haven't ended yet
+		self.stream_starts = 0 # Times the stream has been started or resumed, the gap before a restart isn't a drop
+		self.counted_starts = 0 # Value of stream_starts when the last frame arrived
+		self.last_arrived = None # Time the last chunk with a frame arrived
 
-		self.LWD = False # Left wheel drop
-		self.RWD = False # Right wheel drop
-		self.LB = False # Left bumper
-		self.RB = False # Right bumper
-		self.cliff_left = False
-		self.cliff_front_left = False
-		self.cliff_front_right = False
-		self.cliff_right = False
-		self.virtual_wall = False
-		self.clock = Button()
-		self.schedule = Button()
-		self.day = Button()
-		self.hour = Button()
-		self.minute = Button()
-		self.dock = Button()
-		self.spot = Button()
-		self.clean = Button()
-		self.distance = 0
-		self.angle = 0
-		self.charging = 0
-		self.IR_BR = 0 # Infrared right sensor
-		self.IR_BL = 0 # Infrared left sensor
-		self.LT_BR = False # Light bump right
-		self.LT_BFR = False # Light bump front right
-		self.LT_BCR = False # Light bump center right
-		self.LT_BCL = False # Light bump center left
-		self.LT_BFL = False # Light bump front left
-		self.LT_BL = False # Light bump left
-		self.IR_LEFT_CHAR = IR_CHAR() # Infrared's left character
-		self.IR_RIGHT_CHAR = IR_CHAR() # Infrared's right character
-		self.IR_OMNI_CHAR = IR_CHAR() # Infrared's omni character
+		self.working = SensorState() # Only written by the thread decoding frames
+		self.state = self.working.snapshot() # The last whole frame, replaced by one assignment so a reader never sees parts of two frames
+		self.characters = dict((name, IR_CHAR()) for name in ('IR_LEFT_CHAR', 'IR_RIGHT_CHAR', 'IR_OMNI_CHAR')) # Holds the infrared characters between frames
+		self.odometry = Odometry() # Integrates DISTANCE and ANGLE into the pose
+		self.songs = encoder.SongRegistry(self.connection.send) # Songs that have been uploaded to a slot
+		self.log = eventlog.log # Structured event log that doesn't block, shared by every iRobot unless replaced
+		self.filters = {} # Attribute -> filter applied to it after every frame is decoded
+		self.raw = {} # Attribute -> its last value before filtering
+		self.interlock = None # safety.SafetyInterlock checked on every frame, see set_interlock
+		self.requested_mode = None # Mode connect asked for, which the interlock restores after a fault
+
+		self.packets = list(self.PACKETS) # Packets being streamed
+		self.decoding = threading.Lock() # Held while a frame is decoded so the packets can be changed safely
+		self.decoder = SensorDecoder(self.packets, self.decoders()) # Decodes a whole frame in one pass
+		self.sync = FrameSync(self.decoder.length) # Finds frames in the sensor stream
+		self.history = SensorHistory(self.decoder.indices, self.HISTORY_FRAMES) # Recent values of every packet
 
 	################################################## OI Mode and Starting ##################################################
 
 	def start(self):
 		'''
-		Starts the iRobot and starts the data reading thread
+		Starts the iRobot, asks it to stream its sensors, and starts the data reading thread
+		'''
+		self.connection.send(self.START) # Send start command
+		self.stream_packets() # Send sensor command
+		self.start_reader()
+		self.start_time = time.time()
+
+	def connect(self, mode=SAFE_MODE, timeout=HANDSHAKE_TIMEOUT):
+		'''
+		Starts the iRobot in mode (PASSIVE_MODE, SAFE_MODE, or FULL_MODE) and returns as soon as it reports that mode, then starts the stream and the data reading thread
+		A stream left running by an earlier run is paused and stale bytes are thrown away, and HandshakeError is raised if the mode isn't reported within timeout seconds
+		The replies are read directly, so it can't be used while a fleet.Fleet is serving the iRobot
 		'''
+		deadline = time.time() + timeout
+		self.requested_mode = mode
 		self.connection.send(self.START) # Send start command
-		self.data_thread.start() # Start data thread
+		self.connection.send(encoder.PAUSE_STREAM)
+		if self.MODE_COMMANDS[mode]:
+			self.connection.send(self.MODE_COMMANDS[mode])
+		self.connection.flush(deadline - time.time())
+		while time.time() < deadline and self.connection.receive_within(64, self.HANDSHAKE_QUIET): # Frames sent before the pause
+			pass
+		reported = None
+		while True:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				self.log.event('handshake failed', mode=mode, reported=reported)
+				if reported is None:
+					raise HandshakeError('iRobot did not answer a query for its mode within ' + str(timeout) + ' s')
+				raise HandshakeError('iRobot reported mode ' + str(reported) + ' instead of ' + str(mode) + ' after ' + str(timeout) + ' s')
+			self.connection.drain() # Replies to earlier queries that came late
+			self.connection.send(encoder.query(self.OI_MODE.id))
+			self.connection.flush(remaining)
+			reply = self.connection.receive_within(1, min(self.HANDSHAKE_POLL, max(remaining, 0.001)))
+			if reply:
+				reported = bytearray(reply)[-1]
+				if reported == mode:
+					break
+		self.working.mode = reported
+		self.state = self.working.snapshot()
+		self.log.event('handshake', mode=mode, seconds=round(timeout - deadline + time.time(), 3))
+		self.stream_packets() # Send sensor command
+		self.start_reader()
 		self.start_time = time.time()
 
 	def reset(self):
@@ -199,6 +712,7 @@ class iRobot(object):
 		Resets the iRobot
 		'''
 		self.connection.send(self.RESET) # Send reset command
+		self.songs.clear() # Resetting forgets the songs
 
 	def stop(self):
 		'''
@@ -220,164 +734,406 @@ class iRobot(object):
 
 	################################################## Sensor Reading ##################################################
 
+	def start_reader(self):
+		'''
+		Starts reading the sensor stream, in the data reading thread if there is one, unless it is already being read
+		'''
+		if self.data_thread is not None and not self.data_thread.is_alive():
+			self.data_thread.start() # Start data thread
+
 	def read_data(self):
 		'''
 		Constantly updates the information from the sensors
 		'''
-		num_of_packets = len(self.PACKETS) # Define wanted number of packets
-		num_of_bytes = num_of_packets # Define expected number of bytes without Header, n-bytes, and checksum
-		for i in range(len(self.PACKETS)):
-			num_of_bytes += self.PACKETS[i].bytes
-		com = chr(self.READ_SENSORS) + chr(num_of_packets) # Create command
-		for i in range(len(self.PACKETS)):
-			com += chr(self.PACKETS[i].id)
-		self.connection.send(com) # Send sensor command
 		while True: # Read data while running
-			raw_data = self.connection.receive(num_of_bytes + 3)
-			raw_data = iRobot.unwrap(raw_data, chr(19), chr(num_of_bytes)) # Grab raw data and 'unwrap'
-			if len(raw_data) < (2 * num_of_packets):
-				continue
-			data = unpack(self.SENSOR_READ_FORMAT, raw_data)[2:-1] # Unpack without header, n-bytes, and checksum
-			self.parse_data(data) # Parse Data
-			global flagStop
-			if self.clean.released:
-				if flagStop == True:
-					flagStop = False
-				else:
-					flagStop = True
-			#print(self.charging)
+			self.feed(self.connection.receive_available())
 
-		
-		
-	@staticmethod
-	def unwrap(raw_data, v1, v2):
+	def feed(self, data, arrived=None):
+		'''
+		Decodes every complete frame in newly received bytes, which arrived at time arrived (from history.clock)
+		'''
+		arrived = clock() if arrived is None else arrived
+		metrics = self.metrics
+		sync = self.sync
+		frames, corrupt, skipped = sync.frames, sync.corrupt, sync.skipped
+		for frame in sync.feed(data): # Only complete frames with a valid checksum
+			started = clock()
+			if self.parse_data(frame): # Parse Data
+				self.react(arrived)
+			else:
+				metrics.count('rejected')
+			metrics.parse.record(clock() - started)
+			self.frame_decoded()
+		received = sync.frames - frames
+		metrics.count('reads')
+		metrics.count('corrupt', sync.corrupt - corrupt)
+		metrics.count('skipped_bytes', sync.skipped - skipped)
+		if received:
+			metrics.count('frames', received)
+			if self.counted_starts != self.stream_starts:
+				self.counted_starts, self.last_arrived = self.stream_starts, None
+			if self.last_arrived is not None: # Frames that should have arrived since the last chunk but didn't
+				metrics.count('dropped', max(0, int(round((arrived - self.last_arrived) / FRAME_PERIOD)) - received))
+			self.last_arrived = arrived
+		else:
+			metrics.count('empty_reads')
+
+	def frame_decoded(self, state=None):
 		'''
-		Assumes that a list is circular and forces v1 and v2 to be the first 2 values
+		Wakes up everything waiting on a new frame and toggles flagStop when the clean button is released in state, the last frame by default
 		'''
-		ret_list = []
-		for index in range(len(raw_data)):
-			if raw_data[index] == v1 and raw_data[(index + 1) % len(raw_data)] == v2:
-				ret_list = ''.join([raw_data[(i + index) % len(raw_data)] for i in range(len(raw_data))])
-				break
-		return ret_list
+		with self.frame_ready: # Wake up everything waiting on a new frame
+			self.frame_count += 1
+			self.frame_ready.notify_all()
+		global flagStop
+		if (self.state if state is None else state).clean.released:
+			if flagStop == True:
+				flagStop = False
+			else:
+				flagStop = True
+
+	def parse_data(self, frame):
+		'''
+		Decodes the payload of one frame, returns False if it doesn't hold the expected packets
+		'''
+		with self.decoding:
+			if len(frame) != self.decoder.length: # Streamed before the packets changed
+				return False
+			values = self.decoder.decode(frame)
+			if values is None:
+				return False
+			working = self.working
+			odometry = self.odometry
+			if odometry.moving:
+				working.x, working.y, working.heading = odometry.integrate()
+				working.speed, working.rate = odometry.speed, odometry.rate
+			for name, filter_ in self.filters.items(): # Filter the public state, the history keeps the raw values
+				self.raw[name] = getattr(working, name)
+				setattr(working, name, filter_.update(self.raw[name]))
+			working.frame = self.frame_count + 1
+			self.state = working.snapshot() # Publish the whole frame at once
+			self.history.record(values) # Keep every value with a timestamp
+			return True
+
+	def react(self, arrived, state=None):
+		'''
+		Tells the metrics about bumps, cliffs, and button releases that have just started in state, the last frame by default, so their reaction latency is measured
+		Then the safety interlock, if there is one, checks state and stops the wheels before the frame is handed to anything else
+		'''
+		state = self.state if state is None else state
+		for reason, happening in self.REACTIONS.items():
+			if happening(state):
+				if reason not in self.reacting:
+					self.reacting.add(reason)
+					self.metrics.event(reason, arrived)
+			else:
+				self.reacting.discard(reason)
+		if self.interlock is not None:
+			self.interlock.check(state)
+
+	def stream_packets(self):
+		'''
+		Asks the iRobot to stream the packets in self.packets
+		'''
+		com = encoder.stream([packet.id for packet in self.packets]) # Create command
+		self.stream_starts += 1
+		self.connection.send(com)
+
+	def set_packets(self, packets):
+		'''
+		Changes the streamed packets, rebuilding the decoder, frame synchronizer, and history to match
+		The stream is paused while the packets change and restarted with the new ones
+		'''
+		decoder = SensorDecoder(packets, self.decoders()) # Fails before anything changes if a packet can't be decoded
+		streaming = self.stream_starts > 0
+		if streaming:
+			self.pause_stream()
+		with self.decoding:
+			self.packets = list(packets)
+			self.decoder = decoder
+			self.sync = FrameSync(decoder.length)
+			self.history = SensorHistory(decoder.indices, self.HISTORY_FRAMES)
+		if streaming:
+			self.stream_packets()
+
+	def register(self, *packets):
+		'''
+		Adds packets or packet groups to the stream
+		'''
+		self.set_packets(self.packets + [packet for packet in packets if packet not in self.packets])
 
-	def parse_data(self, data):
+	def unregister(self, *packets):
 		'''
-		Decodes all unpacked data
+		Removes packets or packet groups from the stream
 		'''
-		if data == []:
+		self.set_packets([packet for packet in self.packets if packet not in packets])
+
+	def pause_stream(self):
+		'''
+		Stops the iRobot from streaming sensor frames
+		'''
+		self.connection.send(encoder.PAUSE_STREAM)
+
+	def resume_stream(self):
+		'''
+		Restarts a paused sensor stream
+		'''
+		self.stream_starts += 1
+		self.connection.send(encoder.RESUME_STREAM)
+
+	def track_pose(self):
+		'''
+		Streams the distance and angle packets so the pose in x, y, and heading is kept up to date
+		'''
+		self.register(self.DISTANCE, self.ANGLE)
+
+	def reset_pose(self, x=0.0, y=0.0, heading=0.0):
+		'''
+		Moves the pose to x and y in mm facing heading degrees
+		'''
+		with self.decoding:
+			self.odometry.reset(x, y, heading)
+			self.working.x, self.working.y, self.working.heading = self.odometry.pose
+			self.state = self.working.snapshot()
+
+	def set_interlock(self, interlock=None):
+		'''
+		Checks interlock, a safety.SafetyInterlock, on every decoded frame in the thread that decodes them, and streams the packets it needs
+		None removes the interlock and lets the wheels drive again even if a fault is latched
+		'''
+		if interlock is None:
+			with self.decoding:
+				self.interlock = None
+			self.connection.release()
 			return
-		for i in range(0, len(data), 2):
-			if data[i] == self.WHEEL_DROP_AND_BUMPERS.id:
-				self.decodeWDAB(data[i + 1])
-			elif data[i] == self.CLIFF_LEFT.id:
-				self.cliff_left = bool(data[i + 1])
-			elif data[i] == self.CLIFF_FRONT_LEFT.id:
-				self.cliff_front_left = bool(data[i + 1])
-			elif data[i] == self.CLIFF_FRONT_RIGHT.id:
-				self.cliff_front_right = bool(data[i + 1])
-			elif data[i] == self.CLIFF_RIGHT.id:
-				self.cliff_right = bool(data[i + 1])
-			elif data[i] == self.VIRTUAL_WALL.id:
-				self.virtual_wall = bool(data[i + 1])
-			elif data[i] == self.BUTTONS.id:
-				self.decodeB(data[i + 1])
-			elif data[i] == self.DISTANCE.id:
-				self.distance += data[i + 1]
-			elif data[i] == self.ANGLE.id:
-				self.angle += data[i + 1]
-				self.angle %= 360
-			elif data[i] == self.LIGHT_BUMP_RIGHT.id:
-				self.IR_BR = data[i + 1]
-			elif data[i] == self.LIGHT_BUMPERS.id:
-				self.decodeLTBS(data[i + 1])
-			elif data[i] == self.IR_LEFT.id:
-				self.IR_LEFT_CHAR.update(int(data[i + 1]))
-			elif data[i] == self.IR_RIGHT.id:
-				self.IR_RIGHT_CHAR.update(int(data[i + 1]))
-			elif data[i] == self.IR_OMNI.id:
-				self.IR_OMNI_CHAR.update(int(data[i + 1]))
-			elif data[i] == self.CHARGING.id:
-				self.charging = data[i + 1]
+		self.register(*interlock.packets)
+		with self.decoding:
+			self.interlock = interlock
+
+	def set_filter(self, name, filter_=None):
+		'''
+		Filters the attribute name, such as 'IR_BR' or 'LB', with one of the filters in filters.py after every frame is decoded
+		The attribute must be set on every frame, the unfiltered value is kept in raw[name], and None removes the filter
+		'''
+		with self.decoding:
+			if filter_ is None:
+				self.filters.pop(name, None)
+				self.raw.pop(name, None)
 			else:
-				print "Unknown ID found"
-				break
+				getattr(self.working, name) # Fails now if there is no such sensor
+				self.filters[name] = filter_
+
+	def decoders(self):
+		'''
+		Creates the dispatch table that maps each packet id to the function that decodes its value
+		'''
+		return {
+			self.WHEEL_DROP_AND_BUMPERS.id: self.decodeWDAB,
+			self.CLIFF_LEFT.id: self.setter('cliff_left', bool),
+			self.CLIFF_FRONT_LEFT.id: self.setter('cliff_front_left', bool),
+			self.CLIFF_FRONT_RIGHT.id: self.setter('cliff_front_right', bool),
+			self.CLIFF_RIGHT.id: self.setter('cliff_right', bool),
+			self.VIRTUAL_WALL.id: self.setter('virtual_wall', bool),
+			self.BUTTONS.id: self.decodeB,
+			self.DISTANCE.id: self.decodeDistance,
+			self.ANGLE.id: self.decodeAngle,
+			self.LIGHT_BUMP_LEFT.id: self.setter('IR_BL'),
+			self.LIGHT_BUMP_FRONT_LEFT.id: self.setter('IR_BFL'),
+			self.LIGHT_BUMP_CENTER_LEFT.id: self.setter('IR_BCL'),
+			self.LIGHT_BUMP_CENTER_RIGHT.id: self.setter('IR_BCR'),
+			self.LIGHT_BUMP_FRONT_RIGHT.id: self.setter('IR_BFR'),
+			self.LIGHT_BUMP_RIGHT.id: self.setter('IR_BR'),
+			self.LIGHT_BUMPS.id: self.decodeLightBumps,
+			self.LIGHT_BUMPERS.id: self.decodeLTBS,
+			self.IR_LEFT.id: self.setter('IR_LEFT_CHAR', self.characters['IR_LEFT_CHAR'].update),
+			self.IR_RIGHT.id: self.setter('IR_RIGHT_CHAR', self.characters['IR_RIGHT_CHAR'].update),
+			self.IR_OMNI.id: self.setter('IR_OMNI_CHAR', self.characters['IR_OMNI_CHAR'].update),
+			self.CHARGING.id: self.setter('charging'),
+			self.OI_MODE.id: self.setter('mode'),
+		}
+
+	def setter(self, name, cast=None):
+		'''
+		Creates a decoder that stores a packet's value in the working state's attribute name
+		'''
+		state = self.working
+		if cast is None:
+			return lambda data: setattr(state, name, data)
+		return lambda data: setattr(state, name, cast(data))
 
 	def decodeWDAB(self, data):
 		'''
 		Takes the byte that represents the wheel drop and bump sensors and decodes it
 		'''
-		self.LWD = bool(data & 8)
-		self.RWD = bool(data & 4)
-		self.LB = bool(data & 2)
-		self.RB = bool(data & 1)
+		state = self.working
+		state.LWD = bool(data & 8)
+		state.RWD = bool(data & 4)
+		state.LB = bool(data & 2)
+		state.RB = bool(data & 1)
 
 	def decodeB(self, data):
 		'''
 		Takes the byte that represents Buttons and decodes it
 		'''
-		self.clock.update_button(bool(data & 128))
-		self.schedule.update_button(bool(data & 64))
-		self.day.update_button(bool(data & 32))
-		self.hour.update_button(bool(data & 16))
-		self.minute.update_button(bool(data & 8))
-		self.dock.update_button(bool(data & 4))
-		self.spot.update_button(bool(data & 2))
-		self.clean.update_button(bool(data & 1))
+		state = self.working
+		state.clock = state.clock.update_button(bool(data & 128))
+		state.schedule = state.schedule.update_button(bool(data & 64))
+		state.day = state.day.update_button(bool(data & 32))
+		state.hour = state.hour.update_button(bool(data & 16))
+		state.minute = state.minute.update_button(bool(data & 8))
+		state.dock = state.dock.update_button(bool(data & 4))
+		state.spot = state.spot.update_button(bool(data & 2))
+		state.clean = state.clean.update_button(bool(data & 1))
+
+	def decodeDistance(self, data):
+		'''
+		Takes the distance traveled since the last frame and adds it to the total
+		'''
+		self.working.distance += data
+		self.odometry.add(distance=data)
+
+	def decodeAngle(self, data):
+		'''
+		Takes the angle turned since the last frame and adds it to the total
+		'''
+		self.working.angle = (self.working.angle + data) % 360
+		self.odometry.add(angle=data)
+
+	def decodeLightBumps(self, data):
+		'''
+		Takes the six values of the light bump group (packet 106) and decodes them
+		'''
+		state = self.working
+		state.IR_BL, state.IR_BFL, state.IR_BCL, state.IR_BCR, state.IR_BFR, state.IR_BR = data
 
 	def decodeLTBS(self, data):
 		'''
+		Takes the byte that represents the light bumpers and decodes it
 		'''
-		self.LT_BR = bool(data & 32)
-		self.LT_BFR = bool(data & 16)
-		self.LT_BCR = bool(data & 8)
-		self.LT_BCL = bool(data & 4)
-		self.LT_BFL = bool(data & 2)
-		self.LT_BL = bool(data & 1)
+		state = self.working
+		state.LT_BR = bool(data & 32)
+		state.LT_BFR = bool(data & 16)
+		state.LT_BCR = bool(data & 8)
+		state.LT_BCL = bool(data & 4)
+		state.LT_BFL = bool(data & 2)
+		state.LT_BL = bool(data & 1)
 
 
+	################################################## Waiting ##################################################
+
+	def wait_frame(self, timeout=None):
+		'''
+		Blocks until the next frame has been decoded, returns False if timeout seconds pass first
+		'''
+		with self.frame_ready:
+			count = self.frame_count
+			self.frame_ready.wait(timeout)
+			return self.frame_count != count
+
+	def wait_until(self, predicate=None, timeout=None, interrupts=()):
+		'''
+		Checks predicate and the interrupts (BUMP, CLIFF, WHEEL_DROP, and BUTTON) once per frame until one of them happens or timeout seconds pass
+		Returns the reason it woke up: DONE if predicate returned True, TIMEOUT, or the interrupt that happened
+		'''
+		deadline = None if timeout is None else time.time() + timeout
+		with self.frame_ready:
+			while True:
+				if predicate is not None and predicate():
+					return self.DONE
+				state = self.state # Every interrupt is checked against the same frame
+				for reason in interrupts:
+					if self.INTERRUPTS[reason](state):
+						return reason
+				count = self.frame_count
+				while self.frame_count == count: # Sleep until the next frame
+					remaining = None if deadline is None else deadline - time.time()
+					if remaining is not None and remaining <= 0:
+						return self.TIMEOUT
+					self.frame_ready.wait(remaining)
+
 	################################################## Movement ##################################################
 
 	def drive(self, speed=MAX_SPEED / 5.0, radius=STRAIGHT, delay=False):
 		'''
 		Wrapper for drive commands, required from project 1
 		'''
-		self.connection.send(pack('>B2h', self.DRIVE, int(speed * 1000), radius), delay=delay)
+		self.connection.send(encoder.drive(speed * 1000, radius), delay=delay)
 		#if self.clean.pressed:
 			#raise self.BUTTON_INTERRUPT
 
-	def drive_straight(self, distance, speed=MAX_SPEED / 5.0):
+	def drive_straight(self, distance, speed=MAX_SPEED / 5.0, basis=None):
 		'''
 		Takes a distance in meters and a speed in meters per second and moves the iRobot the intended distance in a straight line
+		basis is ODOMETRY to stop on the measured distance, slowing down near the end, or TIME to stop once the distance should have been covered
+		By default it is ODOMETRY when the pose is tracked
 		'''
 		speed = self.MAX_SPEED if speed > self.MAX_SPEED else -self.MAX_SPEED if speed < -self.MAX_SPEED else speed # Makes sure that the speed isn't too high or too low
-		t = distance / speed # Solve for t
-		drive_start_time = time.time() # Keep track of start time
-		self.drive(speed) # Send drive command
-		while (time.time() - drive_start_time < t and self.safe_to_drive() and not self.clean.pressed): # Make sure the iRobot is safe to drive and hasn't driven too far
-			continue
+		interrupts = (self.WHEEL_DROP, self.BUMP, self.CLIFF, self.BUTTON)
+		if self.on_odometry(basis):
+			direction = -1 if speed < 0 else 1
+			start = self.state.distance
+			reason = self.move(lambda v: self.drive(direction * v), abs(distance) * 1000, abs(speed),
+				lambda state: (direction * (state.distance - start), direction * state.speed), interrupts)
+		else:
+			t = distance / speed # Solve for t
+			self.drive(speed) # Send drive command
+			reason = self.wait_until(timeout=t, interrupts=interrupts) # Make sure the iRobot is safe to drive and hasn't driven too far
 		self.stop_drive() # Send stop driving command
 		if self.clean.pressed:
 			raise self.BUTTON_INTERRUPT
+		return reason
 
-	def turn(self, angle, speed=MAX_SPEED / 5.0):
+	def turn(self, angle, speed=MAX_SPEED / 5.0, basis=None):
 		'''
 		Takes an angle in degrees and a speed in meters per second to rotate the iRobot in place
 		If angle is positive then the iRobot will turn counter clockwise
+		basis is ODOMETRY to stop on the measured angle, slowing down near the end, or TIME to stop once the angle should have been turned
+		By default it is ODOMETRY when the pose is tracked
 		'''
 		speed = self.MAX_SPEED if speed > self.MAX_SPEED else -self.MAX_SPEED if speed < -self.MAX_SPEED else speed # Makes sure that the speed isnt too fast
-		deg_per_sec = speed * 180.0 / (self.RADIUS * math.pi) # Find degrees per second
-		t = angle / deg_per_sec # Solve for t
-		if angle < 0: # Figure out which way to rotate
-			self.drive(speed, self.CW)
+		rotation = self.CW if angle < 0 else self.CCW # Figure out which way to rotate
+		interrupts = (self.WHEEL_DROP, self.BUTTON)
+		if self.on_odometry(basis):
+			mm_per_degree = math.radians(1) * self.RADIUS * 1000 # Each wheel travels this far per degree turned
+			turned = [0.0, self.state.heading] # Degrees turned so far and the heading they were last added at
+			def progress(state):
+				turned[0] += (state.heading - turned[1] + 180) % 360 - 180 # Smallest change, so a turn can go past 360
+				turned[1] = state.heading
+				return rotation * turned[0] * mm_per_degree, rotation * state.rate * mm_per_degree
+			reason = self.move(lambda v: self.drive(v, rotation), abs(angle) * mm_per_degree, abs(speed), progress, interrupts)
 		else:
-			self.drive(speed, self.CCW)
-		drive_start_time = time.time() # Keep track of start time
-		while (time.time() - drive_start_time < abs(t) and self.safe_to_turn() and not self.clean.pressed): # Make sure the iRobot is safe to turn and hasn't turned for too long
-			continue
+			deg_per_sec = speed * 180.0 / (self.RADIUS * math.pi) # Find degrees per second
+			t = angle / deg_per_sec # Solve for t
+			self.drive(speed, rotation)
+			reason = self.wait_until(timeout=abs(t), interrupts=interrupts) # Make sure the iRobot is safe to turn and hasn't turned for too long
 		self.stop_drive() # Stop turning
 		if self.clean.pressed:
 			raise self.BUTTON_INTERRUPT
+		return reason
+
+	def on_odometry(self, basis=None):
+		'''
+		Returns True if a move should stop on odometry: when basis is ODOMETRY, which streams DISTANCE and ANGLE if they aren't, or by default when they are streamed
+		'''
+		tracked = self.DISTANCE in self.packets and self.ANGLE in self.packets
+		if basis == self.ODOMETRY and not tracked:
+			self.track_pose()
+		return basis == self.ODOMETRY or (basis is None and tracked)
+
+	def move(self, command, target, speed, progress, interrupts=()):
+		'''
+		Sends command(speed in m/s) on every frame until the mm each wheel has traveled, from progress(state) as (mm, mm/s), would reach target mm by the time a stop takes effect
+		The speed ramps down at DECELERATION near the target but not below MIN_SPEED, so the iRobot arrives without overshooting
+		Returns DONE, the interrupt that happened, or TIMEOUT if the stream stops or the iRobot stalls
+		'''
+		def arrived():
+			covered, moving = progress(self.state)
+			remaining = target - covered - max(moving, 0.0) * self.STOP_LATENCY # Where a stop sent now would leave it
+			if remaining <= 0:
+				return True
+			command(min(speed, max(self.MIN_SPEED, math.sqrt(2 * self.DECELERATION * remaining / 1000.0))))
+			return False
+		return self.wait_until(arrived, timeout=2 * target / 1000.0 / max(speed, self.MIN_SPEED) + self.MOTION_TIMEOUT, interrupts=interrupts)
 
 	def stop_drive(self):
 		'''
@@ -390,50 +1146,42 @@ class iRobot(object):
 		Takes a time in seconds and 2 velocities in mm/s
 		These represent the left and right wheel velocities
 		'''
-		self.connection.send(pack('>B2h', self.DRIVE_DIRECT, vl * 1000, vr * 1000), delay=False) # Send drive direct command
-		drive_start_time = time.time() # Keep track of when the iRobot started driving
-		while ((time.time() - drive_start_time < t) and self.safe_to_drive()): # While can drive and hasn't driven for 't' seconds
-			continue
+		self.connection.send(encoder.drive_direct(vr * 1000, vl * 1000), delay=False) # Send drive direct command, right wheel first
+		reason = self.wait_until(timeout=t, interrupts=(self.WHEEL_DROP, self.BUMP, self.CLIFF)) # While can drive and hasn't driven for 't' seconds
 		self.stop_drive() # Stop iRobot
+		return reason
 
 	################################################## Magic Methods ##################################################
 	def __str__(self):
 		'''
 		Creates a string that shows the iRobot's current runtime, and other data
 		'''
+		state = self.state
 		output = '<' + str(time.time() - self.start_time) + '>'
-		output += '  Clean Button Pressed: ' + str(self.clean.pressed) + '\n'
-		output += '  Distance: ' + str(self.distance) + '\n'
-		output += '  Angle: ' + str(self.angle) + '\n'
-		output += '  Left Bumper Pressed: ' + str(self.LB) + '\n'
-		output += '  Right Bumper Pressed: ' + str(self.RB) + '\n'
+		output += '  Clean Button Pressed: ' + str(state.clean.pressed) + '\n'
+		output += '  Distance: ' + str(state.distance) + '\n'
+		output += '  Angle: ' + str(state.angle) + '\n'
+		output += '  Left Bumper Pressed: ' + str(state.LB) + '\n'
+		output += '  Right Bumper Pressed: ' + str(state.RB) + '\n'
 		return output
 
 	def safe_to_drive(self):
 		'''
 		Returns a boolean that represents whether or not the iRobot is safe to drive
 		'''
-		return not (self.LWD or self.RWD or self.LB or self.RB or self.cliff_front_left or self.cliff_front_right or self.cliff_left or self.cliff_right)
+		return self.state.safe_to_drive()
 
 	def safe_to_turn(self):
 		'''
 		Returns a boolean that represents whether or not the iRobot is safe to rotate
 		'''
-		return not (self.LWD or self.RWD)
+		return self.state.safe_to_turn()
 
 	def button_pressed(self):
 		'''
 		Returns a boolean that represents whether or not the iRobot has had a button pressed
 		'''
-		return self.clean.pressed or self.dock.pressed or self.spot.pressed or self.schedule.pressed or self.clock.pressed or self.day.pressed or self.hour.pressed or self.minute.pressed
-
-	def play_song(self):
-		'''
-		Creates and plays a song
-		'''
-		song = chr(59) + chr(16) + chr(55) + chr(16) + chr(60) + chr(16) + chr(55) + chr(16) + chr(62) + chr(16) + chr(55) + chr(16) + chr(63) + chr(16) + chr(55) + chr(16) + chr(62) + chr(16) + chr(55) + chr(16) + chr(60) + chr(16) + chr(55) + chr(16) + chr(40) + chr(8) + chr(41) + chr(8) + chr(42) + chr(8) + chr(43) + chr(16)
-		self.connection.send(chr(140) + chr(0) + chr(16) + song)
-		self.connection.send(chr(141) + chr(0))
+		return self.state.button_pressed()
 
 	@staticmethod
 	def error2radius(error):
@@ -459,137 +1207,60 @@ class iRobot(object):
 		return val
 	def play_song(self):
 		'''
-		Creates and plays a song
+		Plays the charging song, uploading it only the first time
 		'''
-		song = chr(59)+chr(16)+chr(55)+chr(16)+chr(60)+chr(16)+chr(55)+chr(16)+chr(62)+chr(16)+chr(55)+chr(16)+chr(63)+chr(16)+chr(55)+chr(16)+chr(62)+chr(16)+chr(55)+chr(16)+chr(60)+chr(16)+chr(55)+chr(16)+chr(40)+chr(8)+chr(41)+chr(8)+chr(42)+chr(8)+chr(43)+chr(16)
-		self.connection.send(chr(140)+chr(0)+chr(16)+song)
-		print("playing song")
-		self.connection.send(chr(141)+chr(0))
+		self.songs.play(self.CHARGING_SONG)
+		self.log.event("playing song")
 	def seek_dock(self):
-		closeFlag = False
-		onDock = False
-		numOfAtmp = 0
-		while (self.charging != 2):
-			print("still running")
-			#print(self.charging)
-			if onDock == False and self.IR_OMNI_CHAR.curr == 0 and self.IR_LEFT_CHAR.curr == 0 and self.IR_RIGHT_CHAR.curr == 0:
-				#print "Nothing found"
-				continue
-			elif onDock == True and self.IR_OMNI_CHAR.curr == 0 and self.IR_LEFT_CHAR.curr == 0 and self.IR_RIGHT_CHAR.curr == 0 and numOfAtmp < 3:
-				print("Literally on the dock")
-				self.drive(-iRobot.MAX_SPEED/10, iRobot.STRAIGHT)
-				self.turn(5)
-				time.sleep(0.75)
-				self.turn(-5)
-				time.sleep(0.75)
-				numOfAtmp += 1
-			elif onDock == True and self.IR_OMNI_CHAR.curr == 0 and self.IR_LEFT_CHAR.curr == 0 and self.IR_RIGHT_CHAR.curr == 0 and numOfAtmp >= 3:
-				print("3 attempts without success")
-				self.drive(-iRobot.MAX_SPEED/10, iRobot.STRAIGHT)
-				time.sleep(0.75)
-				numOfAtmp = 0
-				onDock = False
-			elif self.IR_LEFT_CHAR.curr == iRobot.G_N_R_BUOY or self.IR_RIGHT_CHAR.curr == iRobot.G_N_R_BUOY:
-				print "Drive Straight"
-				self.drive(iRobot.MAX_SPEED / 10, iRobot.STRAIGHT)
-				while not (self.LB or self.RB):
-					continue
-				self.stop_drive()
-				if (self.LB and self.RB and self.charging != 0):
-					print("woah")
-					break
-				elif (self.LB and self.RB and self.charging == 0):
-					print("center hit")
-					onDock = True
-					#self.drive_straight
-					#self.drive_direct(0.5, -iRobot.MAX_SPEED/10, -iRobot.MAX_SPEED/10)
-					self.turn(-5)
-					self.drive(-iRobot.MAX_SPEED/10, iRobot.STRAIGHT)
-					#self.drive(-iRobot.MAX_SPEED / 10, 0.6*iRobot.STRAIGHT)
-					while not (self.LB or self.RB):
-						continue
-				elif (self.RB and not self.LB):
-					print("right hit")
-					onDock = True
-					#self.drive_straight
-					#self.drive_direct(0.5, -iRobot.MAX_SPEED/10, -iRobot.MAX_SPEED/10)
-					self.turn(-5)
-					self.drive(-iRobot.MAX_SPEED/10, iRobot.STRAIGHT)
-					time.sleep(.25)
-					self.turn(-5)
-					#self.drive_direct(1, 0, -iRobot.MAX_SPEED/10)
-					while not (self.LB or self.RB):
-						continue
-				elif onDock == True and self.IR_OMNI_CHAR.curr == 0 and self.IR_LEFT_CHAR.curr == 0 and self.IR_RIGHT_CHAR.curr == 0:
-					print("Literally on the dock")
-					self.turn(5)
-					time.sleep(0.75)
-					self.turn(-5)
-					time.sleep(0.75)
-					continue
-				elif (self.LB and not self.RB):
-					print("left hit")
-					onDock = True
-					#self.drive_straight
-					#self.drive_direct(0.5, -iRobot.MAX_SPEED/10, -iRobot.MAX_SPEED/10)
-					self.turn(5)
-					self.drive(-iRobot.MAX_SPEED/10, iRobot.STRAIGHT)
-					self.turn(5)
-					#self.drive_direct(1, 0, -iRobot.MAX_SPEED/10)
-					while not (self.LB or self.RB):
-						continue
-				else:
-					self.drive_direct(0.5, -iRobot.MAX_SPEED / 10, -iRobot.MAX_SPEED / 10)
-					#self.turn(7)
-					self.drive(iRobot.MAX_SPEED / 10, iRobot.STRAIGHT)
-					while not (self.LB or self.RB):
-						continue
-				closeFlag = True
-				#break
-			elif self.IR_OMNI_CHAR.curr == iRobot.FORCE_FIELD and self.IR_LEFT_CHAR.curr == 0 and self.IR_RIGHT_CHAR.curr == 0 and closeFlag == False:
-				print "Making room"
-				self.turn(15)
-				self.drive_straight(0.44)
-				self.turn(-85)
-				time.sleep(0.5)
-				self.turn(-3)
-				time.sleep(0.5)
-				self.stop_drive()
-				closeFlag = True
-			'''
-			elif (self.IR_OMNI_CHAR.curr == iRobot.RED_BUOY or self.IR_OMNI_CHAR.curr == self.R_N_FF) and self.IR_LEFT_CHAR.curr == 0:
-				print "Centering"
-				self.drive_direct(1.5, 0, iRobot.MAX_SPEED / 5)
-				self.stop_drive()
-			else:
-				self.turn(-15)
-			'''
+		'''
+		Follows the dock's infrared beams until the iRobot is charging, then plays a song
+		The machine in behavior.seek_dock is ticked on every frame, so a new infrared character or a bump is acted on within a frame
+		'''
+		behavior.seek_dock(self).run()
 		self.play_song()
-		print("charging detected")
-			
+		self.log.event("charging detected")
+
+def sensor_property(name):
+	'''
+	Creates a read only iRobot attribute that reads name from the last published frame
+	Reading several attributes can still span two frames, take robot.state once to check more than one value of the same frame
+	'''
+	return property(operator.attrgetter('state.' + name))
+
+for sensor in SensorState.__slots__:
+	setattr(iRobot, sensor, sensor_property(sensor))
 
 ################################################## Main Method ##################################################
 
 if __name__ == "__main__":
-	global flagStop
 	flagStop = True
 	Kp = 0.3 # Arbitrary proprtional gain
 	Kd = 0.0075 # Arbitrary derivative gain
 	set_point = 420 # Arbitrary set point
-	delay = 0.25
-	error = lambda e_prev_, e_curr_: (Kp * e_curr_) + (Kd * (e_curr_ - e_prev_) / delay)
-	robot = iRobot()
-	robot.start()
-	robot.safe()
-	#robot.full()
-	time.sleep(0.1)
-	e_prev = set_point - robot.IR_BR # Previous error
-	e_curr = e_prev # Current error
+	robot = iRobot(Connection(recorder=TelemetryRecorder(time.strftime('telemetry-%Y%m%d-%H%M%S.bin')))) # Record the run for replay
+	scheduler = FrameScheduler(robot) # Ticks the wall follower on every frame, about 66 times a second
+	robot.set_filter('IR_BR', Median(3)) # A single bright or dark frame doesn't swing the controller
+	robot.set_filter('LT_BFR', Debounce(2)) # A single noisy frame doesn't start a turn
+	robot.set_filter('LT_BCL', Debounce(2))
+	robot.set_interlock(SafetyInterlock(robot)) # Stops the wheels within a frame of a wheel drop or cliff, whatever the controller is doing
+	robot.connect(iRobot.SAFE_MODE) # Returns once the iRobot reports safe mode, or raises HandshakeError
 	while True:
+			robot.wait_frame() # Check the buttons once per frame
 			if robot.hour.pressed: # Dev full stop
 				break
 			if robot.clean.released: # Start moving once clean is pressed
-				while True:
+				if not robot.interlock.acknowledge(): # Still on a cliff or lifted, wait for the next press
+					flagStop = True
+					continue
+				follower = behavior.wall_follower(robot, Kp, Kd, set_point, stop=lambda state: flagStop or robot.interlock.fault is not None) # Stop robot when button pressed or the interlock trips
+				try:
+					state = follower.run(scheduler) # Wall follow until clean is pressed again or the dock is seen
+				except:
+					state = None
+				robot.log.event('controller stats', **follower.task.stats()) # Runs, overruns, and jitter of the controller
+				if robot.interlock.fault is not None:
+					flagStop = True # The next press acknowledges the fault and starts again
+				if state == 'dock':
 					'''
 					Seek Dock:
 					If only omni char, rotate until left or right char
@@ -597,38 +1268,16 @@ if __name__ == "__main__":
 					Once left and right receive green and red, drive straight
 					Once Center bump, stop driving
 					'''
-					try:
-						if flagStop == True: # Stop robot when button pressed
-							robot.stop_drive()
-							break
-
-						if flagStop == False: # Wall follow while no button is pressed
-							if robot.IR_OMNI_CHAR.curr != 0:
-								robot.seek_dock()
-								# Happy song
-								print("yeah boi")
-								robot.play_song()
-								time.sleep(2)
-								robot.stop()
-								exit()
-							e_prev, e_curr = e_curr, set_point - robot.IR_BR # Set error
-							e_val = error(e_prev, e_curr) # Find an error value
-							radius = iRobot.error2radius(e_val) # Find a required radius
-							robot.drive(iRobot.MAX_SPEED / 4.5, radius) # Drive while safe
-							if robot.clean.released:
-								break
-							if robot.LT_BFR or (robot.RB and not robot.LB): # If the robot is pointed towards the wall, turn left
-								robot.drive(iRobot.MAX_SPEED / 4.5, iRobot.CCW)
-								while robot.LT_BFR or (robot.RB and not robot.LB):
-									continue
-								robot.stop_drive()
-							if (robot.LB and robot.RB) or robot.LT_BCL: # If the robot has a center bump or sees a wall infront of it, turn left
-								robot.drive(iRobot.MAX_SPEED / 4.5, iRobot.CCW)
-								while (robot.LB and robot.RB) or robot.LT_BCL:
-									continue
-								robot.stop_drive()
-							time.sleep(delay)
-					except:
-						break
+					robot.seek_dock()
+					# Happy song
+					robot.log.event("yeah boi")
+					robot.play_song()
+					time.sleep(2)
+					robot.stop()
+					robot.connection.close()
+					robot.log.close() # Write out every event before exiting
+					exit()
 	robot.stop_drive()
-	robot.stop()
\ No newline at end of file
+	robot.stop()
+	robot.connection.close()
+	robot.log.close()
\ No newline at end of file
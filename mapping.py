@@ -0,0 +1,209 @@
+'''
+Occupancy grid of what the iRobot has bumped into, found a cliff at, or seen with its light bumpers, placed by its odometry pose
+The grid is split into square tiles of NumPy arrays that are only allocated where something has been seen, and whole rays are updated at once
+Positions are in mm and headings in degrees, like odometry
+Needs NumPy
+'''
+import math
+import numpy as np
+from interface import iRobot
+
+RESOLUTION = 20.0 # mm per cell
+TILE = 64 # Cells along a side of a tile, so a tile covers 1.28 m
+HIT = 0.85 # Log odds added to a cell where something was found
+MISS = -0.4 # Log odds added to a cell a sensor saw through
+LIMIT = 5.0 # Log odds are kept within +-LIMIT so a cell can change its mind
+OCCUPIED = 0.5 # Log odds above which a cell counts as an obstacle
+
+def pack(cx, cy):
+	'''
+	Packs cell or tile indices into one int64 key each, so they can be sorted and compared as plain numbers
+	'''
+	return cx * (1 << 32) + (cy & 0xFFFFFFFF)
+
+def unpack(keys):
+	'''
+	Returns the indices packed into keys, as arrays or, for a single key, as a tuple of ints
+	'''
+	cx = keys >> 32
+	cy = ((keys & 0xFFFFFFFF) ^ 0x80000000) - 0x80000000 # Back to signed
+	return (int(cx), int(cy)) if isinstance(keys, int) else (cx, cy)
+
+class OccupancyGrid(object):
+	'''
+	Sparse grid of log odds that each cell holds an obstacle, 0 for cells nothing is known about
+	'''
+	def __init__(self, resolution=RESOLUTION, tile=TILE):
+		'''
+		Creates an empty grid of resolution mm cells in tiles of tile by tile cells
+		'''
+		self.resolution = float(resolution)
+		self.tile = tile
+		self.tiles = {} # (tile x, tile y) -> float32 array of log odds indexed [cell x, cell y]
+
+	def cells(self, x, y):
+		'''
+		Returns the cell indices of points x, y as two int arrays
+		'''
+		return (np.floor(np.asarray(x, dtype=float) / self.resolution).astype(np.int64),
+			np.floor(np.asarray(y, dtype=float) / self.resolution).astype(np.int64))
+
+	def update(self, cx, cy, change):
+		'''
+		Adds change to the log odds of every distinct cell in cx, cy, allocating tiles as needed
+		'''
+		cells = np.unique(pack(np.ravel(cx), np.ravel(cy))) # A cell hit by several samples of a ray counts once
+		if not len(cells):
+			return
+		cx, cy = unpack(cells)
+		keys, inverse = np.unique(pack(cx // self.tile, cy // self.tile), return_inverse=True)
+		lx, ly = cx % self.tile, cy % self.tile
+		for i, key in enumerate(keys.tolist()): # Rays cross few tiles, the cells of each are updated together
+			tile = self.tiles.get(unpack(key))
+			if tile is None:
+				tile = self.tiles[unpack(key)] = np.zeros((self.tile, self.tile), dtype=np.float32)
+			inside = inverse == i
+			tile[lx[inside], ly[inside]] = np.clip(tile[lx[inside], ly[inside]] + change, -LIMIT, LIMIT)
+
+	def mark(self, x, y, hit=True):
+		'''
+		Marks points x, y as obstacles, or as free if hit is False
+		'''
+		cx, cy = self.cells(x, y)
+		self.update(cx, cy, HIT if hit else MISS)
+
+	def ray(self, x0, y0, x1, y1, hit=True):
+		'''
+		Marks the cells along rays from x0, y0 to x1, y1 as free, and the cell at the end of each ray whose hit is True as an obstacle
+		Any argument can be an array, so many rays are updated at once
+		'''
+		x0, y0, x1, y1, hit = np.broadcast_arrays(*[np.atleast_1d(np.asarray(a, dtype=float)) for a in (x0, y0, x1, y1)] + [np.atleast_1d(np.asarray(hit, dtype=bool))])
+		steps = int(math.ceil(np.max(np.hypot(x1 - x0, y1 - y0)) * 2 / self.resolution)) + 1 # Half a cell apart so no cell is skipped
+		t = np.linspace(0.0, 1.0, steps)
+		sx, sy = self.cells(x0[:, None] + (x1 - x0)[:, None] * t, y0[:, None] + (y1 - y0)[:, None] * t)
+		ex, ey = self.cells(x1[hit], y1[hit])
+		free = ~np.isin(pack(sx, sy), pack(ex, ey)) # The obstacles themselves aren't seen through
+		self.update(sx[free], sy[free], MISS)
+		self.update(ex, ey, HIT)
+
+	def log_odds(self, x, y):
+		'''
+		Returns the log odds of the cells at points x, y, 0 where nothing is known
+		'''
+		cx, cy = self.cells(x, y)
+		cx, cy = np.atleast_1d(cx), np.atleast_1d(cy)
+		values = np.zeros(cx.shape, dtype=np.float32)
+		tx, ty = cx // self.tile, cy // self.tile
+		for key in set(zip(tx.tolist(), ty.tolist())):
+			tile = self.tiles.get(key)
+			if tile is not None:
+				inside = (tx == key[0]) & (ty == key[1])
+				values[inside] = tile[cx[inside] % self.tile, cy[inside] % self.tile]
+		return values
+
+	def occupied(self, x, y):
+		'''
+		Returns whether the cells at points x, y hold obstacles
+		'''
+		return self.log_odds(x, y) > OCCUPIED
+
+	def obstacles(self, x0, y0, x1, y1):
+		'''
+		Returns the centers of the obstacle cells in the box from x0, y0 to x1, y1 as an (n, 2) array
+		'''
+		(cx0, cx1), (cy0, cy1) = self.cells(sorted((x0, x1)), sorted((y0, y1)))
+		found = []
+		for (tx, ty), tile in self.tiles.items():
+			if tx * self.tile > cx1 or (tx + 1) * self.tile <= cx0 or ty * self.tile > cy1 or (ty + 1) * self.tile <= cy0:
+				continue
+			lx, ly = np.nonzero(tile > OCCUPIED)
+			cx, cy = lx + tx * self.tile, ly + ty * self.tile
+			inside = (cx >= cx0) & (cx <= cx1) & (cy >= cy0) & (cy <= cy1)
+			found.append(np.stack([cx[inside], cy[inside]], axis=1))
+		if not found:
+			return np.zeros((0, 2))
+		return (np.concatenate(found) + 0.5) * self.resolution
+
+	def nearest(self, x, y, radius=1000.0):
+		'''
+		Returns (distance, x, y) of the obstacle nearest to x, y within radius mm, or None if there is none
+		'''
+		points = self.obstacles(x - radius, y - radius, x + radius, y + radius)
+		if not len(points):
+			return None
+		distances = np.hypot(points[:, 0] - x, points[:, 1] - y)
+		i = int(np.argmin(distances))
+		if distances[i] > radius:
+			return None
+		return float(distances[i]), float(points[i, 0]), float(points[i, 1])
+
+	def free_path(self, x0, y0, x1, y1, clearance=iRobot.RADIUS * 1000):
+		'''
+		Returns True if no known obstacle is within clearance mm of the straight path from x0, y0 to x1, y1, by default the iRobot's radius
+		'''
+		margin = clearance + self.resolution
+		points = self.obstacles(min(x0, x1) - margin, min(y0, y1) - margin, max(x0, x1) + margin, max(y0, y1) + margin)
+		if not len(points):
+			return True
+		dx, dy = x1 - x0, y1 - y0
+		length = dx * dx + dy * dy
+		t = np.clip(((points[:, 0] - x0) * dx + (points[:, 1] - y0) * dy) / length, 0.0, 1.0) if length else np.zeros(len(points))
+		distances = np.hypot(points[:, 0] - (x0 + t * dx), points[:, 1] - (y0 + t * dy))
+		return bool(np.all(distances > clearance))
+
+class Mapper(object):
+	'''
+	Marks what an iRobot's bumpers, cliff sensors, and light bumpers show on an OccupancyGrid, once per frame
+	The iRobot must stream DISTANCE and ANGLE, which iRobot.track_pose does, and the light bumpers (packet 45) for anything but bumps and cliffs
+	'''
+	RADIUS = iRobot.RADIUS * 1000 # mm from the center to the bumper
+	LIGHT_RANGE = 100.0 # mm past the bumper the light bumpers see
+	BUMPS = ((True, True, 0.0), (True, False, 45.0), (False, True, -45.0)) # (LB, RB, degrees from the heading of the hit)
+	CLIFFS = (('cliff_left', 60.0), ('cliff_front_left', 15.0), ('cliff_front_right', -15.0), ('cliff_right', -60.0))
+	LIGHT_BUMPS = (('LT_BL', 65.0), ('LT_BFL', 35.0), ('LT_BCL', 10.0), ('LT_BCR', -10.0), ('LT_BFR', -35.0), ('LT_BR', -65.0))
+	TURNED = 5.0 # Degrees the iRobot has to turn before the same readings are mapped again
+
+	def __init__(self, robot, grid=None):
+		'''
+		Maps robot's sensors onto grid, a new OccupancyGrid by default
+		'''
+		self.robot = robot
+		self.grid = OccupancyGrid() if grid is None else grid
+		self.frame = None # Last frame looked at
+		self.mapped = None # (x, y, heading, readings) last mapped
+		self.light_angles = np.radians([angle for name, angle in self.LIGHT_BUMPS])
+		footprint = np.arange(-self.RADIUS, self.RADIUS, self.grid.resolution)
+		fx, fy = np.meshgrid(footprint, footprint)
+		inside = np.hypot(fx, fy) < self.RADIUS * 0.8
+		self.footprint = (fx[inside], fy[inside]) # Points under the iRobot, which can't hold obstacles
+
+	def update(self, dt=None):
+		'''
+		Maps the iRobot's last frame, once, so it can be run by a FrameScheduler
+		The same readings from about the same pose are only mapped once, so standing still doesn't pile up evidence
+		'''
+		state = self.robot.state
+		if state.frame == self.frame:
+			return
+		self.frame = state.frame
+		readings = (state.LB, state.RB) + tuple(getattr(state, name) for name, angle in self.CLIFFS + self.LIGHT_BUMPS)
+		if self.mapped is not None:
+			x, y, heading, mapped = self.mapped
+			if mapped == readings and math.hypot(state.x - x, state.y - y) < self.grid.resolution / 2 and abs((state.heading - heading + 180) % 360 - 180) < self.TURNED:
+				return
+		self.mapped = (state.x, state.y, state.heading, readings)
+		grid = self.grid
+		x, y, heading = state.x, state.y, math.radians(state.heading)
+		cos, sin = math.cos(heading), math.sin(heading)
+		grid.mark(x + self.footprint[0] * cos - self.footprint[1] * sin, y + self.footprint[0] * sin + self.footprint[1] * cos, hit=False)
+		angles = heading + self.light_angles
+		start = self.RADIUS
+		end = self.RADIUS + self.LIGHT_RANGE
+		seen = [getattr(state, name) for name, angle in self.LIGHT_BUMPS]
+		grid.ray(x + start * np.cos(angles), y + start * np.sin(angles), x + end * np.cos(angles), y + end * np.sin(angles), seen)
+		hits = [angle for left, right, angle in self.BUMPS if state.LB == left and state.RB == right]
+		hits += [angle for name, angle in self.CLIFFS if getattr(state, name)]
+		if hits:
+			angles = heading + np.radians(hits)
+			reach = self.RADIUS + grid.resolution / 2
+			grid.mark(x + reach * np.cos(angles), y + reach * np.sin(angles))
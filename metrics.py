@@ -0,0 +1,186 @@
+'''
+Counters and latency histograms for the sensor and command paths
+Recording is a few additions into preallocated arrays under an uncontended lock, so it stays on all the time
+'''
+import bisect
+import sys
+import threading
+from array import array
+from history import clock
+
+class Histogram(object):
+	'''
+	Counts durations in seconds in fixed buckets that double in width, from 1 us to about 8 s
+	It can be recorded from one thread while another takes snapshots
+	'''
+	BOUNDS = [1e-6 * 2 ** i for i in range(24)] # Upper bound of each bucket, the last bucket holds everything longer
+
+	def __init__(self):
+		'''
+		Creates an empty histogram
+		'''
+		self.buckets = array('L', [0]) * (len(self.BOUNDS) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.lock = threading.Lock()
+
+	def record(self, seconds):
+		'''
+		Adds one duration
+		'''
+		with self.lock:
+			self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+			self.count += 1
+			self.total += seconds
+			if seconds > self.max:
+				self.max = seconds
+
+	def percentile(self, percent):
+		'''
+		Returns the upper bound of the bucket holding the given percentile, or None if nothing has been recorded
+		The bound is capped at the longest duration recorded, which can be inside the bucket
+		'''
+		if not self.count:
+			return None
+		rank = self.count * percent / 100.0
+		seen = 0
+		for bucket, n in enumerate(self.buckets):
+			seen += n
+			if seen >= rank and n:
+				return min(self.BOUNDS[bucket], self.max) if bucket < len(self.BOUNDS) else self.max
+		return self.max
+
+	def snapshot(self):
+		'''
+		Returns a dictionary of the count, mean, max, and 50th, 90th, and 99th percentiles in seconds
+		'''
+		with self.lock:
+			return {'count': self.count, 'mean': self.total / self.count if self.count else None, 'max': self.max, 'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+	def reset(self):
+		'''
+		Forgets every duration
+		'''
+		with self.lock:
+			for bucket in range(len(self.buckets)):
+				self.buckets[bucket] = 0
+			self.count = 0
+			self.total = 0.0
+			self.max = 0.0
+
+class Metrics(object):
+	'''
+	Counters and histograms shared by a Connection and its iRobot
+	Reaction latency runs from the arrival of the bytes that showed an event to the next urgent command (a stop or mode change) being written
+	The reading and writing threads both record into it, so every change holds its lock
+	'''
+	COUNTERS = ('reads', 'empty_reads', 'frames', 'dropped', 'corrupt', 'rejected', 'skipped_bytes', 'commands', 'blocked', 'unanswered')
+	REACTION_TIMEOUT = 1.0 # Seconds after which an event without an urgent command is counted as unanswered
+
+	def __init__(self):
+		'''
+		Creates zeroed counters and empty histograms
+		'''
+		self.counters = dict.fromkeys(self.COUNTERS, 0)
+		self.parse = Histogram() # Seconds to decode a frame
+		self.queue_wait = Histogram() # Seconds a command waited in the send queue
+		self.reactions = {} # Event -> Histogram of reaction latencies
+		self.pending = {} # Event -> time the bytes that showed it arrived
+		self.dumping = None
+		self.lock = threading.Lock()
+
+	def count(self, name, n=1):
+		'''
+		Adds n to a counter
+		'''
+		with self.lock:
+			self.counters[name] += n
+
+	def event(self, name, arrived):
+		'''
+		Notes that the bytes that arrived at time arrived (from history.clock) showed an event, such as a bump, that needs an urgent command
+		'''
+		with self.lock:
+			if name not in self.pending:
+				self.pending[name] = arrived
+
+	def actuated(self, now=None):
+		'''
+		Records the reaction latency of every pending event when an urgent command is written
+		'''
+		if not self.pending:
+			return
+		now = clock() if now is None else now
+		with self.lock:
+			for name, arrived in list(self.pending.items()):
+				latency = now - arrived
+				if latency > self.REACTION_TIMEOUT:
+					self.counters['unanswered'] += 1
+				else:
+					if name not in self.reactions:
+						self.reactions[name] = Histogram()
+					self.reactions[name].record(latency)
+				del self.pending[name]
+
+	def snapshot(self):
+		'''
+		Returns a dictionary of every counter and histogram
+		'''
+		with self.lock:
+			snapshot = dict(self.counters)
+			reactions = list(self.reactions.items())
+		snapshot['parse'] = self.parse.snapshot()
+		snapshot['queue_wait'] = self.queue_wait.snapshot()
+		snapshot['reactions'] = dict((name, histogram.snapshot()) for name, histogram in reactions)
+		return snapshot
+
+	def reset(self):
+		'''
+		Zeroes every counter and empties every histogram
+		'''
+		with self.lock:
+			for name in self.counters:
+				self.counters[name] = 0
+			self.reactions.clear()
+			self.pending.clear()
+		self.parse.reset()
+		self.queue_wait.reset()
+
+	def dump(self, interval=5.0, write=None):
+		'''
+		Writes a snapshot every interval seconds from a background thread until stop_dump is called
+		write is given one line of text at a time, the default writes to stderr
+		'''
+		self.stop_dump()
+		write = sys.stderr.write if write is None else write
+		stopped = threading.Event()
+		def dump_snapshots():
+			while not stopped.wait(interval):
+				write(self.format() + '\n')
+		self.dumping = stopped
+		thread = threading.Thread(target=dump_snapshots)
+		thread.daemon = True
+		thread.start()
+
+	def stop_dump(self):
+		'''
+		Stops writing snapshots
+		'''
+		if self.dumping is not None:
+			self.dumping.set()
+			self.dumping = None
+
+	def format(self):
+		'''
+		Returns a snapshot as one line of text, with durations in ms
+		'''
+		ms = lambda seconds: '-' if seconds is None else '%.2f' % (seconds * 1000)
+		histogram = lambda name, s: '%s n=%d p50=%s p99=%s max=%s' % (name, s['count'], ms(s['p50']), ms(s['p99']), ms(s['max'] if s['count'] else None))
+		snapshot = self.snapshot()
+		parts = ['%s=%d' % (name, snapshot[name]) for name in self.COUNTERS]
+		parts.append(histogram('parse', snapshot['parse']))
+		parts.append(histogram('queue_wait', snapshot['queue_wait']))
+		for name in sorted(snapshot['reactions']):
+			parts.append(histogram(name, snapshot['reactions'][name]))
+		return ' | '.join(parts)
@@ -0,0 +1,81 @@
+'''
+Dead reckoning from the distance (19) and angle (20) packets the iRobot streams
+Positions are in mm and headings in degrees counter clockwise, like the packets
+Besides the pose it estimates the speed and turn rate over the last few frames, so it can predict where the iRobot will be a moment later
+'''
+import collections
+import math
+from scheduler import FRAME_PERIOD
+
+WINDOW = 4 # Frames the speed and turn rate are averaged over, the packets only count whole mm and degrees
+
+class Odometry(object):
+	'''
+	Integrates the distance and angle reported in each frame into a pose, and estimates how fast it is changing
+	'''
+	def __init__(self, x=0.0, y=0.0, heading=0.0, period=FRAME_PERIOD):
+		'''
+		Starts at x, y facing heading, with frames arriving every period seconds
+		'''
+		self.period = period
+		self.recent = collections.deque([(0, 0)] * WINDOW, maxlen=WINDOW) # (mm, degrees) of the last frames
+		self.speed = 0.0 # mm/s
+		self.rate = 0.0 # Degrees/s counter clockwise
+		self.reset(x, y, heading)
+
+	def reset(self, x=0.0, y=0.0, heading=0.0):
+		'''
+		Moves the pose to x, y facing heading and forgets anything not integrated yet
+		'''
+		self.x = float(x)
+		self.y = float(y)
+		self.heading = float(heading) % 360
+		self.moved = 0 # mm reported since the last integrate
+		self.turned = 0 # Degrees reported since the last integrate
+
+	def add(self, distance=0, angle=0):
+		'''
+		Takes the distance or angle of one packet, which are integrated together once the frame is decoded
+		'''
+		self.moved += distance
+		self.turned += angle
+
+	def integrate(self):
+		'''
+		Moves the pose by the distance and angle of the frame and returns (x, y, heading)
+		The distance is taken along the heading halfway through the turn, which is exact for an arc
+		'''
+		if self.moved:
+			middle = math.radians(self.heading + self.turned / 2.0)
+			self.x += self.moved * math.cos(middle)
+			self.y += self.moved * math.sin(middle)
+		self.heading = (self.heading + self.turned) % 360
+		recent = self.recent
+		recent.append((self.moved, self.turned))
+		self.speed = sum(moved for moved, turned in recent) / (WINDOW * self.period)
+		self.rate = sum(turned for moved, turned in recent) / (WINDOW * self.period)
+		self.moved = 0
+		self.turned = 0
+		return self.x, self.y, self.heading
+
+	@property
+	def moving(self):
+		'''
+		True while there is motion to integrate or the speed or turn rate hasn't settled to 0
+		'''
+		return bool(self.moved or self.turned or self.speed or self.rate)
+
+	def predict(self, seconds):
+		'''
+		Returns the (x, y, heading) the iRobot reaches in seconds if it keeps its speed and turn rate
+		'''
+		turn = self.rate * seconds
+		middle = math.radians(self.heading + turn / 2.0)
+		return self.x + self.speed * seconds * math.cos(middle), self.y + self.speed * seconds * math.sin(middle), (self.heading + turn) % 360
+
+	@property
+	def pose(self):
+		'''
+		(x, y, heading) as of the last integrate
+		'''
+		return self.x, self.y, self.heading
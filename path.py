@@ -0,0 +1,189 @@
+'''
+Plans drives through arbitrary waypoints as timed drive direct commands
+Corners are blended into arcs so the iRobot doesn't stop at them, and speeds follow the fastest profile the wheel speed and acceleration limits allow
+Distances are in mm, speeds in mm/s, and angles in degrees, like trajectory
+'''
+from __future__ import division
+import math
+import encoder
+
+WHEEL_BASE = encoder.WHEEL_BASE # mm between the wheels
+MAX_SPEED = encoder.MAX_SPEED # Fastest a wheel can turn, mm/s
+ACCELERATION = 500.0 # Fastest the speed along the path changes, mm/s^2
+LATERAL = 1000.0 # Largest sideways acceleration allowed on an arc, mm/s^2
+BLEND = 150.0 # Radius corners are rounded to when the legs around them are long enough, mm
+MIN_RADIUS = 5.0 # Corners that can only be rounded tighter than this are turned in place instead, mm
+STEP = 0.05 # Seconds each drive direct command lasts while the speed ramps
+
+class Piece(object):
+	'''
+	A line, arc, or turn in place of a planned path
+	'''
+	LINE = 'line'
+	ARC = 'arc'
+	SPIN = 'spin'
+	def __init__(self, kind, length, right, left, limit):
+		'''
+		Creates a piece length mm long whose wheels turn at right and left times the speed along it, which never goes over limit
+		For a turn in place length is how far each wheel travels, and the speed is the wheels' speed
+		'''
+		self.kind = kind
+		self.length = length
+		self.right = right
+		self.left = left
+		self.limit = limit
+		self.entry = 0.0 # Speed the piece starts at, set by the planner
+		self.exit = 0.0 # Speed the piece ends at, set by the planner
+
+	def profile(self, acceleration):
+		'''
+		Returns the (start speed, end speed, seconds) phases of the fastest trapezoidal profile from entry to exit speed
+		'''
+		peak = min(self.limit, math.sqrt(max(acceleration * self.length + (self.entry ** 2 + self.exit ** 2) / 2, 0.0)))
+		speeding = (peak ** 2 - self.entry ** 2) / (2 * acceleration)
+		slowing = (peak ** 2 - self.exit ** 2) / (2 * acceleration)
+		cruising = max(self.length - speeding - slowing, 0.0)
+		phases = [(self.entry, peak, (peak - self.entry) / acceleration)]
+		if cruising and peak:
+			phases.append((peak, peak, cruising / peak))
+		phases.append((peak, self.exit, (peak - self.exit) / acceleration))
+		return [phase for phase in phases if phase[2] > 0]
+
+class Plan(object):
+	'''
+	The pieces of a path and the drive direct commands that drive them, with the duration known before anything is sent
+	'''
+	def __init__(self, pieces, acceleration=ACCELERATION, step=STEP):
+		'''
+		Times pieces with the fastest speed profile that starts and ends stopped
+		'''
+		self.pieces = pieces
+		self.acceleration = acceleration
+		self.step = step
+		self.plan_speeds()
+		self.steps = self.plan_steps()
+		self.duration = sum(seconds for right, left, seconds in self.steps)
+
+	def plan_speeds(self):
+		'''
+		Sets each piece's entry and exit speed as high as the limits on both sides of it allow
+		A forward pass caps how fast each piece can be reached and a backward pass how fast it can be left
+		'''
+		pieces = self.pieces
+		bounds = [0.0] * (len(pieces) + 1) # Speed at the start of each piece and the end of the last
+		for i in range(1, len(pieces)):
+			before, after = pieces[i - 1], pieces[i]
+			if before.kind != Piece.SPIN and after.kind != Piece.SPIN: # Turns in place start and end stopped
+				bounds[i] = min(before.limit, after.limit)
+		for i, piece in enumerate(pieces):
+			bounds[i + 1] = min(bounds[i + 1], math.sqrt(bounds[i] ** 2 + 2 * self.acceleration * piece.length))
+		for i in reversed(range(len(pieces))):
+			bounds[i] = min(bounds[i], math.sqrt(bounds[i + 1] ** 2 + 2 * self.acceleration * pieces[i].length))
+		for i, piece in enumerate(pieces):
+			piece.entry = bounds[i]
+			piece.exit = bounds[i + 1]
+
+	def plan_steps(self):
+		'''
+		Returns the (right mm/s, left mm/s, seconds) commands that drive the pieces
+		Ramps are split into commands of about step seconds at the speed halfway through each, so the distance matches the profile
+		'''
+		steps = []
+		for piece in self.pieces:
+			for start, end, seconds in piece.profile(self.acceleration):
+				count = 1 if start == end else max(int(math.ceil(seconds / self.step)), 1)
+				for i in range(count):
+					speed = start + (end - start) * (i + 0.5) / count
+					command = (int(round(speed * piece.right)), int(round(speed * piece.left)))
+					if steps and steps[-1][:2] == command:
+						steps[-1] = command + (steps[-1][2] + seconds / count,)
+					else:
+						steps.append(command + (seconds / count,))
+		return steps
+
+	def commands(self):
+		'''
+		Returns the (drive direct command, seconds until the next one) pairs of the plan, ending with a stop
+		'''
+		return [(encoder.drive_direct(right, left), seconds) for right, left, seconds in self.steps] + [(encoder.drive_direct(0, 0), 0.0)]
+
+def angle_between(heading, following):
+	'''
+	Returns the counter clockwise turn in radians from heading to following, between -pi and pi
+	'''
+	return (following - heading + math.pi) % (2 * math.pi) - math.pi
+
+def spin(angle, speed, wheel_base):
+	'''
+	Creates a piece that turns angle radians in place, counter clockwise if positive
+	'''
+	direction = 1.0 if angle > 0 else -1.0
+	return Piece(Piece.SPIN, abs(angle) * wheel_base / 2, direction, -direction, speed)
+
+def plan(waypoints, heading=None, speed=MAX_SPEED, acceleration=ACCELERATION, lateral=LATERAL, blend=BLEND, wheel_base=WHEEL_BASE, step=STEP, final=None):
+	'''
+	Plans a drive from the first of waypoints, a list of (x, y) points in mm, through the rest in order
+	heading is the direction the iRobot starts facing in degrees counter clockwise from the x axis, by default the direction of the first leg
+	final is the direction it should end facing, which it turns to in place at the last waypoint, by default the direction of the last leg
+	No wheel goes faster than speed, corners are rounded to radius blend or less so they fit between the legs, and corners too sharp to round are turned in place
+	Returns a Plan
+	'''
+	legs = [] # (length, heading in radians) of every leg that goes somewhere
+	for (x0, y0), (x1, y1) in zip(waypoints, waypoints[1:]):
+		length = math.hypot(x1 - x0, y1 - y0)
+		if length > 1e-9:
+			legs.append((length, math.atan2(y1 - y0, x1 - x0)))
+	line_limit = min(speed, MAX_SPEED)
+	if not legs:
+		angle = 0.0 if heading is None or final is None else angle_between(math.radians(heading), math.radians(final))
+		return Plan([spin(angle, line_limit, wheel_base)] if abs(angle) > 1e-9 else [], acceleration, step)
+	arc_limit = lambda radius: min(line_limit / (1 + wheel_base / (2 * radius)), math.sqrt(lateral * radius))
+	corners = [] # (turn in radians, radius or None to turn in place, mm of each leg the arc uses) between consecutive legs
+	for i in range(1, len(legs)):
+		angle = angle_between(legs[i - 1][1], legs[i][1])
+		if abs(angle) < 1e-9:
+			corners.append((0.0, None, 0.0))
+			continue
+		room = min(legs[i - 1][0] / (1 if i == 1 else 2), legs[i][0] / (1 if i == len(legs) - 1 else 2)) # Legs between two corners share their length
+		tangent = math.tan(abs(angle) / 2)
+		radius = min(blend, room / tangent)
+		if radius < MIN_RADIUS:
+			corners.append((angle, None, 0.0))
+		else:
+			corners.append((angle, radius, radius * tangent))
+
+	pieces = []
+	if heading is not None:
+		angle = angle_between(math.radians(heading), legs[0][1])
+		if abs(angle) > 1e-9:
+			pieces.append(spin(angle, line_limit, wheel_base))
+	for i, (length, direction) in enumerate(legs):
+		start = corners[i - 1][2] if i > 0 else 0.0
+		end = corners[i][2] if i < len(corners) else 0.0
+		if length - start - end > 1e-9:
+			pieces.append(Piece(Piece.LINE, length - start - end, 1.0, 1.0, line_limit))
+		if i < len(corners):
+			angle, radius, used = corners[i]
+			if radius is not None:
+				curvature = (1.0 if angle > 0 else -1.0) / radius
+				pieces.append(Piece(Piece.ARC, radius * abs(angle), 1 + curvature * wheel_base / 2, 1 - curvature * wheel_base / 2, arc_limit(radius)))
+			elif angle:
+				pieces.append(spin(angle, line_limit, wheel_base))
+	if final is not None:
+		angle = angle_between(legs[-1][1], math.radians(final))
+		if abs(angle) > 1e-9:
+			pieces.append(spin(angle, line_limit, wheel_base))
+	return Plan(pieces, acceleration, step)
+
+def polygon(sides, perimeter=2000, start=(0.0, 0.0), heading=0.0):
+	'''
+	Returns the waypoints of a regular polygon traced counter clockwise from start, with the first side heading degrees from the x axis
+	'''
+	x, y = start
+	points = [(x, y)]
+	for i in range(sides):
+		direction = math.radians(heading + 360.0 * i / sides)
+		x += math.cos(direction) * perimeter / sides
+		y += math.sin(direction) * perimeter / sides
+		points.append((x, y))
+	return points
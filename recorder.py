@@ -0,0 +1,214 @@
+'''
+Records the bytes received from and sent to the iRobot in a compact append-only log, and replays them
+A log is a MAGIC header followed by records of [kind][timestamp][length][bytes]
+'''
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'IRTL\x01'
+RECORD = struct.Struct('<BdI') # Kind, seconds since the epoch, and number of bytes
+RECEIVED = 1 # Bytes read from the iRobot
+SENT = 2 # Command written to the iRobot
+
+class TelemetryRecorder(object):
+	'''
+	Appends every received chunk and sent command to a log from a background thread
+	Recording only appends to a deque, so it never blocks the sensor or writer threads
+	'''
+	FLUSH_INTERVAL = 0.25 # Most seconds a record waits before it is written to the file
+
+	def __init__(self, path):
+		'''
+		Creates or appends to the log at path and starts the writing thread
+		'''
+		self.path = path
+		self.file = open(path, 'ab')
+		if self.file.tell() == 0:
+			self.file.write(MAGIC)
+		self.pending = collections.deque() # Records waiting to be written
+		self.wake = threading.Event()
+		self.running = True
+		self.thread = threading.Thread(target=self.write_records)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def received(self, data):
+		'''
+		Records bytes read from the iRobot
+		'''
+		if data:
+			self.pending.append((RECEIVED, time.time(), bytes(data)))
+
+	def sent(self, data):
+		'''
+		Records a command written to the iRobot
+		'''
+		self.pending.append((SENT, time.time(), bytes(data)))
+
+	def write_records(self):
+		'''
+		Writes pending records to the file until the recorder is closed
+		'''
+		while self.running or self.pending:
+			self.wake.wait(self.FLUSH_INTERVAL)
+			self.wake.clear()
+			while self.pending:
+				kind, timestamp, data = self.pending.popleft()
+				self.file.write(RECORD.pack(kind, timestamp, len(data)))
+				self.file.write(data)
+			self.file.flush()
+
+	def close(self):
+		'''
+		Writes every pending record and closes the log
+		'''
+		self.running = False
+		self.wake.set()
+		self.thread.join()
+		self.file.close()
+
+class TelemetryLog(object):
+	'''
+	Reads a log through mmap without loading it into memory
+	'''
+	def __init__(self, path):
+		'''
+		Maps the log at path
+		'''
+		self.file = open(path, 'rb')
+		size = os.fstat(self.file.fileno()).st_size
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+		if self.map[:len(MAGIC)] != MAGIC:
+			raise ValueError(path + ' is not a telemetry log')
+
+	def records(self, kinds=(RECEIVED, SENT)):
+		'''
+		Yields (kind, timestamp, data) for every complete record of one of the kinds, in the order they were recorded
+		'''
+		try:
+			view = memoryview(self.map)
+		except TypeError: # Python 2 mmaps can't be viewed
+			view = self.map
+		offset = len(MAGIC)
+		while offset + RECORD.size <= len(self.map):
+			kind, timestamp, length = RECORD.unpack_from(self.map, offset)
+			offset += RECORD.size
+			if offset + length > len(self.map): # Still being written
+				return
+			if kind in kinds:
+				yield kind, timestamp, view[offset:offset + length]
+			offset += length
+
+	def close(self):
+		'''
+		Unmaps the log
+		'''
+		if self.map:
+			self.map.close()
+		self.file.close()
+
+class ReplayTransport(object):
+	'''
+	Stands in for a serial port and feeds a log's received bytes back with their recorded timing
+	Commands written to it are kept in sent instead of going anywhere
+	'''
+	BUFFERED = 4096 # Most bytes moved out of the log ahead of being read when replaying as fast as possible
+	def __init__(self, path, speed=1.0):
+		'''
+		Replays the log at path speed times faster than it was recorded, or as fast as possible if speed is None
+		'''
+		self.log = TelemetryLog(path)
+		self.speed = speed
+		self.timeout = None # Seconds read waits for, like serial.Serial.timeout
+		self.chunks = self.log.records((RECEIVED,))
+		self.buffer = bytearray() # Bytes that are due but haven't been read
+		self.next = None # The next chunk that isn't due yet
+		self.first = None # Recorded time of the first chunk
+		self.started = None # Time the replay started
+		self.finished = threading.Event() # Set once every chunk has been read
+		self.closed = threading.Event()
+		self.sent = [] # Commands written during the replay
+
+	def due(self):
+		'''
+		Moves every chunk whose time has come into the buffer and returns the seconds until the next one, or None at the end
+		'''
+		while True:
+			if self.next is None:
+				self.next = next(self.chunks, None)
+				if self.next is None:
+					if not self.buffer:
+						self.finished.set()
+					return None
+			kind, timestamp, data = self.next
+			if self.first is None:
+				self.first, self.started = timestamp, time.time()
+			wait = 0.0 if not self.speed else (timestamp - self.first) / self.speed - (time.time() - self.started)
+			if wait > 0:
+				return wait
+			self.buffer += data
+			self.next = None
+			if not self.speed and len(self.buffer) >= self.BUFFERED:
+				return 0.0
+
+	def read(self, n=1):
+		'''
+		Returns up to n bytes, waiting at most timeout seconds for them to come due
+		'''
+		deadline = None if self.timeout is None else time.time() + self.timeout
+		while len(self.buffer) < n:
+			wait = self.due()
+			if len(self.buffer) >= n:
+				break
+			remaining = None if deadline is None else deadline - time.time()
+			if remaining is not None and remaining <= 0:
+				break
+			if wait is None: # Nothing left to replay, wait like a port that has gone quiet
+				if not self.buffer:
+					self.closed.wait(remaining)
+				break
+			time.sleep(wait if remaining is None else min(wait, remaining))
+		data = bytes(self.buffer[:n])
+		del self.buffer[:n]
+		if not self.buffer:
+			self.due() # Sets finished once the last byte has been read
+		return data
+
+	@property
+	def in_waiting(self):
+		'''
+		Number of bytes that are due
+		'''
+		self.due()
+		return len(self.buffer)
+
+	def write(self, data):
+		'''
+		Keeps a command instead of sending it
+		'''
+		self.sent.append(bytes(data))
+		return len(data)
+
+	def reset_input_buffer(self):
+		'''
+		Throws away every byte that is due
+		'''
+		del self.buffer[:]
+
+	def flush(self):
+		'''
+		Nothing is buffered on the way out
+		'''
+
+	def close(self):
+		'''
+		Stops replaying
+		'''
+		self.closed.set()
+		self.next = None
+		self.chunks.close()
+		self.log.close()
@@ -0,0 +1,97 @@
+'''
+Safety interlock checked by the thread that decodes the sensor stream, so the wheels stop within a frame whatever the control code is doing
+A trip writes a stop straight to the serial port, ahead of every queued command, and latches a fault that holds back every motion command except stops
+The control code has to acknowledge the fault before the iRobot can drive again
+'''
+import collections
+import threading
+import encoder
+from history import clock
+
+Fault = collections.namedtuple('Fault', 'reason frame time') # What tripped the interlock, the number of the frame that showed it, and when
+
+class SafetyInterlock(object):
+	'''
+	Stops the iRobot on the first frame any of its conditions is True, and keeps it stopped until acknowledge
+	'''
+	STOP = encoder.drive_direct(0, 0) # Stops both wheels without leaving the mode
+	PACKETS = { # Names of the iRobot packets each of its INTERRUPTS needs streamed
+		'wheel drop': ('WHEEL_DROP_AND_BUMPERS',),
+		'bump': ('WHEEL_DROP_AND_BUMPERS',),
+		'cliff': ('CLIFF_LEFT', 'CLIFF_FRONT_LEFT', 'CLIFF_FRONT_RIGHT', 'CLIFF_RIGHT'),
+		'button': ('BUTTONS',),
+	}
+
+	def __init__(self, robot, conditions=None):
+		'''
+		Guards robot once robot.set_interlock is given the interlock
+		conditions are names of robot.INTERRUPTS, by default WHEEL_DROP and CLIFF, or a dictionary of names and predicates of a frame's Snapshot
+		Bumps aren't a condition by default, behaviors such as seek_dock drive until they bump on purpose
+		'''
+		self.robot = robot
+		conditions = (robot.WHEEL_DROP, robot.CLIFF) if conditions is None else conditions
+		if not isinstance(conditions, dict):
+			conditions = dict((name, robot.INTERRUPTS[name]) for name in conditions)
+		self.conditions = sorted(conditions.items()) # Checked in the same order every frame
+		self.packets = [] # Packets the conditions read, which robot.set_interlock adds to the stream
+		for reason, condition in self.conditions:
+			for name in self.PACKETS.get(reason, ()):
+				if getattr(robot, name) not in self.packets:
+					self.packets.append(getattr(robot, name))
+		self.fault = None # The Fault latched by the last trip, None until then and once acknowledged
+		self.trips = 0
+		self.latching = threading.Lock() # Keeps a trip in the decoding thread and an acknowledge in the control thread apart
+
+	def check(self, state):
+		'''
+		Runs for every decoded frame: trips on the first of the conditions that is True in state unless a fault is already latched
+		Returns the latched Fault or None
+		'''
+		if self.fault is not None:
+			return self.fault
+		for reason, condition in self.conditions:
+			if condition(state):
+				return self.trip(reason, state.frame)
+		return None
+
+	def trip(self, reason, frame=None):
+		'''
+		Stops the wheels now and latches a fault, which can also be done by the control code, for example on a button
+		Returns the latched Fault, which is the earlier one if a fault was already latched
+		'''
+		with self.latching:
+			if self.fault is not None:
+				return self.fault
+			fault = self.fault = Fault(reason, self.robot.state.frame if frame is None else frame, clock())
+			self.trips += 1
+			self.robot.connection.halt(self.STOP)
+		self.robot.log.event('interlock tripped', reason=reason, frame=fault.frame)
+		return fault
+
+	def active(self):
+		'''
+		Returns the names of the conditions that are True in the last frame
+		'''
+		state = self.robot.state
+		return [reason for reason, condition in self.conditions if condition(state)]
+
+	def acknowledge(self):
+		'''
+		Releases the latched fault so the iRobot can drive again, unless a condition is still True in the last frame
+		Safe mode drops to passive on a wheel drop or cliff, so the mode connect asked for is sent again first
+		Returns True if no fault is latched any more
+		'''
+		with self.latching:
+			if self.fault is None:
+				return True
+			holding = self.active()
+			if holding:
+				self.robot.log.event('interlock held', reasons=holding)
+				return False
+			self.robot.log.event('interlock acknowledged', reason=self.fault.reason)
+			self.fault = None
+			mode = self.robot.requested_mode
+			if mode is not None and self.robot.MODE_COMMANDS[mode]:
+				self.robot.connection.send(self.robot.MODE_COMMANDS[mode])
+			self.robot.connection.release()
+			return True
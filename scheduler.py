@@ -0,0 +1,151 @@
+'''
+Runs control callbacks in step with the sensor stream, once every so many frames or at a fixed period
+Every callback is given the measured seconds since it last ran, and each task keeps count of its overruns and jitter
+'''
+from history import clock
+
+FRAME_PERIOD = 0.015 # Seconds between frames of the sensor stream
+
+class Task(object):
+	'''
+	A callback run by a FrameScheduler, with its timing statistics
+	'''
+	def __init__(self, callback, frames=1, period=None):
+		'''
+		Runs callback(dt) every frames frames, or every period seconds if period is given
+		'''
+		self.callback = callback
+		self.frames = max(1, int(frames))
+		self.period = period
+		self.interval = period if period is not None else self.frames * FRAME_PERIOD # Nominal seconds between runs
+		self.due_frame = None # Frame count the task next runs at
+		self.due_time = None # Time the task next runs at
+		self.last = None # Time of the last run
+		self.dt = 0.0 # Measured seconds between the last two runs
+		self.duration = 0.0 # Seconds the last run took
+		self.runs = 0
+		self.overruns = 0 # Runs skipped because the last run, or the frame, came late
+		self.jitter_total = 0.0
+		self.jitter_max = 0.0 # Largest difference between a measured dt and the interval
+
+	def due(self, frame, now):
+		'''
+		Returns True if the task should run at this frame and time
+		'''
+		if self.period is None:
+			return self.due_frame is None or frame >= self.due_frame
+		return self.due_time is None or now >= self.due_time
+
+	def run(self, frame, now):
+		'''
+		Calls the callback with the seconds since the last run and schedules the next run
+		'''
+		if self.period is None:
+			if self.due_frame is not None and frame >= self.due_frame + self.frames:
+				self.overruns += (frame - self.due_frame) // self.frames
+			self.due_frame = frame + self.frames
+		else:
+			if self.due_time is not None and now >= self.due_time + self.period:
+				missed = int((now - self.due_time) / self.period)
+				self.overruns += missed
+				self.due_time += missed * self.period
+			self.due_time = (now if self.due_time is None else self.due_time) + self.period # Keeps a fixed rate instead of drifting
+		if self.last is None:
+			self.dt = self.interval
+		else:
+			self.dt = now - self.last
+			jitter = abs(self.dt - self.interval)
+			self.jitter_total += jitter
+			self.jitter_max = max(self.jitter_max, jitter)
+		self.last = now
+		try:
+			self.callback(self.dt)
+		finally:
+			self.runs += 1
+			self.duration = clock() - now
+
+	@property
+	def jitter(self):
+		'''
+		Average difference between a measured dt and the interval
+		'''
+		return self.jitter_total / (self.runs - 1) if self.runs > 1 else 0.0
+
+	def stats(self):
+		'''
+		Returns a dictionary of the task's timing statistics
+		'''
+		return {'runs': self.runs, 'overruns': self.overruns, 'interval': self.interval, 'dt': self.dt, 'duration': self.duration, 'jitter': self.jitter, 'jitter_max': self.jitter_max}
+
+class FrameScheduler(object):
+	'''
+	Wakes once per decoded frame of an iRobot and runs the tasks that are due
+	'''
+	def __init__(self, robot):
+		'''
+		Schedules tasks on the frames of robot
+		'''
+		self.robot = robot
+		self.tasks = []
+		self.running = False
+
+	def every(self, callback, frames=1, period=None):
+		'''
+		Runs callback(dt) every frames frames, or every period seconds (checked once per frame) if period is given
+		Returns the Task, which holds its timing statistics
+		'''
+		task = Task(callback, frames, period)
+		self.tasks.append(task)
+		return task
+
+	def cancel(self, task):
+		'''
+		Stops running a task
+		'''
+		if task in self.tasks:
+			self.tasks.remove(task)
+
+	def step(self, timeout=None):
+		'''
+		Waits for the next frame and runs every task that is due
+		Returns the number of tasks run, 0 if no frame arrived within timeout seconds
+		'''
+		if not self.robot.wait_frame(timeout):
+			return 0
+		return self.run_due()
+
+	def run_due(self):
+		'''
+		Runs every task that is due at the current frame, returns the number run
+		'''
+		frame = self.robot.frame_count
+		ran = 0
+		for task in list(self.tasks):
+			now = clock()
+			if task.due(frame, now):
+				task.run(frame, now)
+				ran += 1
+		return ran
+
+	def run(self, until=None, timeout=None):
+		'''
+		Runs tasks frame by frame until stop is called, until() returns True, or no frame arrives within timeout seconds
+		'''
+		self.running = True
+		while self.running and not (until is not None and until()):
+			if not self.robot.wait_frame(timeout):
+				break
+			self.run_due()
+		self.running = False
+
+	def stop(self):
+		'''
+		Makes run return after the current frame
+		'''
+		self.running = False
+
+	def stats(self):
+		'''
+		Returns the timing statistics of every task
+		'''
+		return [task.stats() for task in self.tasks]
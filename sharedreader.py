@@ -0,0 +1,302 @@
+'''
+Reads and decodes the sensor stream in a child process, so control code holding the GIL can't make frames late
+The child publishes every decoded frame into a ring in shared memory, and each slot is guarded by a sequence counter (a seqlock)
+The parent reads whole frames from the ring without a lock and keeps the same iRobot interface
+Needs Python 3.8 and the fork start method, so it runs on Linux and macOS
+'''
+import errno
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import shared_memory
+from struct import Struct
+from history import clock
+from interface import BUTTON_STATES, CHARACTERS, Button, Character, SENSOR_VALUES, SensorState, Snapshot, iRobot
+from metrics import Metrics
+
+def encode_value(value):
+	'''
+	Returns a sensor value as a number that fits its slot
+	'''
+	if isinstance(value, Button):
+		return value.pressed | value.released << 1
+	if isinstance(value, Character):
+		return value.curr
+	return value
+
+def field_codes():
+	'''
+	Returns the struct code and decoder of every SensorState field, picked from the type of its value before any frame
+	Numbers are doubles so a filter can make them floats, and they are turned back into ints when they are whole
+	'''
+	codes = []
+	for name, value in zip(SensorState.__slots__, SENSOR_VALUES(SensorState())):
+		if isinstance(value, bool):
+			codes.append(('?', bool))
+		elif isinstance(value, Button):
+			codes.append(('B', lambda bits: BUTTON_STATES[bool(bits & 1), bool(bits & 2)]))
+		elif isinstance(value, Character):
+			codes.append(('B', CHARACTERS.__getitem__))
+		elif name == 'frame':
+			codes.append(('Q', int))
+		else:
+			codes.append(('d', lambda number: int(number) if number.is_integer() else number))
+	return codes
+
+class SharedFrames(object):
+	'''
+	Ring of sensor snapshots in shared memory, written by one process and read by any number of others
+	The header holds the number of frames published, and each slot a sequence counter that is odd while the slot is being written
+	'''
+	CODES = field_codes()
+	HEADER = Struct('<Q') # Frames published
+	SEQUENCE = Struct('<Q') # Start of every slot, even when the slot can be read
+	PAYLOAD = Struct('<Qd' + ''.join(code for code, decoder in CODES)) # Number of the frame, arrival time, and every sensor value
+	DECODERS = [decoder for code, decoder in CODES]
+	RETRIES = 1000 # Reads of a slot that keeps changing before giving up on it
+
+	def __init__(self, slots=64):
+		'''
+		Creates a ring of slots frames, about a second at the stream rate
+		'''
+		self.slots = slots
+		self.size = self.SEQUENCE.size + self.PAYLOAD.size
+		self.memory = shared_memory.SharedMemory(create=True, size=self.HEADER.size + slots * self.size)
+		self.buffer = self.memory.buf
+		self.HEADER.pack_into(self.buffer, 0, 0)
+		for slot in range(slots):
+			self.SEQUENCE.pack_into(self.buffer, self.offset(slot), 0)
+		self.published = 0 # Frames published, only kept by the writer
+		self.cached = (None, None) # (frame number, (arrival time, Snapshot)) of the last frame read
+
+	def offset(self, number):
+		'''
+		Returns where the slot of frame number starts
+		'''
+		return self.HEADER.size + (number % self.slots) * self.size
+
+	def publish(self, state, arrived):
+		'''
+		Writes a snapshot that arrived at time arrived into the next slot, then counts it so readers can see it
+		'''
+		buffer = self.buffer
+		offset = self.offset(self.published)
+		sequence = self.SEQUENCE.unpack_from(buffer, offset)[0]
+		self.SEQUENCE.pack_into(buffer, offset, sequence + 1) # Odd, readers retry
+		self.PAYLOAD.pack_into(buffer, offset + self.SEQUENCE.size, self.published, arrived, *[encode_value(value) for value in SENSOR_VALUES(state)])
+		self.SEQUENCE.pack_into(buffer, offset, sequence + 2)
+		self.published += 1
+		self.HEADER.pack_into(buffer, 0, self.published)
+
+	@property
+	def count(self):
+		'''
+		Frames published so far
+		'''
+		return self.HEADER.unpack_from(self.buffer, 0)[0]
+
+	def read(self, number):
+		'''
+		Returns (arrival time, Snapshot) of frame number, or None if its slot has already been reused for a newer frame
+		'''
+		cached = self.cached # Read once, another thread may replace it
+		if cached[0] == number:
+			return cached[1]
+		buffer = self.buffer
+		offset = self.offset(number)
+		for retry in range(self.RETRIES):
+			before = self.SEQUENCE.unpack_from(buffer, offset)[0]
+			if before & 1: # Being written
+				time.sleep(0)
+				continue
+			values = self.PAYLOAD.unpack_from(buffer, offset + self.SEQUENCE.size)
+			if self.SEQUENCE.unpack_from(buffer, offset)[0] == before:
+				break
+		else:
+			return None
+		if values[0] != number:
+			return None
+		frame = (values[1], tuple.__new__(Snapshot, [decode(value) for decode, value in zip(self.DECODERS, values[2:])]))
+		self.cached = (number, frame)
+		return frame
+
+	def latest(self):
+		'''
+		Returns (arrival time, Snapshot) of the newest frame, or None if nothing has been published
+		'''
+		while True:
+			count = self.count
+			if not count:
+				return None
+			frame = self.read(count - 1)
+			if frame is not None: # Otherwise the writer lapped the ring while it was read
+				return frame
+
+	def close(self):
+		'''
+		Unmaps the ring and frees it
+		'''
+		self.buffer = None
+		self.memory.close()
+		self.memory.unlink()
+
+class SilentConnection(object):
+	'''
+	Stands in for the Connection of the child's decoder, which only reads
+	'''
+	def __init__(self):
+		self.metrics = Metrics()
+
+	def send(self, data, delay=True, priority=None):
+		pass
+
+class FrameWriter(iRobot):
+	'''
+	The child's decoder, which publishes every frame it decodes
+	'''
+	def __init__(self, frames, waking):
+		iRobot.__init__(self, SilentConnection(), reader=False)
+		self.frames = frames
+		self.waking = waking
+		self.arrived = 0.0
+
+	def feed(self, data, arrived=None):
+		self.arrived = clock() if arrived is None else arrived
+		iRobot.feed(self, data, self.arrived)
+
+	def parse_data(self, frame):
+		if not iRobot.parse_data(self, frame):
+			return False
+		self.frames.publish(self.state, self.arrived)
+		try:
+			os.write(self.waking, b'\0') # Wake the parent
+		except OSError as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK): # The parent is behind, it reads every new frame when it wakes
+				raise
+		return True
+
+class SharedRobot(iRobot):
+	'''
+	An iRobot whose sensor stream is read and decoded by a child process
+	Commands are still written by this process, and a light thread here only wakes up waiting code and measures reactions
+	Changes to the packets, filters, and pose are sent to the child over a control pipe, and history stays empty since only the child decodes
+	'''
+	def __init__(self, connection=None, slots=64):
+		'''
+		Establishes connection to the iRobot and a ring of slots frames shared with the reader process
+		connection must be a serial port, which the reader process inherits
+		'''
+		self.local = None # Snapshot used before the reader publishes a frame
+		iRobot.__init__(self, connection, reader=False)
+		self.frames = SharedFrames(slots)
+		self.waker, self.waking = os.pipe() # Written by the reader process after every frame
+		os.set_blocking(self.waking, False)
+		self.changes, self.control = multiprocessing.Pipe(duplex=False) # Packet, filter, and pose changes for the reader process
+		self.process = None
+		self.followed = 0 # Frames handed to waiting code
+		self.data_thread = threading.Thread(target=self.follow_frames)
+		self.data_thread.daemon = True
+
+	@property
+	def state(self):
+		'''
+		The newest frame published by the reader process
+		'''
+		frame = self.frames.latest()
+		return self.local if frame is None else frame[1]
+
+	@state.setter
+	def state(self, snapshot):
+		self.local = snapshot
+
+	def start_reader(self):
+		'''
+		Forks the reader process, then starts the thread that wakes up waiting code, unless they are already running
+		'''
+		if self.process is not None:
+			return
+		self.process = multiprocessing.get_context('fork').Process(target=self.read_frames)
+		self.process.daemon = True
+		self.process.start()
+		os.close(self.waking)
+		self.changes.close()
+		self.data_thread.start()
+
+	def tell(self, *change):
+		'''
+		Sends a change to the reader process once it is running, it applies it before decoding the next bytes it reads
+		'''
+		if self.process is not None:
+			self.control.send(change)
+
+	def stream_packets(self):
+		'''
+		Tells the reader process the packets before the iRobot is asked to stream them, so it never decodes the new frames with the old layout
+		'''
+		self.tell('packets', self.packets)
+		iRobot.stream_packets(self)
+
+	def set_filter(self, name, filter_=None):
+		iRobot.set_filter(self, name, filter_)
+		self.tell('filter', name, filter_)
+
+	def reset_pose(self, x=0.0, y=0.0, heading=0.0):
+		iRobot.reset_pose(self, x, y, heading)
+		self.tell('pose', x, y, heading)
+
+	def read_frames(self):
+		'''
+		Runs in the reader process: decodes the stream with the same packets, filters, and state as this iRobot and publishes every frame
+		Later changes to them arrive through the control pipe
+		'''
+		os.close(self.waker)
+		self.control.close()
+		writer = FrameWriter(self.frames, self.waking)
+		writer.set_packets(self.packets)
+		for name, filter_ in self.filters.items():
+			writer.set_filter(name, filter_)
+		for name, value in zip(SensorState.__slots__, SENSOR_VALUES(self.working)):
+			setattr(writer.working, name, value)
+		writer.odometry.reset(self.working.x, self.working.y, self.working.heading)
+		port = self.connection.connection
+		changes = {'packets': writer.set_packets, 'filter': writer.set_filter, 'pose': writer.reset_pose}
+		while True:
+			data = port.read(max(1, port.in_waiting))
+			while self.changes.poll(): # Sent before the command that changes the stream, so it is here before any bytes it affects
+				change = self.changes.recv()
+				changes[change[0]](*change[1:])
+			writer.feed(data)
+
+	def follow_frames(self):
+		'''
+		Hands every frame the reader process publishes to the code waiting on frames
+		Frames that were overwritten before this thread got to them are counted as dropped
+		'''
+		while True:
+			try:
+				if not os.read(self.waker, 1024): # The reader process has exited
+					return
+			except OSError:
+				return
+			count = self.frames.count
+			while self.followed < count:
+				frame = self.frames.read(self.followed)
+				self.followed += 1
+				if frame is None:
+					self.metrics.count('dropped')
+					continue
+				self.react(frame[0], frame[1])
+				self.metrics.count('frames')
+				self.frame_decoded(frame[1])
+
+	def close(self):
+		'''
+		Stops the reader process, closes the connection, and frees the shared ring
+		'''
+		if self.process is not None:
+			self.process.terminate()
+			self.process.join()
+		self.control.close()
+		self.connection.close()
+		self.frames.close()
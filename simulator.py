@@ -0,0 +1,97 @@
+'''
+Vectorized kinematic simulator for tuning the wall follower's PD gains without the iRobot
+Every gain combination is one element of the simulation's arrays, so thousands run together
+Run with: python simulator.py
+'''
+import math
+import time
+import numpy as np
+from interface import iRobot
+
+WHEEL_BASE = iRobot.DIAMETER # m, the wheels sit at the edge of the iRobot
+SENSOR_ANGLE = math.radians(-60) # Direction of the right light bump relative to the heading
+SENSOR_PEAK = 3000.0 # Light bump reading against a wall
+SENSOR_FALLOFF = 0.03 # m, distance at which the reading has halved
+SENSOR_MAX = 4095
+COLLISION_PENALTY = 1.0 # Added to the score for every collision
+BUMP_TURN = math.radians(20) # How far the iRobot turns away after hitting the wall
+
+def light_bump(distance, heading):
+	'''
+	Models the right light bump of iRobots distance m (center to wall) from a wall on their right, heading radians from parallel
+	'''
+	direction = heading + SENSOR_ANGLE
+	facing = np.sin(direction) < 0 # The sensor only sees the wall when it points towards it
+	edge = distance + iRobot.RADIUS * np.sin(direction)
+	reach = np.where(facing, np.maximum(edge, 0.0) / -np.where(facing, np.sin(direction), -1.0), np.inf)
+	return np.clip(SENSOR_PEAK / (1.0 + (reach / SENSOR_FALLOFF) ** 2), 0, SENSOR_MAX)
+
+def error2radius(error):
+	'''
+	Vectorized iRobot.error2radius
+	'''
+	safe = np.where(error == 0, 1.0, error)
+	radius = np.where(error < 0, -iRobot.STRAIGHT / safe + 500, -iRobot.STRAIGHT / safe + 100)
+	radius = np.trunc(np.clip(radius, -iRobot.STRAIGHT + 1, iRobot.STRAIGHT))
+	return np.where(error == 0, iRobot.STRAIGHT, radius)
+
+def simulate(Kp, Kd, set_point=420, delay=0.25, speed=iRobot.MAX_SPEED / 4.5, duration=20.0, dt=0.015, distance=0.2, heading=0.0, noise=0.0, seed=None):
+	'''
+	Simulates the wall follower in __main__ for every combination of the arguments, which are broadcast together
+	The iRobot starts distance m (center to wall) from a straight wall on its right, heading radians away from it
+	Returns a dictionary of arrays: rms_error (in set points), collisions, and score (lower is better)
+	'''
+	Kp, Kd, set_point, delay = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in (Kp, Kd, set_point, delay)])
+	shape = Kp.shape
+	rng = np.random.RandomState(seed)
+	y = np.full(shape, float(distance)) # Distance from the wall to the iRobot's center
+	theta = np.full(shape, float(heading)) # Heading, positive turns away from the wall
+	omega = np.zeros(shape) # Angular velocity from the last drive command
+	velocity = np.full(shape, float(speed))
+	e_prev = set_point - light_bump(y, theta)
+	since_control = np.full(shape, np.inf) # Seconds since each controller last ran
+	squared_error = np.zeros(shape)
+	collisions = np.zeros(shape)
+	steps = int(duration / dt)
+	for step in range(steps):
+		reading = light_bump(y, theta)
+		if noise:
+			reading = reading + rng.normal(0.0, noise, shape)
+		e_curr = set_point - reading
+		squared_error += (e_curr / set_point) ** 2
+		control = since_control >= delay # Controllers whose delay has passed run this step
+		since_control = np.where(control, 0.0, since_control + dt)
+		e_val = Kp * e_curr + Kd * (e_curr - e_prev) / delay
+		radius = error2radius(e_val) / 1000.0 # m
+		with np.errstate(divide='ignore'):
+			turning = np.where(np.abs(radius) <= 0.001, np.sign(radius) * speed / (WHEEL_BASE / 2.0), speed / radius)
+		omega = np.where(control, np.where(radius >= iRobot.STRAIGHT / 1000.0, 0.0, turning), omega)
+		velocity = np.where(control, np.where(np.abs(radius) <= 0.001, 0.0, speed), velocity)
+		e_prev = np.where(control, e_curr, e_prev)
+		theta = theta + omega * dt
+		y = y + velocity * np.sin(theta) * dt
+		hit = y <= iRobot.RADIUS # The bumper touched the wall
+		collisions += hit
+		y = np.where(hit, iRobot.RADIUS, y)
+		theta = np.where(hit, theta + BUMP_TURN, theta)
+	rms_error = np.sqrt(squared_error / steps)
+	return {'rms_error': rms_error, 'collisions': collisions, 'score': rms_error + COLLISION_PENALTY * collisions}
+
+def tune(Kp_values, Kd_values, set_points=(420,), delays=(0.25,), **kwargs):
+	'''
+	Simulates every combination of the given gains, set points, and delays
+	Returns a list of (score, Kp, Kd, set_point, delay, rms_error, collisions), best first
+	'''
+	Kp, Kd, set_point, delay = np.meshgrid(Kp_values, Kd_values, set_points, delays, indexing='ij')
+	results = simulate(Kp, Kd, set_point, delay, **kwargs)
+	order = np.argsort(results['score'], axis=None)
+	columns = (results['score'], Kp, Kd, set_point, delay, results['rms_error'], results['collisions'])
+	return [tuple(float(column.flat[i]) for column in columns) for i in order]
+
+if __name__ == '__main__':
+	start = time.time()
+	ranking = tune(np.linspace(0.0, 1.0, 41), np.linspace(0.0, 0.05, 41), set_points=(300, 420, 600), delays=(0.015, 0.1, 0.25))
+	print('%d combinations in %.1f s' % (len(ranking), time.time() - start))
+	print('score    Kp      Kd      set point  delay  rms error  collisions')
+	for result in ranking[:10]:
+		print('%-8.4f %-7.3f %-7.4f %-10.0f %-6.3f %-10.4f %.0f' % result)
@@ -0,0 +1,107 @@
+'''
+Tests for the sensor stream and command paths of interface.py, run with: python -m pytest
+'''
+import encoder
+from interface import CommandQueue, Connection, FrameSync
+
+def make_frame(payload):
+	'''
+	Returns a whole frame (header, n-bytes, payload, and checksum) around payload, a list of byte values
+	'''
+	frame = bytearray([FrameSync.HEADER, len(payload)] + payload)
+	frame.append(-sum(frame) & 0xFF)
+	return frame
+
+def feed(sync, data):
+	'''
+	Feeds data and returns copies of the payloads found, which are only valid until the next feed
+	'''
+	return [bytes(payload) for payload in sync.feed(bytes(data))]
+
+FIRST, SECOND, THIRD = [7, 1], [7, 2], [7, 3] # Payloads of one wheel drop and bumpers packet
+
+def test_resyncs_after_a_dropped_byte():
+	sync = FrameSync(2)
+	first = make_frame(FIRST)
+	del first[3] # The value never arrived
+	assert feed(sync, first + make_frame(SECOND) + make_frame(THIRD)) == [bytes(bytearray(SECOND)), bytes(bytearray(THIRD))]
+	assert sync.frames == 2
+
+def test_resyncs_after_a_corrupt_checksum():
+	sync = FrameSync(2)
+	first = make_frame(FIRST)
+	first[-1] ^= 0x40
+	assert feed(sync, first + make_frame(SECOND) + make_frame(THIRD)) == [bytes(bytearray(SECOND)), bytes(bytearray(THIRD))]
+	assert sync.corrupt == 1
+
+def test_one_byte_at_a_time():
+	sync = FrameSync(2)
+	stream = make_frame(FIRST) + make_frame(SECOND) + make_frame(THIRD)
+	found = []
+	for i in range(len(stream)):
+		found += feed(sync, stream[i:i + 1])
+	assert found == [bytes(bytearray(payload)) for payload in (FIRST, SECOND, THIRD)]
+	assert sync.skipped == 0
+
+def test_frame_split_across_two_feeds():
+	sync = FrameSync(2)
+	stream = make_frame(FIRST) + make_frame(SECOND)
+	assert feed(sync, stream[:7]) == [bytes(bytearray(FIRST))]
+	assert feed(sync, stream[7:]) == [bytes(bytearray(SECOND))]
+
+class Transport(object):
+	'''
+	Stands in for the serial port and keeps everything written to it
+	'''
+	def __init__(self):
+		self.written = []
+
+	def write(self, data):
+		self.written.append(data)
+
+	def close(self):
+		pass
+
+def drain(queue):
+	'''
+	Returns the (data, priority) of every queued command in the order they would be written
+	'''
+	commands = []
+	while True:
+		command = queue.get(block=False)
+		if command is None:
+			return commands
+		commands.append((command[0], command[2]))
+		queue.done()
+
+STOP = encoder.drive(0, 0)
+SONG = encoder.play(0)
+
+def test_stop_goes_ahead_of_a_queued_song():
+	queue = CommandQueue()
+	queue.put(SONG)
+	queue.put(STOP)
+	assert drain(queue) == [(STOP, CommandQueue.URGENT), (SONG, CommandQueue.BULK)]
+
+def test_consecutive_drives_collapse_to_the_last():
+	queue = CommandQueue()
+	for speed in (100, 200, 300):
+		queue.put(encoder.drive(speed, 0))
+	assert drain(queue) == [(encoder.drive(300, 0), CommandQueue.NORMAL)]
+	assert queue.unfinished == 0
+
+def test_drive_after_a_waiting_stop_keeps_its_priority():
+	queue = CommandQueue()
+	queue.put(STOP)
+	queue.put(encoder.drive(300, 0))
+	assert drain(queue) == [(encoder.drive(300, 0), CommandQueue.NORMAL)]
+	assert queue.unfinished == 0
+
+def test_repeat_of_the_last_drive_is_skipped():
+	transport = Transport()
+	connection = Connection(transport=transport, writer=False)
+	for i in range(2):
+		connection.send(encoder.drive(100, 0))
+		connection.write_command(connection.queue.get(block=False))
+	assert transport.written == [encoder.drive(100, 0)]
+	assert connection.metrics.counters['commands'] == 1
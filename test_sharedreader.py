@@ -0,0 +1,62 @@
+'''
+Tests for sharedreader.py against the emulator on a pseudo terminal, run with: python -m pytest
+'''
+import time
+import pytest
+
+pytest.importorskip('multiprocessing.shared_memory') # Python 3.8 and later
+from emulator import OIEmulator
+from interface import Connection
+from sharedreader import SharedRobot
+
+class SlowRobot(SharedRobot):
+	'''
+	A SharedRobot whose frame thread stalls on its first frame, so the reader process laps the ring meanwhile
+	'''
+	def react(self, arrived, state=None):
+		if not self.metrics.counters['frames']:
+			time.sleep(0.3)
+		SharedRobot.react(self, arrived, state)
+
+def connected(robot_class, slots=64):
+	'''
+	Returns an emulator and a robot_class connected to it over a pseudo terminal
+	'''
+	emulator = OIEmulator()
+	robot = robot_class(Connection(emulator.serve_pty()), slots)
+	robot.connect()
+	return emulator, robot
+
+def test_frames_are_published():
+	emulator, robot = connected(SharedRobot)
+	try:
+		assert robot.wait_frame(1)
+		assert robot.frames.count > 0
+		emulator.bump(True, True, 5)
+		assert robot.wait_until(lambda: robot.state.LB and robot.state.RB, timeout=1) == robot.DONE
+	finally:
+		robot.close()
+		emulator.close()
+
+def test_overwritten_frames_are_dropped():
+	emulator, robot = connected(SlowRobot, slots=4)
+	try:
+		assert robot.wait_until(lambda: robot.metrics.counters['frames'] > 1, timeout=2) == robot.DONE
+		assert robot.metrics.counters['dropped'] > 0
+	finally:
+		robot.close()
+		emulator.close()
+
+def test_new_packets_apply_before_their_frames():
+	emulator, robot = connected(SharedRobot)
+	try:
+		assert robot.wait_frame(1)
+		robot.track_pose() # Told to the reader process before the iRobot streams the longer frames
+		robot.drive(0.1)
+		assert robot.wait_until(lambda: robot.state.x > 0, timeout=2) == robot.DONE
+		robot.stop_drive()
+		count = robot.frames.count
+		assert robot.wait_until(lambda: robot.frames.count > count + 5, timeout=1) == robot.DONE
+	finally:
+		robot.close()
+		emulator.close()
@@ -0,0 +1,106 @@
+'''
+Compiles paths of drive and turn segments into Open Interface scripts
+The iRobot runs a script on its own, stopping each segment on its own distance and angle sensors
+'''
+import math
+import struct
+import encoder
+
+# Op Codes
+DRIVE = 137
+SCRIPT = 152
+PLAY_SCRIPT = 153
+WAIT_DISTANCE = 156
+WAIT_ANGLE = 157
+
+MAX_SCRIPT = 100 # Most bytes a script can hold
+STRAIGHT = 32767
+CCW = 1
+CW = -1
+DRIVE_COMMAND = struct.Struct('>B2h')
+WAIT_COMMAND = struct.Struct('>Bh')
+STOP = DRIVE_COMMAND.pack(DRIVE, 0, 0)
+
+class Segment(object):
+	'''
+	One straight drive or turn in place of a path
+	'''
+	DRIVE = 'drive'
+	TURN = 'turn'
+	def __init__(self, kind, amount, speed):
+		'''
+		Creates a segment that drives amount mm or turns amount degrees counter clockwise at speed mm/s
+		'''
+		self.kind = kind
+		self.amount = amount
+		self.speed = abs(speed)
+
+	def compile(self):
+		'''
+		Returns the script commands for the segment: a drive command followed by a wait
+		'''
+		direction = 1 if self.amount >= 0 else -1
+		if self.kind == self.DRIVE:
+			return DRIVE_COMMAND.pack(DRIVE, int(direction * self.speed), STRAIGHT) + WAIT_COMMAND.pack(WAIT_DISTANCE, int(round(self.amount)))
+		return DRIVE_COMMAND.pack(DRIVE, int(self.speed), CCW if direction > 0 else CW) + WAIT_COMMAND.pack(WAIT_ANGLE, int(round(self.amount)))
+
+	def duration(self, wheel_base=encoder.WHEEL_BASE):
+		'''
+		Estimates how many seconds the segment takes
+		'''
+		distance = abs(self.amount) if self.kind == self.DRIVE else math.radians(abs(self.amount)) * wheel_base / 2.0
+		return distance / self.speed if self.speed else 0.0
+
+def drive(distance, speed=100):
+	'''
+	Creates a segment that drives distance mm in a straight line, backwards if distance is negative
+	'''
+	return Segment(Segment.DRIVE, distance, speed)
+
+def turn(angle, speed=100):
+	'''
+	Creates a segment that turns angle degrees in place, counter clockwise if angle is positive
+	'''
+	return Segment(Segment.TURN, angle, speed)
+
+def polygon(sides, perimeter=2000, speed=100):
+	'''
+	Creates the segments that trace a regular polygon counter clockwise with a perimeter in mm
+	'''
+	segments = []
+	for i in range(sides):
+		segments.append(drive(float(perimeter) / sides, speed))
+		segments.append(turn(360.0 / sides, speed))
+	return segments
+
+def compile_scripts(segments):
+	'''
+	Turns segments into as few scripts as possible, each of which fits in MAX_SCRIPT bytes and ends by stopping
+	Returns a list of (script body, estimated seconds) pairs
+	'''
+	scripts = []
+	body = b''
+	seconds = 0.0
+	for segment in segments:
+		commands = segment.compile()
+		if body and len(body) + len(commands) + len(STOP) > MAX_SCRIPT:
+			scripts.append((body + STOP, seconds))
+			body = b''
+			seconds = 0.0
+		body += commands
+		seconds += segment.duration()
+	if body:
+		scripts.append((body + STOP, seconds))
+	return scripts
+
+def upload(body):
+	'''
+	Returns the command that stores a script body on the iRobot
+	'''
+	return struct.pack('>2B', SCRIPT, len(body)) + body
+
+def play():
+	'''
+	Returns the command that runs the stored script
+	'''
+	return struct.pack('>B', PLAY_SCRIPT)